@@ -0,0 +1,209 @@
+"""
+the services of the route handlers, created on first use and shared by the whole worker process.
+
+importing the app creates nothing and imports none of the clients (pynamodb / botocore, aiohttp, requests, redis):
+the handlers get their services with Depends(get_....dependency), the first request needing a service creates it
+(and imports its modules) in the threadpool. tests can call the handlers with their own services, or replace them
+with app.dependency_overrides.
+"""
+import asyncio
+import functools
+import threading
+
+from app_config import (OKTA_DOMAIN, OKTA_API_TOKEN, OKTA_ADMIN_GROUP_ID, CSV_BATCH_SIZE, OKTA_FULL_SYNC_INTERVAL,
+                        REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_MAX_CONNECTIONS, REDIS_SERIALIZER,
+                        REDIS_COMPRESS_THRESHOLD, USER_CACHE_L1_SIZE, USER_CACHE_L1_TTL, SCAN_JOB_WORKERS,
+                        DYNAMODB_WRITERS, DYNAMODB_WRITES_PER_SECOND, SCAN_TOTAL_SEGMENTS,
+                        USERS_VIEW_RECONCILE_INTERVAL, USER_SNAPSHOT_PATH, USER_SNAPSHOT_MAX_AGE,
+                        CSV_PARALLEL_WORKERS, CSV_PARALLEL_MIN_BYTES, CSV_PARALLEL_WINDOW_BYTES, CSV_PARALLEL_TMP_DIR)
+
+# reentrant - the getters call the getters of the services they depend on.
+_lock = threading.RLock()
+
+
+def shared(factory):
+    """
+    decorator - the returned getter creates the service on its first call (once per process, under a lock) and
+    returns the same one afterwards.
+
+    getter.dependency is the coroutine function to use with Depends: FastAPI runs the plain function dependencies
+    in the threadpool, one thread hop per request, while this one only goes there to create the service.
+    getter.created() tells whether the service was created (e.g. to only close the created ones).
+    """
+    instance = []
+
+    @functools.wraps(factory)
+    def getter():
+        if not instance:
+            with _lock:
+                if not instance:
+                    instance.append(factory())
+        return instance[0]
+
+    async def dependency():
+        if instance:
+            return instance[0]
+        return await asyncio.to_thread(getter)
+
+    getter.dependency = dependency
+    getter.created = lambda: bool(instance)
+    return getter
+
+
+@shared
+def get_redis_service():
+    from app.services.redis_service import RedisService
+    from app.services.serializers import get_serializer
+
+    return RedisService(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, max_connections=REDIS_MAX_CONNECTIONS,
+                        serializer=get_serializer(REDIS_SERIALIZER, REDIS_COMPRESS_THRESHOLD))
+
+
+@shared
+def get_async_redis_service():
+    from app.services.redis_service import AsyncRedisService
+    from app.services.serializers import get_serializer
+
+    return AsyncRedisService(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, max_connections=REDIS_MAX_CONNECTIONS,
+                             serializer=get_serializer(REDIS_SERIALIZER, REDIS_COMPRESS_THRESHOLD))
+
+
+@shared
+def get_user_cache():
+    """
+    :return: in-process cache in front of redis for the hot user details keys.
+    """
+    from app.services.two_tier_cache import TwoTierCache, LocalCache
+
+    return TwoTierCache(get_redis_service(), LocalCache(max_size=USER_CACHE_L1_SIZE, ttl=USER_CACHE_L1_TTL),
+                        async_redis_service=get_async_redis_service())
+
+
+def invalidate_user_details(emails):
+    # also when this process never read a user - the redis keys and the L1 of the other workers are invalidated.
+    get_user_cache().invalidate(*[f"user_details:{email}" for email in emails])
+
+
+@shared
+def get_users_view():
+    """
+    :return: materialized view of the users list, updated by the writes of the user repository.
+    """
+    from app.services.users_view import UsersView
+
+    return UsersView(get_redis_service(), async_redis_service=get_async_redis_service())
+
+
+@shared
+def get_user_snapshot():
+    """
+    :return: columnar copy of the users view in this process, for the analytical routes. requires numpy.
+    """
+    from app.services.user_snapshot import UserSnapshot
+
+    return UserSnapshot.open(USER_SNAPSHOT_PATH or None, max_age=USER_SNAPSHOT_MAX_AGE)
+
+
+@shared
+def get_user_repository():
+    from app.dynamo_db.models import OktaUser
+    from app.dynamo_db.repositories import UserRepository
+
+    users_view = get_users_view()
+    user_repository = UserRepository(OktaUser, on_users_written=invalidate_user_details, users_view=users_view)
+    if USERS_VIEW_RECONCILE_INTERVAL:
+        users_view.start_reconcile_job(user_repository, USERS_VIEW_RECONCILE_INTERVAL, SCAN_TOTAL_SEGMENTS)
+    return user_repository
+
+
+@shared
+def get_user_event_repository():
+    from app.dynamo_db.models import OktaUserEvent
+    from app.dynamo_db.repositories import UserEventRepository
+
+    return UserEventRepository(OktaUserEvent)
+
+
+@shared
+def get_async_user_repository():
+    from app.dynamo_db.repositories import AsyncUserRepository
+
+    return AsyncUserRepository(get_user_repository())
+
+
+@shared
+def get_user_service():
+    from app.dynamo_db.service import UserService
+
+    return UserService(get_user_repository(), event_repository=get_user_event_repository(), writers=DYNAMODB_WRITERS,
+                       writes_per_second=DYNAMODB_WRITES_PER_SECOND or None)
+
+
+@shared
+def get_okta_client():
+    from app.api.okta import OktaClient
+
+    return OktaClient(OKTA_DOMAIN, OKTA_API_TOKEN)
+
+
+@shared
+def get_async_okta_client():
+    from app.api.okta import AsyncOktaClient
+
+    return AsyncOktaClient(OKTA_DOMAIN, OKTA_API_TOKEN)
+
+
+@shared
+def get_identity_service():
+    from app.api.utils import DataProcessor
+    from app.services.identity_service import IdentityService
+
+    okta_client = get_okta_client()
+    return IdentityService(api_service=okta_client, data_processor=DataProcessor(okta_client),
+                           async_api_service=get_async_okta_client())
+
+
+@shared
+def get_cache_service():
+    """
+    :return: cache-aside helper protected against cache stampedes.
+    """
+    from app.services.cache_service import AsyncCacheService
+
+    return AsyncCacheService(get_async_redis_service())
+
+
+@shared
+def get_okta_sync_service():
+    from app.services.okta_sync_service import OktaSyncService
+
+    return OktaSyncService(get_identity_service(), get_user_repository(), get_redis_service(),
+                           admin_group_id=OKTA_ADMIN_GROUP_ID, full_sync_interval=OKTA_FULL_SYNC_INTERVAL)
+
+
+@shared
+def get_scan_job_service():
+    """
+    :return: background processing of the S3 scan files.
+    """
+    from app.services.scan_job_service import ScanJobService
+
+    return ScanJobService(get_user_service(), get_redis_service(), max_workers=SCAN_JOB_WORKERS,
+                          batch_size=CSV_BATCH_SIZE, parallel_workers=CSV_PARALLEL_WORKERS,
+                          parallel_min_bytes=CSV_PARALLEL_MIN_BYTES, parallel_window_bytes=CSV_PARALLEL_WINDOW_BYTES,
+                          tmp_dir=CSV_PARALLEL_TMP_DIR or None)
+
+
+async def close_services():
+    """
+    release the resources of the services created by this process - called on shutdown.
+    """
+    if get_async_okta_client.created():
+        await get_async_okta_client().close()
+    if get_scan_job_service.created():
+        # the running jobs are not waited for, they resume from their last checkpoint when submitted again.
+        get_scan_job_service().shutdown(wait=False)
+    if get_async_user_repository.created():
+        get_async_user_repository().close()
+    if get_users_view.created():
+        get_users_view().stop_reconcile_job()
@@ -0,0 +1,65 @@
+import json
+import logging
+import time
+
+from fastapi import APIRouter
+from fastapi.responses import Response
+from prometheus_client import REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+
+from app.services.metrics import HTTP_REQUEST_SECONDS, collect_timings
+
+logger = logging.getLogger(__name__)
+
+# create metrics route.
+metrics = APIRouter(tags=["metrics"])
+
+
+@metrics.get("/metrics")
+def get_metrics():
+    """
+    :return: the metrics of this worker process in the Prometheus text format.
+    """
+    return Response(content=generate_latest(REGISTRY), media_type=CONTENT_TYPE_LATEST)
+
+
+class RequestTimingMiddleware:
+    """
+    ASGI middleware recording the latency of every request (http_request_duration_seconds, by route template), and
+    logging one JSON line per request with its status, duration and the time spent per external service, e.g.:
+
+        {"method": "POST", "route": "/users/scan/", "status": 202, "ms": 35.2,
+         "components": {"dynamodb": {"calls": 3, "ms": 12.1}, "redis": {"calls": 4, "ms": 1.3}}}
+    """
+
+    def __init__(self, app, log_level=logging.INFO):
+        self.app = app
+        self.log_level = log_level
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        components = {}
+        try:
+            with collect_timings() as components:
+                await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            # the route template (e.g. /users/{email}), the raw paths would be unbounded labels.
+            route = getattr(scope.get("route"), "path", "unmatched")
+            HTTP_REQUEST_SECONDS.labels(scope["method"], route, str(status)).observe(elapsed)
+
+            if logger.isEnabledFor(self.log_level):
+                logger.log(self.log_level, json.dumps({
+                    "method": scope["method"], "route": route, "path": scope["path"], "status": status,
+                    "ms": round(elapsed * 1000, 2), "components": components}))
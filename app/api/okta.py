@@ -1,4 +1,15 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
 import requests
+from requests.adapters import HTTPAdapter
+
+from app.services.metrics import add_bytes, observe
+
+logger = logging.getLogger(__name__)
 
 
 class OktaClient:
@@ -8,29 +19,76 @@ class OktaClient:
         It handles the construction of the API request, making the HTTP GET call to retrieve user data,
         and processing the response. The class ensures that the interaction with the Okta API is abstracted
         and centralized, making it easier to maintain and modify.
+
+        All the requests go through one pooled requests.Session. list endpoints are paginated by following
+        the 'Link: rel="next"' cursors, and the X-Rate-Limit-* headers are used to throttle the requests before
+        Okta starts rejecting them.
     """
 
-    def __init__(self, okta_domain: str, api_key: str):
+    def __init__(self, okta_domain: str, api_key: str, page_limit: int = 200, base_url: str = None,
+                 pool_size: int = 10, rate_limit_threshold: int = 5, max_retries: int = 3):
+        """
+        :param okta_domain: Okta organization domain (e.g. example.okta.com).
+        :param api_key: Okta API token.
+        :param page_limit: number of items requested per page ('limit' parameter).
+        :param base_url: override of the API base url (default https://{okta_domain}).
+        :param pool_size: max number of pooled connections.
+        :param rate_limit_threshold: below this number of remaining requests, the client spreads the remaining
+         requests until the rate limit window resets.
+        :param max_retries: how many times to retry a request that was rejected with 429.
+        """
         self.okta_domain = okta_domain
         self.api_key = api_key
+        self.page_limit = page_limit
+        self.base_url = base_url or f"https://{okta_domain}"
+        self.rate_limit_threshold = rate_limit_threshold
+        self.max_retries = max_retries
+
+        self.session = requests.Session()
+        self.session.headers.update({"Authorization": f"SSWS {self.api_key}", "Accept": "application/json"})
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
 
-    def get_users_data(self):
+    def iter_pages(self, path, params=None):
         """
-        get users from Okta API.
+        :param path: API path (e.g. /api/v1/users).
+        :param params: query parameters of the first request, 'limit' is added if missing.
+        :return: iterator over the pages (list of items) of the endpoint, following the 'next' links.
         """
-        url = f"https://{self.okta_domain}/api/v1/users"
-        headers = {"Authorization": f"SSWS {self.api_key}"}
+        url = self.base_url + path
+        params = {"limit": self.page_limit, **(params or {})}
 
-        try:
-            response = requests.get(url, headers=headers)
+        while url:
+            response = self._get(url, params)
+            yield response.json()
 
-            # Raise exception for bad responses
-            response.raise_for_status()
-            return response.json()
+            # the next link already holds the cursor and the query parameters.
+            url = response.links.get("next", {}).get("url")
+            params = None
 
-        except requests.exceptions.RequestException as e:
-            print(f"Error fetching users data: {e}")
-            return []
+    def iter_users(self, params=None):
+        """
+        :return: iterator over all the users in the organization, page after page.
+        """
+        for page in self.iter_pages("/api/v1/users", params):
+            yield from page
+
+    def get_users_data(self, updated_since=None):
+        """
+        get users from Okta API.
+
+        the request errors are raised - an empty list always means that there are no (updated) users, the sync
+        state is never moved forward after a failed fetch.
+
+        :param updated_since: if given (Okta timestamp, e.g. 2025-03-01T10:00:00.000Z), only the users updated
+         at or after it are fetched (filter=lastUpdated ge "...").
+        """
+        params = None
+        if updated_since:
+            params = {"filter": f'lastUpdated ge "{updated_since}"'}
+
+        return list(self.iter_users(params))
 
     def get_admin_users(self, admin_group_id):
         """
@@ -38,14 +96,185 @@ class OktaClient:
 
             return: function get list if all users and insert for admin field only for admin users in organization.
         """
-        url = "https://" + self.okta_domain + f"/api/v1/groups/{admin_group_id}/users"
-        headers = {"Authorization": f"SSWS {self.api_key}"}
+        # raised like in get_users_data - a failed fetch would remove the admins.
+        return [user for page in self.iter_pages(f"/api/v1/groups/{admin_group_id}/users") for user in page]
+
+    def get_users_and_admin_users(self, admin_group_id, updated_since=None):
+        """
+        fetch the users and the members of the admin group concurrently.
+
+        :param admin_group_id:
+        :param updated_since: see get_users_data.
+        :return: tuple of (users, admin users).
+        """
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            users_future = executor.submit(self.get_users_data, updated_since)
+            admins_future = executor.submit(self.get_admin_users, admin_group_id)
+            return users_future.result(), admins_future.result()
+
+    def _get(self, url, params):
+        """
+        GET request with rate limit handling - wait for the rate limit reset on 429 and retry.
+        """
+        for attempt in range(self.max_retries + 1):
+            start = time.perf_counter()
+            try:
+                response = self.session.get(url, params=params)
+            except requests.exceptions.RequestException as e:
+                observe("okta", "get", time.perf_counter() - start, type(e).__name__)
+                raise
+
+            observe("okta", "get", time.perf_counter() - start,
+                    str(response.status_code) if response.status_code >= 400 else None)
+            add_bytes("okta", "in", len(response.content))
 
-        try:
-            response = requests.get(url, headers=headers)
+            if response.status_code == 429 and attempt < self.max_retries:
+                wait = self._seconds_until_reset(response)
+                logger.info("Okta rate limit exceeded, retrying in %.1f seconds.", wait)
+                time.sleep(wait)
+                continue
+
+            # Raise exception for bad responses
             response.raise_for_status()
+            self._throttle(response)
+            return response
+
+    def _throttle(self, response):
+        """
+        adaptive throttling - when only a few requests are left in the current rate limit window, spread them
+        evenly until the window resets instead of bursting into 429 responses.
+        """
+        wait = throttle_delay(response.headers, self.rate_limit_threshold)
+        if wait > 0:
+            time.sleep(wait)
+
+    @staticmethod
+    def _seconds_until_reset(response):
+        return seconds_until_reset(response.headers)
+
+
+class AsyncOktaClient:
+    """
+        asyncio version of OktaClient (aiohttp), for the async request handlers.
+
+        same pagination and rate limit handling as OktaClient, the users and the admin group are fetched
+        concurrently on one pooled aiohttp session. the session is created on first use, call close() on shutdown.
+    """
+
+    def __init__(self, okta_domain: str, api_key: str, page_limit: int = 200, base_url: str = None,
+                 pool_size: int = 10, rate_limit_threshold: int = 5, max_retries: int = 3):
+        self.okta_domain = okta_domain
+        self.api_key = api_key
+        self.page_limit = page_limit
+        self.base_url = base_url or f"https://{okta_domain}"
+        self.pool_size = pool_size
+        self.rate_limit_threshold = rate_limit_threshold
+        self.max_retries = max_retries
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                headers={"Authorization": f"SSWS {self.api_key}", "Accept": "application/json"},
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def iter_pages(self, path, params=None):
+        """
+        :return: async iterator over the pages (list of items) of the endpoint, following the 'next' links.
+        """
+        url = self.base_url + path
+        params = {"limit": self.page_limit, **(params or {})}
+
+        while url:
+            page, links = await self._get(url, params)
+            yield page
+
+            next_link = links.get("next")
+            url = str(next_link["url"]) if next_link else None
+            params = None
+
+    async def iter_users(self, params=None):
+        async for page in self.iter_pages("/api/v1/users", params):
+            for user in page:
+                yield user
+
+    async def get_users_data(self, updated_since=None):
+        """
+        get users from Okta API, see OktaClient.get_users_data (the request errors are raised).
+        """
+        params = None
+        if updated_since:
+            params = {"filter": f'lastUpdated ge "{updated_since}"'}
+
+        return [user async for user in self.iter_users(params)]
 
-            return response.json()
+    async def get_admin_users(self, admin_group_id):
+        return [user async for page in self.iter_pages(f"/api/v1/groups/{admin_group_id}/users") for user in page]
 
-        except requests.exceptions.RequestException:
-            return []
+    async def get_users_and_admin_users(self, admin_group_id, updated_since=None):
+        """
+        :return: tuple of (users, admin users), fetched concurrently.
+        """
+        return tuple(await asyncio.gather(self.get_users_data(updated_since), self.get_admin_users(admin_group_id)))
+
+    async def _get(self, url, params):
+        """
+        :return: tuple of (json body, links) of the response.
+        """
+        for attempt in range(self.max_retries + 1):
+            start = time.perf_counter()
+            try:
+                response = await self.session.get(url, params=params)
+            except aiohttp.ClientError as e:
+                observe("okta", "get", time.perf_counter() - start, type(e).__name__)
+                raise
+
+            async with response:
+                # the body is read here, so the time includes the download.
+                if response.status < 400:
+                    add_bytes("okta", "in", len(await response.read()))
+                observe("okta", "get", time.perf_counter() - start,
+                        str(response.status) if response.status >= 400 else None)
+
+                if response.status == 429 and attempt < self.max_retries:
+                    wait = seconds_until_reset(response.headers)
+                    logger.info("Okta rate limit exceeded, retrying in %.1f seconds.", wait)
+                    await asyncio.sleep(wait)
+                    continue
+
+                response.raise_for_status()
+                body = await response.json()
+
+                wait = throttle_delay(response.headers, self.rate_limit_threshold)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                return body, response.links
+
+
+def seconds_until_reset(headers):
+    """
+    :return: seconds until the Okta rate limit window resets (X-Rate-Limit-Reset).
+    """
+    reset = headers.get("X-Rate-Limit-Reset")
+    if reset is None:
+        return 1.0
+    return max(0.0, int(reset) - time.time())
+
+
+def throttle_delay(headers, rate_limit_threshold):
+    """
+    :return: seconds to wait before the next request, so the remaining requests of the rate limit window are
+     spread until it resets (0 if there are more than rate_limit_threshold requests left).
+    """
+    remaining = headers.get("X-Rate-Limit-Remaining")
+    if remaining is None or int(remaining) > rate_limit_threshold:
+        return 0.0
+    return seconds_until_reset(headers) / (int(remaining) + 1)
@@ -0,0 +1,5 @@
+from pydantic import BaseModel
+
+
+class ScanRequest(BaseModel):
+    s3_link: str
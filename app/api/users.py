@@ -1,15 +1,14 @@
-from fastapi import APIRouter, HTTPException
-from app.dynamo_db.models import OktaUser, ScanRequest
-from app.dynamo_db.repositories import UserRepository
-from app.dynamo_db.service import UserService
-from app.api.utils import parse_datetime, serialize_okta_user, read_csv_from_s3, DataProcessor
-from pynamodb.exceptions import ScanError
-from datetime import datetime, timedelta
-from app.api.okta import OktaClient
-from app_config import OKTA_DOMAIN, OKTA_API_TOKEN
-from app.services.identity_service import IdentityService
-from app.services.redis_service import RedisService
-import json
+import time
+from fastapi import APIRouter, HTTPException, Depends, Header
+from fastapi.responses import StreamingResponse, Response
+from app.api.dependencies import (get_user_cache, get_user_repository, get_user_event_repository,
+                                  get_async_user_repository, get_cache_service, get_okta_sync_service,
+                                  get_scan_job_service, get_users_view, get_user_snapshot)
+from app.api.schemas import ScanRequest
+from app_config import SCAN_TOTAL_SEGMENTS, OKTA_SYNC_WAIT_TIMEOUT
+
+# the services are created by the first request needing them, and their modules (pynamodb / botocore, aiohttp,
+# requests, redis) imported then - see app.api.dependencies.
 
 
 # create users route.
@@ -19,91 +18,168 @@ users = APIRouter(
     responses={404: {"description": "Not found"}}
 )
 
-# initialize the UserRepository & UserService outside the route handlers.
-user_repository = UserRepository(OktaUser)
-user_service = UserService(user_repository)
-
-# initialize OktaClient & DataProcessor outside the route handlers.
-okta_client = OktaClient(OKTA_DOMAIN, OKTA_API_TOKEN)
-data_processor = DataProcessor(okta_client)
-
-# initialize IdentityService.
-identity_service = IdentityService(api_service=okta_client, data_processor=data_processor)
-
-# initialize redis service for cache handling.
-redis_service = RedisService()
-
 
 @users.get("/")
-def insert_okta_users_to_db():
+async def insert_okta_users_to_db(full: bool = False, cache_service=Depends(get_cache_service.dependency),
+                                  okta_sync_service=Depends(get_okta_sync_service.dependency)):
     """
     when client login to url 'http://localhost/users/' we insert the scan results we get from Okta api.
+
+    only the users updated in Okta since the last sync are fetched and upserted, unless a full sync is
+    requested ('http://localhost/users/?full=true') or the periodic full reconciliation is due.
+    a 503 is returned if another worker is still syncing after OKTA_SYNC_WAIT_TIMEOUT seconds.
     :return:
     """
+    from app.services.cache_service import CacheTimeout
+
     relevant_fields = {"id", "statusChanged", "lastLogin", "passwordChanged",
                                                            "name", "email"}
     cache_key = "okta_users_data"
+    synced = []
 
-    # get cache data from redis.
-    cached_data = redis_service.get(cache_key)
-
-    if cached_data:
-        return {"okta users fetched from cache."}
+    async def sync_users():
+        # get the changed users from external api and upsert them to DB.
+        synced.append(True)
+        return (await okta_sync_service.sync_async(relevant_fields, full=full))["users_data"]
 
     try:
-        # get users from external api and data processor and extract this data.
-        users_data_dict = identity_service.get_users_data(relevant_fields)
-        # insert relevant data to redis.
-        redis_service.set(cache_key, json.dumps(users_data_dict), ex=500)
+        if full:
+            # explicit full sync - bypass the cache.
+            await cache_service.set(cache_key, await sync_users(), ttl=500)
+        else:
+            # only one worker syncs when the cache expires, the others get the cached data.
+            await cache_service.get_or_compute(cache_key, sync_users, ttl=500, wait_timeout=OKTA_SYNC_WAIT_TIMEOUT)
 
-        # upload_user_data_to_db(okta_users_data)
-        user_repository.upload_user_data_to_db(users_data_dict)
+        if not synced:
+            return {"okta users fetched from cache."}
         return {"okta users insert successfully."}
 
+    except CacheTimeout:
+        raise HTTPException(status_code=503, detail="the okta users are being synced, retry later.",
+                            headers={"Retry-After": "5"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"failed to get users from Okta API: {str(e)}")
 
 
 @users.get("/results")
-def get_users_scan_results():
+async def get_users_scan_results(limit: int = None, last_evaluated_key: str = None,
+                                 async_user_repository=Depends(get_async_user_repository.dependency),
+                                 users_view=Depends(get_users_view.dependency),
+                                 user_repository=Depends(get_user_repository.dependency),
+                                 if_none_match: str = Header(None)):
     """
     displays the results of the last scan on this route.
+
+    with 'limit' the results are paginated: the response holds up to 'limit' users and a 'last_evaluated_key'
+    token to pass to the next request ('http://localhost/users/results?limit=100&last_evaluated_key=...'),
+    the token is null on the last page.
+
+    the whole list is served from the users view (see app.services.users_view), kept up to date by the writes -
+    DynamoDB is only scanned to build it, in the background. the response has an ETag, a request with a matching
+    If-None-Match gets a 304 without the body. while the view is being built, the last version this worker served
+    is returned, or a 503 if there is none.
     :return:
     """
-    cache_scan_key = 'scan results'
-    cached_data = redis_service.get(cache_scan_key)
+    if limit is not None:
+        return await get_users_scan_results_page(limit, last_evaluated_key, async_user_repository)
+
+    try:
+        view = await users_view.aget()
+        if view is None:
+            users_view.start_build(user_repository, SCAN_TOTAL_SEGMENTS)
+            view = users_view.last_response
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"internal server error. details:{e}")
+
+    if view is None:
+        raise HTTPException(status_code=503, detail="the users view is being built, retry later.",
+                            headers={"Retry-After": "5"})
+
+    etag, content = view
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=content, media_type="application/json", headers=headers)
+
+
+def _etag_matches(if_none_match, etag):
+    """
+    :return: True if the If-None-Match header matches the etag (weak comparison).
+    """
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
 
-    if cached_data is not None:
-        return json.loads(cached_data)
+async def get_users_scan_results_page(limit, last_evaluated_key, async_user_repository):
+    from app.api.utils import serialize_raw_item, encode_page_token, decode_page_token
+    from app.dynamo_db.models import OktaUser
+    from app.services.serializers import dumps_json
+
+    if limit <= 0:
+        raise HTTPException(status_code=400, detail="limit must be a positive number.")
+
+    try:
+        start_key = decode_page_token(last_evaluated_key)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
     try:
-        response = user_repository.scan_table()
-        results = [serialize_okta_user(res) for res in response]
+        response, next_key = await async_user_repository.scan_page(limit, start_key, raw=True)
 
-        # save results in redis for 500 seconds in json format.
-        redis_service.set(cache_scan_key, json.dumps(results), ex=60)
-        return results
+        content = dumps_json({"items": [serialize_raw_item(OktaUser, item) for item in response],
+                              "last_evaluated_key": encode_page_token(next_key)})
+        return Response(content=content, media_type="application/json")
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"internal server error. details:{e}")
 
 
+@users.get("/results/stream")
+def stream_users_scan_results(user_repository=Depends(get_user_repository.dependency)):
+    """
+    displays the results of the last scan as NDJSON (one user per line), streamed while the table is scanned.
+    :return:
+    """
+    from app.api.utils import serialize_raw_item
+    from app.dynamo_db.models import OktaUser
+    from app.services.serializers import dumps_json
+
+    def ndjson_lines():
+        for item in user_repository.iter_scan(total_segments=SCAN_TOTAL_SEGMENTS, raw=True):
+            yield dumps_json(serialize_raw_item(OktaUser, item)) + b"\n"
+
+    return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
+
+
+@users.get("/cache/stats")
+def get_user_cache_stats(user_cache=Depends(get_user_cache.dependency)):
+    """
+    hit and miss counters of the user details cache, per tier (L1 in-process, L2 redis).
+    :return:
+    """
+    return user_cache.stats()
+
+
 @users.get("/{email}")
-def get_last_user_login(email):
+async def get_last_user_login(email, user_cache=Depends(get_user_cache.dependency),
+                              async_user_repository=Depends(get_async_user_repository.dependency)):
     """
     function get user_id from client and return the last login event for this user.
 
     :return:
     """
     last_login_cache_key = f"user_details:{email}"
-    cached_data = redis_service.get(last_login_cache_key)
+    cached_data = await user_cache.aget_object(last_login_cache_key)
 
     if cached_data:
-        return json.loads(cached_data)
+        return cached_data
 
     try:
         # get user details from DynamoDB.
-        user_details = user_repository.get_user_by_email(email)
+        user_details = await async_user_repository.get_user_by_email(email)
 
         if user_details.lastLogin == "":
             response = {f"user {user_details.name}, has not logged in yet."}
@@ -111,7 +187,7 @@ def get_last_user_login(email):
             response = {"user": user_details.name, "last_login": user_details.lastLogin}
 
         # save result in redis.
-        redis_service.set(last_login_cache_key, json.dumps(response), ex=60)
+        await user_cache.aset_object(last_login_cache_key, response, ex=60)
 
         return response
 
@@ -120,7 +196,8 @@ def get_last_user_login(email):
 
 
 @users.get("/admin/{email}")
-def show_last_password_changed_for_admins(email):
+async def show_last_password_changed_for_admins(email, user_cache=Depends(get_user_cache.dependency),
+                                                async_user_repository=Depends(get_async_user_repository.dependency)):
     """
     The function receives A email and returns when the password was last changed.
     The function returns the appropriate value only for those who are defined as admin in the system.
@@ -132,16 +209,16 @@ def show_last_password_changed_for_admins(email):
     :return: The last time the password was changed.
     """
     cache_key = f"user_details:{email}"
-    cached_data = redis_service.get(cache_key)
+    cached_data = await user_cache.aget_object(cache_key)
 
     if cached_data:
-        user_details = json.loads(cached_data)
+        user_details = cached_data
     else:
         try:
             # get user details from DynamoDB.
-            user_details = user_repository.get_user_by_email(email)
+            user_details = await async_user_repository.get_user_by_email(email)
             # save user details in Redis for cache use.
-            redis_service.set(cache_key, json.dumps(user_details), ex=3600)
+            await user_cache.aset_object(cache_key, user_details, ex=3600)
 
         except Exception:
             raise HTTPException(status_code=404, detail="User not found.")
@@ -149,7 +226,7 @@ def show_last_password_changed_for_admins(email):
     # check if this user is admin.
     if user_details['attribute_values'].get("admin"):
         response = user_details['attribute_values'].get("'passwordChanged'")
-        redis_service.set(cache_key, json.dumps(user_details))
+        await user_cache.aset_object(cache_key, user_details)
 
         if response == '':
             return {f"{user_details['attribute_values'].get("name")} hasn't changed his password yet."}
@@ -160,32 +237,125 @@ def show_last_password_changed_for_admins(email):
 
 
 @users.get("/admin/")
-def highlight_admins_with_old_password():
-    # get all admins in organization.
+async def highlight_admins_with_old_password(days: int = 7,
+                                             async_user_repository=Depends(get_async_user_repository.dependency)):
+    """
+    :param days: password age (in days) from which an admin password is considered old.
+    :return: dict of {admin name: last password change} for all the admins with an old password.
+    """
+    from pynamodb.exceptions import QueryError
+
     try:
-        admins = user_repository.get_admins_list()
-        expired_admins = {}
+        # single query on the admins index instead of scanning all the users.
+        admins = await async_user_repository.get_admins_with_old_password(days)
 
-        # check for all admins if they had an old password:
-        for admin in admins:
-            if admin.passwordChanged:
-                last_changed_date = parse_datetime(admin.passwordChanged)
+        return {admin.name: admin.passwordChanged for admin in admins}
 
-                if last_changed_date < (datetime.now() - timedelta(days=7)):
-                    expired_admins[admin.name] = admin.passwordChanged
+    except QueryError as e:
+        raise HTTPException(status_code=500, detail=f"DynamoDB Query Error: {str(e)}")
 
-        return expired_admins
 
-    except ScanError as e:
-        raise HTTPException(status_code=500, detail=f"DynamoDB Scan Error: {str(e)}")
+async def user_snapshot_dependency():
+    """
+    :return: the user snapshot of the analytical routes - a 503 if numpy is not installed.
+    """
+    try:
+        return await get_user_snapshot.dependency()
+    except ImportError as e:
+        raise HTTPException(status_code=503, detail=f"the analytical routes are not available: {e}")
+
+
+@users.get("/analytics/users")
+def get_analytics_users(admin: bool = None, inactive_days: int = None, never_logged_in: bool = False,
+                        password_older_than_days: int = None, status_changed_within_days: int = None,
+                        order_by: str = None, descending: bool = False, limit: int = 100,
+                        user_snapshot=Depends(user_snapshot_dependency),
+                        users_view=Depends(get_users_view.dependency),
+                        user_repository=Depends(get_user_repository.dependency)):
+    """
+    the users matching all the given filters, from the columnar snapshot of the users (see
+    app.services.user_snapshot) - e.g. the admins that did not log in for 90 days, latest login first
+    ('http://localhost/users/analytics/users?admin=true&inactive_days=90&order_by=lastLogin&descending=true').
+
+    :param inactive_days: users whose last login is older than this many days (never logged in excluded).
+    :param never_logged_in: users without a login.
+    :param password_older_than_days: users whose password changed more than this many days ago.
+    :param status_changed_within_days: users whose status changed in the last days.
+    :param order_by: 'lastLogin', 'passwordChanged' or 'statusChanged'.
+    :return: dict of {"count": number of matching users, "users": up to 'limit' of them}.
+    """
+    if limit <= 0:
+        raise HTTPException(status_code=400, detail="limit must be a positive number.")
+
+    now = time.time()
+    filters = {"equals": {}, "before": {}, "since": {}, "missing": []}
+    if admin is not None:
+        filters["equals"]["admin"] = str(admin)
+    if inactive_days is not None:
+        filters["before"]["lastLogin"] = now - inactive_days * 86400
+    if never_logged_in:
+        filters["missing"].append("lastLogin")
+    if password_older_than_days is not None:
+        filters["before"]["passwordChanged"] = now - password_older_than_days * 86400
+    if status_changed_within_days is not None:
+        filters["since"]["statusChanged"] = now - status_changed_within_days * 86400
+
+    refresh_user_snapshot(user_snapshot, users_view, user_repository)
+    try:
+        return {"count": user_snapshot.count(**filters),
+                "users": user_snapshot.rows(limit=limit, order_by=order_by, descending=descending, **filters)}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 
-@users.post("/scan/")
-def initiate_new_scan_from_s3_link(scan_request: ScanRequest):
+@users.get("/analytics/summary")
+def get_analytics_summary(days: int = 90, user_snapshot=Depends(user_snapshot_dependency),
+                          users_view=Depends(get_users_view.dependency),
+                          user_repository=Depends(get_user_repository.dependency)):
+    """
+    :param days: age (in days) from which a login / password change is considered old.
+    :return: number of users, admins, users that never logged in / are inactive, passwords older than 'days'
+     (all the users, and the admins only).
+    """
+    refresh_user_snapshot(user_snapshot, users_view, user_repository)
+    threshold = time.time() - days * 86400
+    admins = {"admin": "True"}
+    return {"users": user_snapshot.count(),
+            "admins": user_snapshot.count(equals=admins),
+            "never_logged_in": user_snapshot.count(missing=["lastLogin"]),
+            "inactive": user_snapshot.count(before={"lastLogin": threshold}),
+            "old_passwords": user_snapshot.count(before={"passwordChanged": threshold}),
+            "admins_with_old_password": user_snapshot.count(equals=admins, before={"passwordChanged": threshold})}
+
+
+def refresh_user_snapshot(user_snapshot, users_view, user_repository):
+    """
+    bring the snapshot up to date with the users view - a view that is not built is built in the background, the
+    snapshot keeps its last version meanwhile (503 if it has none).
+    """
+    try:
+        if not user_snapshot.refresh(users_view):
+            users_view.start_build(user_repository, SCAN_TOTAL_SEGMENTS)
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"internal server error. details:{e}")
+
+    if user_snapshot.build is None:
+        raise HTTPException(status_code=503, detail="the users view is being built, retry later.",
+                            headers={"Retry-After": "5"})
+
+
+@users.post("/scan/", status_code=202)
+def initiate_new_scan_from_s3_link(scan_request: ScanRequest,
+                                   scan_job_service=Depends(get_scan_job_service.dependency)):
     """
     1. get s3 link to .csv file from client.
-    2. parse the data from file to list[dict].
-    3. upload the data to dynamoDB table.
+    2. queue a background job that streams the rows of the file and uploads them to dynamoDB in bounded batches.
+    3. return the job right away - its progress is available on 'http://localhost/users/scan/{job_id}'.
+
+    the job checkpoints its position in the file after every batch. submitting the same link again resumes
+    a failed or interrupted job from its last checkpoint, and is a no-op while the job is running or after it
+    finished - unless the file changed (new ETag / Last-Modified), then the new version is scanned.
 
     command for testing this function:
     curl -X POST "http://127.0.0.1:8001/users/scan/" -H "Content-Type: application/json" -d
@@ -194,35 +364,54 @@ def initiate_new_scan_from_s3_link(scan_request: ScanRequest):
 
 
     :param scan_request: link to AWS S3 link with .csv file to parse.
-    :return:
+    :return: the job progress (see get_scan_job).
     """
-    # get the s3 link file from client.
-    s3_link = scan_request.s3_link
-    cache_key = f"s3_cache:{s3_link}"
+    try:
+        return scan_job_service.submit(scan_request.s3_link)
 
-    # check if file from s3 exist in redis.
-    cached_data = redis_service.get(cache_key)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"failed to queue the scan job: {str(e)}")
 
-    if cached_data:
-        # if file already in cache -> return message to client.
-        return {"message": "Data already cached, skipping S3 and DB update."}
 
-    else:
-        try:
-            # parse it to list of dictionaries.
-            users_data_list = read_csv_from_s3(s3_link)
+@users.get("/scan/{job_id}")
+def get_scan_job(job_id, scan_job_service=Depends(get_scan_job_service.dependency)):
+    """
+    :return: status of the scan job, rows processed, rows/sec, ETA (seconds) and errors.
+    """
+    progress = scan_job_service.get_progress(job_id)
 
-            # Store parsed data in Redis.
-            redis_service.set(cache_key, json.dumps(users_data_list), ex=6000)
+    if progress is None:
+        raise HTTPException(status_code=404, detail="Scan job not found.")
+    return progress
 
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"An error occurred while processing the CSV file: {str(e)}")
+
+# declared last, so "/admin/..." and "/scan/..." paths are matched by their own routes first.
+@users.get("/{email}/events")
+def get_user_events(email, start: str = None, end: str = None, limit: int = 100, last_evaluated_key: str = None,
+                    user_event_repository=Depends(get_user_event_repository.dependency)):
+    """
+    the audit events of a user, sorted by time, paginated like /results
+    ('http://localhost/users/{email}/events?start=2025-03-01T00:00:00&end=2025-03-31T23:59:59&limit=100').
+
+    :param start: first timestamp of the range (inclusive).
+    :param end: last timestamp of the range (inclusive).
+    :return: dict of {"items": [events], "last_evaluated_key": token of the next page or null}.
+    """
+    from pynamodb.exceptions import QueryError
+    from app.api.utils import encode_page_token, decode_page_token
+
+    if limit <= 0:
+        raise HTTPException(status_code=400, detail="limit must be a positive number.")
 
     try:
-        # update the users data to DB.
-        user_service.update_users_from_csv(users_data_list)
+        start_key = decode_page_token(last_evaluated_key)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"An error occurred while updating users in the database: {str(e)}")
+    try:
+        events, next_key = user_event_repository.get_events(email, start, end, limit=limit,
+                                                            last_evaluated_key=start_key)
+        return {"items": [event.to_event() for event in events], "last_evaluated_key": encode_page_token(next_key)}
 
-    return ".csv results updated successfully in DB."
+    except QueryError as e:
+        raise HTTPException(status_code=500, detail=f"DynamoDB Query Error: {str(e)}")
@@ -1,44 +1,244 @@
 from datetime import datetime, timezone
+import base64
+import json
+from functools import lru_cache
 import requests
 from pynamodb.models import Model
-from io import StringIO
 import csv
+import time
 from typing import Dict, Any
 
+from app.services.metrics import add_bytes, observe, timed
 
-def read_csv_from_s3(s3_url: str):
+
+def get_s3_fingerprint(s3_url: str, timeout: float = 10):
     """
-       read a CSV file from a public S3 URL and return the contents as a list of dictionaries.
+    identify the current version of a public S3 object with a HEAD request, without downloading it.
 
-       :param s3_url: The public S3 URL of the file to read.
-       :return: List of dictionaries representing the CSV rows.
-       """
+    :param s3_url: The public S3 URL of the file.
+    :param timeout: seconds to wait for the response.
+    :return: dict of {"etag", "last_modified", "content_length"} (None values for missing headers), None if the
+     object could not be reached or has neither an ETag nor a Last-Modified header.
+    """
     try:
-        # Fetch the CSV file using the public URL.
-        response = requests.get(s3_url)
+        with timed("s3", "head"):
+            response = requests.head(s3_url, timeout=timeout)
+    except requests.exceptions.RequestException:
+        return None
 
-        # Check if the request was successful
-        if response.status_code != 200:
-            raise Exception(f"Failed to retrieve file: {response.status_code}")
+    if response.status_code != 200:
+        return None
+
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    if not etag and not last_modified:
+        return None
+
+    content_length = response.headers.get("Content-Length")
+    return {"etag": etag, "last_modified": last_modified,
+            "content_length": int(content_length) if content_length else None}
+
+
+def open_csv_stream(s3_url: str, start_offset: int = 0, fieldnames=None, chunk_size: int = 64 * 1024,
+                    if_match: str = None):
+    """
+    read a CSV file from a public S3 URL as a resumable stream (see CsvStream).
+
+    :param s3_url: The public S3 URL of the file to read.
+    :param start_offset: byte offset of the first row to read (CsvStream.offset of a previous stream), the file is
+     requested from there with a Range header.
+    :param fieldnames: the header of the file, required when start_offset > 0 (CsvStream.fieldnames).
+    :param chunk_size: size (bytes) of the chunks read from the response.
+    :param if_match: ETag of the expected version of the file - fail if the object changed since.
+    :return: CsvStream.
+    """
+    headers = {}
+    if start_offset:
+        headers["Range"] = f"bytes={start_offset}-"
+    if if_match:
+        headers["If-Match"] = if_match
+
+    try:
+        with timed("s3", "get_stream"):
+            response = requests.get(s3_url, stream=True, headers=headers or None)
 
-        # Get the CSV content.
-        csv_content = response.text
+        if response.status_code == 412:
+            response.close()
+            raise Exception("the file changed since the scan started")
 
-        # Use StringIO to simulate a file object from the CSV content.
-        file_like_object = StringIO(csv_content)
+        # the offset is at (or after) the end of the file - nothing left to read.
+        if start_offset and response.status_code == 416:
+            response.close()
+            return CsvStream(None, start_offset, fieldnames, chunk_size)
 
-        # Use csv.DictReader to read the CSV as a dictionary
-        reader = csv.DictReader(file_like_object)
-        return [row for row in reader]
+        if response.status_code not in (200, 206):
+            response.close()
+            raise Exception(f"Failed to retrieve file: {response.status_code}")
 
     except requests.exceptions.RequestException as e:
-        # Handle any exceptions raised by the requests library
         raise requests.exceptions.RequestException(f"Error fetching the file from S3: {str(e)}")
 
     except Exception as e:
-        # General error handling for unexpected issues (e.g., CSV parsing errors)
         raise requests.exceptions.RequestException(f"An error occurred while processing the CSV file: {str(e)}")
 
+    return CsvStream(response, start_offset, fieldnames, chunk_size)
+
+
+def download_csv_from_s3(s3_url: str, path: str, chunk_size: int = 1024 * 1024, start_offset: int = 0,
+                         if_match: str = None):
+    """
+    download a file from a public S3 URL to a local file, in chunks (for the parallel parsing of big files, see
+    app.services.csv_ingest).
+
+    :param s3_url: The public S3 URL of the file to download.
+    :param path: local path to write the file to.
+    :param chunk_size: size (bytes) of the chunks read from the response.
+    :param start_offset: only the bytes from this offset on are downloaded (requested with a Range header).
+    :param if_match: ETag of the expected version of the file - fail if the object changed since.
+    :return: number of bytes written to path.
+    """
+    headers = {}
+    if start_offset:
+        headers["Range"] = f"bytes={start_offset}-"
+    if if_match:
+        headers["If-Match"] = if_match
+
+    try:
+        with timed("s3", "download"), requests.get(s3_url, stream=True, headers=headers or None) as response:
+            if response.status_code == 412:
+                raise Exception("the file changed since the scan started")
+
+            # the offset is at (or after) the end of the file - nothing left to download.
+            if start_offset and response.status_code == 416:
+                open(path, "wb").close()
+                return 0
+
+            if response.status_code not in (200, 206):
+                raise Exception(f"Failed to retrieve file: {response.status_code}")
+
+            # the server ignored the Range header - the bytes before the offset are skipped here.
+            skip = start_offset if response.status_code == 200 else 0
+            size = received = 0
+            with open(path, "wb") as f:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    received += len(chunk)
+                    if skip:
+                        skipped = min(skip, len(chunk))
+                        chunk, skip = chunk[skipped:], skip - skipped
+                    f.write(chunk)
+                    size += len(chunk)
+            add_bytes("s3", "in", received)
+            return size
+
+    except requests.exceptions.RequestException as e:
+        raise requests.exceptions.RequestException(f"Error fetching the file from S3: {str(e)}")
+
+    except Exception as e:
+        raise requests.exceptions.RequestException(f"An error occurred while downloading the CSV file: {str(e)}")
+
+
+class CsvStream:
+    """
+    rows of a CSV file streamed from S3, with the byte offset in the file right after the last row read.
+
+    the offset can be saved and passed back to open_csv_stream to continue the file from the next row, without
+    downloading again what was already processed.
+    """
+
+    def __init__(self, response, start_offset=0, fieldnames=None, chunk_size=64 * 1024):
+        """
+        :param response: streamed response of the file (or of the Range from start_offset), None for no rows.
+        """
+        self.response = response
+        self.offset = start_offset
+        self.fieldnames = fieldnames
+        self.chunk_size = chunk_size
+        self.total_bytes = None
+        # seconds spent waiting for the chunks of the response, bytes received.
+        self.download_seconds = 0.0
+        self.bytes_read = 0
+        self._consumed = start_offset
+        self._skip = 0
+
+        if response is not None:
+            self.total_bytes = self._total_bytes(response, start_offset)
+            # the server ignored the Range header - the bytes before the offset are skipped here.
+            if start_offset and response.status_code == 200:
+                self._skip = start_offset
+
+    @staticmethod
+    def _total_bytes(response, start_offset):
+        content_range = response.headers.get("Content-Range", "")
+        if "/" in content_range and not content_range.endswith("*"):
+            return int(content_range.rsplit("/", 1)[1])
+
+        content_length = response.headers.get("Content-Length")
+        if content_length is None:
+            return None
+        return int(content_length) + (start_offset if response.status_code == 206 else 0)
+
+    def __iter__(self):
+        if self.response is None:
+            return
+
+        try:
+            reader = csv.DictReader(self._iter_lines(), fieldnames=self.fieldnames)
+            if reader.fieldnames is None:
+                return
+
+            self.fieldnames = reader.fieldnames
+            self.offset = self._consumed
+
+            for row in reader:
+                # csv.DictReader reads the lines one by one, so the lines consumed so far end with this row.
+                self.offset = self._consumed
+                yield row
+
+        except requests.exceptions.RequestException as e:
+            raise requests.exceptions.RequestException(f"Error fetching the file from S3: {str(e)}")
+
+        except csv.Error as e:
+            raise requests.exceptions.RequestException(f"An error occurred while processing the CSV file: {str(e)}")
+
+        finally:
+            self.response.close()
+            # the parsing runs between the reads - this is the S3 part of the time spent iterating.
+            observe("s3", "read_stream", self.download_seconds)
+            add_bytes("s3", "in", self.bytes_read)
+
+    def _iter_lines(self):
+        """
+        :return: iterator of the decoded lines of the response, counting the bytes of every line consumed.
+        """
+        encoding = self.response.encoding or "utf-8"
+        pending = b""
+        skip = self._skip
+
+        chunks = self.response.iter_content(chunk_size=self.chunk_size)
+        while True:
+            start = time.perf_counter()
+            chunk = next(chunks, None)
+            self.download_seconds += time.perf_counter() - start
+            if chunk is None:
+                break
+            self.bytes_read += len(chunk)
+
+            if skip:
+                skipped = min(skip, len(chunk))
+                chunk, skip = chunk[skipped:], skip - skipped
+
+            pending += chunk
+            lines = pending.split(b"\n")
+            pending = lines.pop()
+
+            for line in lines:
+                self._consumed += len(line) + 1
+                yield line.decode(encoding).rstrip("\r")
+
+        if pending:
+            self._consumed += len(pending)
+            yield pending.decode(encoding).rstrip("\r")
+
 
 def parse_datetime(date):
     """
@@ -60,7 +260,100 @@ def serialize_okta_user(instance: Model) -> Dict[str, Any]:
     if not isinstance(instance, Model):
         raise ValueError("The provided instance is not a valid PynamoDB model.")
 
-    return {attr: getattr(instance, attr) for attr in instance._get_attributes().keys()}
+    return {attr: getattr(instance, attr) for attr, _, _ in _public_attributes(type(instance))}
+
+
+def serialize_raw_item(model_class, item: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    same output as serialize_okta_user, straight from a raw DynamoDB item (attribute map, e.g. {"email": {"S": ...}})
+    - without building the PynamoDB model, for items that are only returned to the client.
+
+    :param model_class: PynamoDB model of the table.
+    :param item: raw item, as returned by the scan/query API.
+    :return: Dictionary representation of the item.
+    """
+    values = {}
+    for attr, attr_name, default in _public_attributes(model_class):
+        value = item.get(attr_name)
+        if value is None:
+            values[attr] = default()
+        else:
+            # most values are strings - read them inline, without a call per value.
+            values[attr] = value["S"] if "S" in value else _raw_value(value)
+    return values
+
+
+@lru_cache(maxsize=None)
+def _public_attributes(model_class):
+    """
+    :return: tuple of (attribute, DynamoDB attribute name, function returning the value of a missing attribute)
+     of the model, without its internal attributes - computed once per model class.
+    """
+    internal_attributes = getattr(model_class, "internal_attributes", ())
+    attributes = []
+
+    for attr, attribute in model_class.get_attributes().items():
+        if attr in internal_attributes:
+            continue
+
+        default = attribute.default
+        if default is None or callable(default):
+            attributes.append((attr, attribute.attr_name, default or _none))
+        else:
+            attributes.append((attr, attribute.attr_name, lambda default=default: default))
+
+    return tuple(attributes)
+
+
+def _none():
+    return None
+
+
+def _raw_value(value):
+    """
+    :return: python value of a raw DynamoDB typed value (e.g. {"S": "abc"}, {"L": [...]}, {"M": {...}}).
+    """
+    if "S" in value:
+        return value["S"]
+    if "L" in value:
+        return [element["S"] if "S" in element else _raw_value(element) for element in value["L"]]
+    if "M" in value:
+        return {key: element["S"] if "S" in element else _raw_value(element) for key, element in value["M"].items()}
+
+    (value_type, data), = value.items()
+    if value_type == "BOOL":
+        return data
+    if value_type == "N":
+        return json.loads(data)
+    if value_type == "NULL":
+        return None
+    if value_type == "NS":
+        return [json.loads(number) for number in data]
+    # SS, B, BS.
+    return data
+
+
+def encode_page_token(last_evaluated_key):
+    """
+    :param last_evaluated_key: DynamoDB last evaluated key (dict) of a page.
+    :return: opaque url safe token for the next page, None if there is no next page.
+    """
+    if not last_evaluated_key:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(last_evaluated_key, separators=(",", ":")).encode()).decode()
+
+
+def decode_page_token(token):
+    """
+    :param token: token returned by encode_page_token.
+    :return: DynamoDB last evaluated key (dict), None for the first page.
+    """
+    if not token:
+        return None
+    try:
+        return json.loads(base64.urlsafe_b64decode(token.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid page token.")
 
 
 class DataProcessor:
@@ -85,27 +378,18 @@ class DataProcessor:
 
         :return: dict of all users with relevant data.
         """
-        users_data = {}
-
-        for user in raw_users_data:
-            user_dict = {}
+        project = DataProcessor.compile_projection(relevant_fields)
+        return {user['id']: project(user) for user in raw_users_data}
 
-            for field in relevant_fields:
-                if field in user:
-                    user_dict[field] = user[field]
-
-                # combine the fields 'name', 'last name' into one field in DB.
-                elif (field == "name" and "profile" in user and "firstName" in user["profile"]
-                      and "lastName" in user["profile"]):
-                    user_dict["name"] = f"{user['profile']['firstName']} {user['profile']['lastName']}"
-
-                # get email field from user['profile']
-                elif field == "email" and "profile" in user and "email" in user["profile"]:
-                    user_dict["email"] = user["profile"]["email"]
-
-            users_data[user['id']] = user_dict
-
-        return users_data
+    @staticmethod
+    def compile_projection(relevant_fields):
+        """
+        :param relevant_fields: field we would like to include in DB.
+        :return: function(raw user) -> dict of the relevant fields of the user. which fields are read as is and
+         which ones may come from the profile is resolved once here (plans are cached per list of fields), so
+         projecting a user is one dict comprehension plus the profile fallbacks.
+        """
+        return _compile_projection(tuple(relevant_fields))
 
     @staticmethod
     def update_admin_field(group_members, users_data):
@@ -121,3 +405,36 @@ class DataProcessor:
                 user_info['admin'] = True
             else:
                 user_info['admin'] = False
+
+
+@lru_cache(maxsize=64)
+def _compile_projection(relevant_fields):
+    # fields read as is from the user, 'name' and 'email' may also come from user['profile'].
+    plain_fields = tuple(field for field in relevant_fields if field not in ("name", "email"))
+    with_name = "name" in relevant_fields
+    with_email = "email" in relevant_fields
+
+    def project(user):
+        user_dict = {field: user[field] for field in plain_fields if field in user}
+
+        if with_name:
+            if "name" in user:
+                user_dict["name"] = user["name"]
+            else:
+                # combine the fields 'name', 'last name' into one field in DB.
+                profile = user.get("profile")
+                if profile and "firstName" in profile and "lastName" in profile:
+                    user_dict["name"] = f"{profile['firstName']} {profile['lastName']}"
+
+        if with_email:
+            if "email" in user:
+                user_dict["email"] = user["email"]
+            else:
+                # get email field from user['profile']
+                profile = user.get("profile")
+                if profile and "email" in profile:
+                    user_dict["email"] = profile["email"]
+
+        return user_dict
+
+    return project
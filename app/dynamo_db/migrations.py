@@ -0,0 +1,157 @@
+"""
+table creation and migration helpers for the DynamoDB tables.
+
+usage:
+    python -m app.dynamo_db.migrations create_tables
+    python -m app.dynamo_db.migrations add_admin_password_index
+    python -m app.dynamo_db.migrations migrate_user_events
+"""
+import logging
+import sys
+import time
+
+from pynamodb.exceptions import UpdateError
+from pynamodb.expressions.condition import size
+
+from app.dynamo_db.models import OktaUser, OktaUserEvent
+
+logger = logging.getLogger(__name__)
+
+
+def create_tables(read_capacity_units=5, write_capacity_units=5, wait=True):
+    """
+    create the tables (with their indexes) if they do not exist yet.
+    """
+    for model in (OktaUser, OktaUserEvent):
+        if not model.exists():
+            model.create_table(read_capacity_units=read_capacity_units,
+                               write_capacity_units=write_capacity_units,
+                               wait=wait)
+            logger.info("table %s created.", model.Meta.table_name)
+
+
+def add_admin_password_index(wait=True, backfill=True):
+    """
+    add admin_password_index to an existing OktaUser table and backfill its keys.
+
+    :param wait: wait until the index is active.
+    :param backfill: write the index keys on the existing admins.
+    """
+    index = OktaUser.admin_password_index
+    client = OktaUser._get_connection().connection.client
+    table = client.describe_table(TableName=OktaUser.Meta.table_name)["Table"]
+    index_names = {gsi["IndexName"] for gsi in table.get("GlobalSecondaryIndexes", [])}
+
+    if index.Meta.index_name not in index_names:
+        schema = index._get_schema()
+        client.update_table(
+            TableName=OktaUser.Meta.table_name,
+            AttributeDefinitions=schema["attribute_definitions"],
+            GlobalSecondaryIndexUpdates=[{
+                "Create": {
+                    "IndexName": schema["index_name"],
+                    "KeySchema": schema["key_schema"],
+                    "Projection": schema["projection"],
+                    "ProvisionedThroughput": {
+                        "ReadCapacityUnits": index.Meta.read_capacity_units,
+                        "WriteCapacityUnits": index.Meta.write_capacity_units,
+                    },
+                }
+            }],
+        )
+        logger.info("index %s created.", index.Meta.index_name)
+
+        if wait:
+            _wait_for_index(client, index.Meta.index_name)
+
+    if backfill:
+        return backfill_admin_password_index()
+
+
+def backfill_admin_password_index():
+    """
+    write the admin_password_index keys on the admins that were saved before the index existed.
+
+    :return: number of updated users.
+    """
+    updated = 0
+
+    with OktaUser.batch_write() as batch:
+        for user in OktaUser.scan(filter_condition=(OktaUser.admin == "True")):
+            if user.passwordChanged and user.adminPasswordChanged != user.passwordChanged:
+                # serialize() sets the index keys.
+                batch.save(user)
+                updated += 1
+
+    logger.info("backfilled admin_password_index keys for %d admins.", updated)
+    return updated
+
+
+def migrate_user_events(clear=True):
+    """
+    copy the events embedded in the user_events list of the user items to the OktaUserEvent table.
+
+    the users are streamed page by page and their events are written in batches as they are read, so the table is
+    never held in memory. the events keys are deterministic - running the migration again does not duplicate them.
+
+    :param clear: empty the user_events list of every migrated user. the list is only cleared if it still has the
+     migrated number of events - a user that got new embedded events meanwhile is left for the next run.
+    :return: dict of {"users": migrated users, "events": copied events, "skipped": users changed meanwhile}.
+    """
+    create_tables()
+    report = {"users": 0, "events": 0, "skipped": 0}
+
+    for user in OktaUser.scan(attributes_to_get=["email", "user_events"]):
+        if not user.user_events:
+            continue
+
+        events = list(user.user_events)
+        with OktaUserEvent.batch_write() as batch:
+            for event in events:
+                batch.save(OktaUserEvent.from_event(user.email, event))
+        report["events"] += len(events)
+
+        if clear:
+            try:
+                # partial update - only the list is removed, the rest of the item is not rewritten.
+                user.update(actions=[OktaUser.user_events.set([])],
+                            condition=(size(OktaUser.user_events) == len(events)))
+            except UpdateError:
+                report["skipped"] += 1
+                continue
+
+        report["users"] += 1
+
+    logger.info("migrated %d events of %d users (%d users changed meanwhile).",
+                report["events"], report["users"], report["skipped"])
+    return report
+
+
+def _wait_for_index(client, index_name, timeout=600):
+    start = time.time()
+
+    while time.time() - start < timeout:
+        table = client.describe_table(TableName=OktaUser.Meta.table_name)["Table"]
+        statuses = {gsi["IndexName"]: gsi["IndexStatus"] for gsi in table.get("GlobalSecondaryIndexes", [])}
+        if statuses.get(index_name) == "ACTIVE":
+            return
+        time.sleep(5)
+
+    raise TimeoutError(f"index {index_name} is not active after {timeout} seconds.")
+
+
+COMMANDS = {
+    "create_tables": create_tables,
+    "add_admin_password_index": add_admin_password_index,
+    "backfill_admin_password_index": backfill_admin_password_index,
+    "migrate_user_events": migrate_user_events,
+}
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    if len(sys.argv) != 2 or sys.argv[1] not in COMMANDS:
+        sys.exit(f"usage: python -m app.dynamo_db.migrations [{'|'.join(COMMANDS)}]")
+
+    COMMANDS[sys.argv[1]]()
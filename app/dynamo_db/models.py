@@ -1,10 +1,72 @@
+import hashlib
+from time import perf_counter
+
+from pynamodb.connection.base import Connection
 from pynamodb.models import Model
 from pynamodb.attributes import UnicodeAttribute, ListAttribute, MapAttribute
+from pynamodb.indexes import GlobalSecondaryIndex, AllProjection
+from app.services.metrics import observe_dynamodb
 from app_config import AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY
-from pydantic import BaseModel
 
 
-class OktaUser(Model):
+class InstrumentedConnection(Connection):
+    """
+        PynamoDB connection recording the latency, the errors and the consumed capacity of every call (see
+        observe_dynamodb and /metrics).
+    """
+
+    def dispatch(self, operation_name, operation_kwargs):
+        start = perf_counter()
+        try:
+            data = super().dispatch(operation_name, operation_kwargs)
+        except Exception as e:
+            observe_dynamodb(operation_name, perf_counter() - start, error=e)
+            raise
+
+        observe_dynamodb(operation_name, perf_counter() - start, data)
+        return data
+
+
+class InstrumentedModel(Model):
+    """
+        base of the models of the app - their table connection dispatches through an InstrumentedConnection, the
+        other users of PynamoDB are left alone.
+    """
+
+    @classmethod
+    def _get_connection(cls):
+        table_connection = super()._get_connection()
+        if not isinstance(table_connection.connection, InstrumentedConnection):
+            meta = cls.Meta
+            connection = InstrumentedConnection(
+                region=meta.region, host=meta.host, connect_timeout_seconds=meta.connect_timeout_seconds,
+                read_timeout_seconds=meta.read_timeout_seconds, max_retry_attempts=meta.max_retry_attempts,
+                max_pool_connections=meta.max_pool_connections, extra_headers=meta.extra_headers,
+                aws_access_key_id=meta.aws_access_key_id, aws_secret_access_key=meta.aws_secret_access_key,
+                aws_session_token=meta.aws_session_token)
+            connection.add_meta_table(table_connection.get_meta_table())
+            table_connection.connection = connection
+        return table_connection
+
+
+class AdminPasswordIndex(GlobalSecondaryIndex):
+    """
+        sparse index of the admins, sorted by the last time they changed their password.
+
+        only admins that changed their password have the index keys (see OktaUser.serialize), so a query on this
+        index reads only them instead of scanning the whole table.
+    """
+    class Meta:
+        index_name = 'admin-password-index'
+        read_capacity_units = 5
+        write_capacity_units = 5
+        projection = AllProjection()
+
+    adminKey = UnicodeAttribute(hash_key=True)
+    adminPasswordChanged = UnicodeAttribute(range_key=True)
+
+
+class OktaUser(InstrumentedModel):
     """
         defines the table structure in dynamodb.
     """
@@ -23,6 +85,69 @@ class OktaUser(Model):
     id = UnicodeAttribute()
     user_events = ListAttribute(of=MapAttribute, default=list)
 
+    # keys of admin_password_index, derived from admin & passwordChanged on every write.
+    adminKey = UnicodeAttribute(null=True)
+    adminPasswordChanged = UnicodeAttribute(null=True)
+    admin_password_index = AdminPasswordIndex()
+
+    # storage only attributes, not part of the user details returned to clients.
+    internal_attributes = frozenset({"adminKey", "adminPasswordChanged"})
+
+    ADMIN_INDEX_KEY = "True"
+
+    def serialize(self, null_check=True):
+        self.update_admin_password_index_keys()
+        return super().serialize(null_check=null_check)
+
+    def update_admin_password_index_keys(self):
+        """
+        set the admin_password_index keys only for admins with a password change, so the index stays sparse
+        (DynamoDB also rejects empty strings in index keys).
+        """
+        if self.admin == "True" and self.passwordChanged:
+            self.adminKey = self.ADMIN_INDEX_KEY
+            self.adminPasswordChanged = self.passwordChanged
+        else:
+            self.adminKey = None
+            self.adminPasswordChanged = None
+
+
+class OktaUserEvent(InstrumentedModel):
+    """
+        append-only table of the audit events of the users (the events that are not folded into the user item).
+
+        keyed by email and event key - the event timestamp followed by a short digest of the description, so
+        several events of a user in the same second are kept, and writing the same event again is a no-op.
+    """
+    class Meta:
+        table_name = 'OKta_User_Events'
+        region = 'eu-north-1'
+        aws_access_key_id = AWS_ACCESS_KEY_ID
+        aws_secret_access_key = AWS_SECRET_ACCESS_KEY
+
+    email = UnicodeAttribute(hash_key=True)
+    eventKey = UnicodeAttribute(range_key=True)
+    timestamp = UnicodeAttribute()
+    eventDescription = UnicodeAttribute()
+
+    @classmethod
+    def from_event(cls, email, event):
+        """
+        :param email: email of the user.
+        :param event: event in the user_events format - {'Timestamp': ..., 'Event Description': ...}.
+        :return: OktaUserEvent instance.
+        """
+        timestamp, description = event["Timestamp"], event["Event Description"]
+        return cls(email=email, eventKey=cls.event_key(timestamp, description), timestamp=timestamp,
+                   eventDescription=description)
+
+    @staticmethod
+    def event_key(timestamp, description):
+        digest = hashlib.sha1(description.encode()).hexdigest()[:8]
+        return f"{timestamp}#{digest}"
 
-class ScanRequest(BaseModel):
-    s3_link: str
+    def to_event(self):
+        """
+        :return: the event in the user_events format - {'Timestamp': ..., 'Event Description': ...}.
+        """
+        return {"Timestamp": self.timestamp, "Event Description": self.eventDescription}
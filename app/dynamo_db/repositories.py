@@ -1,4 +1,23 @@
-from pynamodb.exceptions import ScanError
+import asyncio
+import contextvars
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+from pynamodb.constants import ALL_OLD, ATTRIBUTES
+from pynamodb.exceptions import ScanError, PutError, QueryError, UpdateError
+from pynamodb.pagination import ResultIterator
+
+from app.api.utils import serialize_okta_user, serialize_raw_item
+from app.services.write_scheduler import WriteScheduler
+
+logger = logging.getLogger(__name__)
+
+# {email: user} written in the current batch (see UserRepository.batch_writes), None outside of one.
+_written_users = contextvars.ContextVar("written_users", default=None)
 
 
 class UserRepository:
@@ -20,8 +39,21 @@ class UserRepository:
      without affecting the rest of the application.
     """
 
-    def __init__(self, okta_user_model):
+    # results of update_user.
+    CREATED = "created"
+    UPDATED = "updated"
+    UNCHANGED = "unchanged"
+
+    def __init__(self, okta_user_model, on_users_written=None, users_view=None):
+        """
+        :param okta_user_model: the OktaUser model.
+        :param on_users_written: optional callback called with the list of emails of the users written to DB
+         (e.g. to invalidate their cached details).
+        :param users_view: optional UsersView updated with the written users (see app.services.users_view).
+        """
         self.okta_user_model = okta_user_model
+        self.on_users_written = on_users_written
+        self.users_view = users_view
 
     def get_user_by_email(self, email):
         """
@@ -35,17 +67,111 @@ class UserRepository:
         except self.okta_user_model.DoesNotExist:
             return None
 
-    def scan_table(self):
+    def get_users_by_email(self, emails, consistent_read=False):
+        """
+        :param emails: emails of the users (BatchGetItem, 100 users per call).
+        :param consistent_read: read the latest writes (twice the read capacity).
+        :return: list of the users that exist, in no particular order.
+        """
+        return list(self.okta_user_model.batch_get(emails, consistent_read=consistent_read))
+
+    def scan_table(self, total_segments=1, raw=False):
         """
+        :param total_segments: number of segments scanned in parallel (DynamoDB parallel scan).
+        :param raw: if True, return the raw DynamoDB items (attribute maps) instead of OktaUser models - cheaper
+         when the users are only serialized for the client (see app.api.utils.serialize_raw_item).
         :return: return list if all users in Users table, in case of error - raise ScanError.
         """
+        return list(self.iter_scan(total_segments, raw=raw))
+
+    def iter_scan(self, total_segments=1, max_buffered_items=1000, raw=False):
+        """
+        iterate over all the users in the table, page by page, without holding the whole table in memory.
+
+        with total_segments > 1 the table is split into segments that are scanned in parallel by a thread pool,
+        the users are yielded as soon as any segment returns them (so the order is not deterministic).
+
+        :param total_segments: number of segments scanned in parallel.
+        :param max_buffered_items: max number of users the scanning threads read ahead of the consumer.
+        :param raw: see scan_table.
+        :return: iterator of users, in case of error - raise ScanError.
+        """
+        try:
+            if total_segments <= 1:
+                yield from self._scan(raw)
+            else:
+                yield from self._parallel_scan(total_segments, max_buffered_items, raw)
+
+        except ScanError as e:
+            raise ScanError(f"An error occurred during the scan operation: {str(e)}")
+
+    def scan_page(self, limit, last_evaluated_key=None, raw=False):
+        """
+        :param limit: max number of users to return.
+        :param last_evaluated_key: key returned by the previous page (None for the first page).
+        :param raw: see scan_table.
+        :return: tuple of (users, last_evaluated_key) - last_evaluated_key is None on the last page.
+        """
         try:
-            res = list(self.okta_user_model.scan())
-            return res
+            result = self._scan(raw, limit=limit, last_evaluated_key=last_evaluated_key)
+            users = list(result)
+            return users, result.last_evaluated_key
 
         except ScanError as e:
             raise ScanError(f"An error occurred during the scan operation: {str(e)}")
 
+    def _scan(self, raw=False, segment=None, total_segments=None, limit=None, last_evaluated_key=None):
+        if not raw:
+            return self.okta_user_model.scan(segment=segment, total_segments=total_segments, limit=limit,
+                                             last_evaluated_key=last_evaluated_key)
+
+        # same pagination as Model.scan, without building a model per item.
+        scan_kwargs = dict(exclusive_start_key=last_evaluated_key, segment=segment, total_segments=total_segments,
+                           limit=limit)
+        return ResultIterator(self.okta_user_model._get_connection().scan, (), scan_kwargs, limit=limit)
+
+    def _parallel_scan(self, total_segments, max_buffered_items, raw=False):
+        items = queue.Queue(maxsize=max_buffered_items)
+        stopped = threading.Event()
+        done = object()
+
+        def put(item):
+            # give up if the consumer stopped iterating, instead of blocking forever on a full queue.
+            while not stopped.is_set():
+                try:
+                    items.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def scan_segment(segment):
+            try:
+                for user in self._scan(raw, segment=segment, total_segments=total_segments):
+                    if stopped.is_set():
+                        return
+                    put(user)
+            except Exception as e:
+                put(e)
+            finally:
+                put(done)
+
+        with ThreadPoolExecutor(max_workers=total_segments) as executor:
+            for segment in range(total_segments):
+                executor.submit(scan_segment, segment)
+
+            try:
+                remaining_segments = total_segments
+                while remaining_segments:
+                    item = items.get()
+                    if item is done:
+                        remaining_segments -= 1
+                    elif isinstance(item, Exception):
+                        raise item
+                    else:
+                        yield item
+            finally:
+                stopped.set()
+
     def get_admins_list(self):
         """
         :return: return list of all admins in organization.
@@ -60,42 +186,360 @@ class UserRepository:
         else:
             return admins
 
-    def upload_user_data_to_db(self, users):
+    def get_admins_with_old_password(self, days=7):
+        """
+        :param days: password age (in days) from which an admin password is considered old.
+        :return: list of admins whose password was last changed more than `days` days ago.
+        """
+        threshold = (datetime.now(timezone.utc) - timedelta(days=days)).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+        index = self.okta_user_model.admin_password_index
+
+        try:
+            # single Query on the sparse admins index - the timestamps are ISO 8601 so they compare as strings.
+            return list(index.query(self.okta_user_model.ADMIN_INDEX_KEY,
+                                    range_key_condition=self.okta_user_model.adminPasswordChanged < threshold))
+
+        except QueryError as e:
+            raise QueryError(f"An error occurred during the query operation: {str(e)}")
+
+    def upload_user_data_to_db(self, users, max_retries=5, backoff_base=0.05, max_workers=8,
+                               writes_per_second=None):
         """
         upload users to dynamodb table -> if they exist -> update to recent values.
-        :param users:
-        :return:
+
+        every user is written with one partial UpdateItem (see update_user), without reading it first: the Okta
+        timestamps are only written if they are newer than the stored ones, and name / admin / id are only set on
+        new users. the updates run on concurrent writers (see WriteScheduler), throttled updates are retried with
+        exponential backoff.
+
+        :param users: dict of {okta user id: user data} as returned by DataProcessor.extract_data.
+        :param max_retries: how many times to retry a throttled update before giving up.
+        :param backoff_base: base delay (seconds) of the exponential backoff between retries.
+        :param max_workers: number of concurrent writers.
+        :param writes_per_second: total write rate of the writers (None for no limit).
+        :return: report of the upload - {"created": [emails], "updated": [emails], "failed": {email: reason}}.
         """
+        report = {"created": [], "updated": [], "failed": {}}
+
+        # skip users without email (partition key in dynamoDB table).
+        valid_users = {}
         for user_id, user_data in users.items():
+            email = user_data.get("email")
+            if not email:
+                report["failed"][user_id] = "missing email"
+                continue
+            valid_users[email] = (user_id, user_data)
+
+        def upload(email, user_id, user_data):
+            latest = {field: user_data.get(field) for field in ("lastLogin", "passwordChanged", "statusChanged")}
+            # fields Okta did not send are only initialized on new users.
+            defaults = {field: "" for field, value in latest.items() if not value}
+            defaults.update(admin=str(user_data.get("admin", False)), name=user_data.get("name") or "", id=user_id)
+
+            return self._update_user(email, latest=latest, defaults=defaults)
+
+        with self.batch_writes(), WriteScheduler(workers=max_workers, writes_per_second=writes_per_second,
+                                                 max_retries=max_retries, backoff_base=backoff_base) as scheduler:
+            for email, (user_id, user_data) in valid_users.items():
+                scheduler.submit(email, upload, email, user_id, user_data)
+
+        for email in valid_users:
+            if email in scheduler.failures:
+                report["failed"][email] = str(scheduler.failures[email])
+            else:
+                report["created" if scheduler.results[email] == self.CREATED else "updated"].append(email)
+
+        if report["failed"]:
+            logger.warning("failed to upload %d users to DB.", len(report["failed"]))
+
+        return report
+
+    def update_user(self, email, fields=None, latest=None, defaults=None, new_events=None, must_exist=False):
+        """
+        partial update of one user with a single UpdateItem - only the given attributes are written, the user is
+        not read first, and concurrent writers of other attributes (or newer timestamps) are never overwritten.
+
+        :param email: email of the user.
+        :param fields: dict of {attribute: value} always written.
+        :param latest: dict of {attribute: ISO timestamp} only written if newer than the stored value (empty
+         values are ignored), so the timestamps never go back.
+        :param defaults: dict of {attribute: value} only written if the user does not have the attribute yet.
+        :param new_events: list of events appended to user_events.
+        :param must_exist: only update an existing user, never create one.
+        :return: 'created', 'updated', 'unchanged' (nothing newer to write) or None if must_exist and the user
+         does not exist.
+        """
+        return self._update_user(email, fields, latest, defaults, new_events, must_exist)
+
+    def _update_user(self, email, fields=None, latest=None, defaults=None, new_events=None, must_exist=False,
+                     max_attempts=3):
+        model = self.okta_user_model
+        latest = {name: value for name, value in (latest or {}).items() if value}
+        exists = False
+
+        for _ in range(max_attempts):
+            actions = [getattr(model, name).set(value) for name, value in (fields or {}).items()]
+            actions += [getattr(model, name).set(value) for name, value in latest.items()]
+            actions += [getattr(model, name).set(getattr(model, name) | value)
+                        for name, value in (defaults or {}).items()]
+            if new_events:
+                actions.append(model.user_events.set((model.user_events | []).append(new_events)))
+
+            if not actions:
+                if must_exist and not exists and self.get_user_by_email(email) is None:
+                    return None
+                return self.UNCHANGED
+
+            condition = None
+            for name, value in latest.items():
+                attribute = getattr(model, name)
+                condition &= attribute.does_not_exist() | (attribute < value)
+            if must_exist:
+                condition &= model.email.exists()
+
             try:
-                email = user_data["email"]
+                response = model._get_connection().update_item(email, actions=actions, condition=condition,
+                                                               return_values=ALL_OLD)
+            except UpdateError as e:
+                if e.cause_response_code != "ConditionalCheckFailedException":
+                    raise
 
-                # Check if the user already exists in the DB
-                existing_user = self.okta_user_model.get(email, consistent_read=True)
+                # some stored timestamps are already newer (or the user does not exist) - keep only the newer ones.
+                user = self.get_user_by_email(email)
+                if user is None:
+                    return None
+                exists = True
+                latest = {name: value for name, value in latest.items()
+                          if not getattr(user, name) or getattr(user, name) < value}
+                continue
 
-                # if user exists, update relevant fields
-                existing_user.lastLogin = user_data.get("lastLogin", existing_user.lastLogin) or ""
-                existing_user.passwordChanged = user_data.get("passwordChanged", existing_user.passwordChanged) or ""
-                existing_user.statusChanged = user_data.get("statusChanged", existing_user.statusChanged) or ""
+            old_item = response.get(ATTRIBUTES)
+            self._update_admin_password_index_keys(email, old_item, fields, latest, defaults)
+            self._users_written({email: self._written_user(email, old_item, fields, latest, defaults, new_events)
+                                 if self.users_view is not None else None})
+            return self.UPDATED if old_item else self.CREATED
 
-                existing_user.save()
+        raise UpdateError(f"Failed to update {email}: the user kept changing concurrently.")
 
-            except self.okta_user_model.DoesNotExist:
-                try:
-                    # Create a new user if not found
-                    new_user = self.okta_user_model(
-                        email=email,
-                        admin=str(user_data.get("admin", False)),
-                        lastLogin=user_data.get("lastLogin") or "",
-                        name=user_data.get("name") or "",
-                        passwordChanged=user_data.get("passwordChanged") or "",
-                        statusChanged=user_data.get("statusChanged") or "",
-                        id=user_id
-                    )
-                    new_user.save()
-
-                except Exception as e:
-                    print(e)
+    def _written_user(self, email, old_item, fields, latest, defaults, new_events):
+        """
+        :return: the user after a successful update (as serialize_raw_item returns it) - computed from the item
+         before the update, returned by the UpdateItem, and the written values, without reading it back.
+        """
+        model = self.okta_user_model
+        user = serialize_raw_item(model, old_item or {})
+        user["email"] = email
+        user.update(fields or {})
+        # all newer than the stored ones - the update was conditioned on it.
+        user.update(latest)
+        for name, value in (defaults or {}).items():
+            if getattr(model, name).attr_name not in (old_item or {}):
+                user[name] = value
+        if new_events:
+            user["user_events"] = (user.get("user_events") or []) + list(new_events)
+        return user
+
+    def _update_admin_password_index_keys(self, email, old_item, fields, latest, defaults):
+        """
+        the admin_password_index keys are derived from admin & passwordChanged (see OktaUser.serialize), which an
+        UpdateItem does not run - set them in a second, rare, update when the written values changed them.
+        """
+        model = self.okta_user_model
+        old = model.from_raw_data(old_item) if old_item else model()
+        user = model()
+
+        for name in ("admin", "passwordChanged"):
+            value = (fields or {}).get(name, latest.get(name))
+            if value is None:
+                value = getattr(old, name)
+            if value is None:
+                value = (defaults or {}).get(name)
+            setattr(user, name, value)
 
+        user.update_admin_password_index_keys()
+        if user.adminKey == old.adminKey and user.adminPasswordChanged == old.adminPasswordChanged:
+            return
+
+        actions = [model.adminKey.set(user.adminKey), model.adminPasswordChanged.set(user.adminPasswordChanged)]
+        # a concurrent writer of admin / passwordChanged sets the keys itself.
+        condition = self._has_value(model.admin, user.admin) & self._has_value(model.passwordChanged,
+                                                                               user.passwordChanged)
+        try:
+            model._get_connection().update_item(email, actions=actions, condition=condition)
+        except UpdateError as e:
+            if e.cause_response_code != "ConditionalCheckFailedException":
+                raise
+
+    @staticmethod
+    def _has_value(attribute, value):
+        return attribute.does_not_exist() if value is None else attribute == value
+
+    def save_user(self, user):
+        """
+        save the given user (all its attributes) to DB.
+
+        :param user: OktaUser instance.
+        """
+        user.save()
+        self._users_written({user.email: serialize_okta_user(user) if self.users_view is not None else None})
+
+    @contextmanager
+    def batch_writes(self):
+        """
+        the users written in the block - in this thread and in the WriteScheduler writers it submits to - are
+        notified together when it exits: one cache invalidation and one view update for the whole batch.
+        """
+        written_users = {}
+        token = _written_users.set(written_users)
+        try:
+            yield
+        finally:
+            _written_users.reset(token)
+            self._users_written(written_users)
+
+    def _users_written(self, users):
+        """
+        :param users: dict of {email: user after the write (None without users_view)}.
+        """
+        if not users:
+            return
+
+        written_users = _written_users.get()
+        if written_users is not None:
+            # the writers of a batch run on several threads - a dict update is atomic.
+            written_users.update(users)
+            return
+
+        # the write itself succeeded - a failing listener must not fail it.
+        if self.on_users_written is not None:
+            try:
+                self.on_users_written(list(users))
+            except Exception as e:
+                logger.warning("on_users_written callback failed: %s", e)
+
+        if self.users_view is not None:
+            try:
+                self.users_view.apply(users)
             except Exception as e:
-                print(f"Error processing user {email}: {str(e)}")
+                # the view is fixed by its next reconciliation (see UsersView.reconcile).
+                logger.warning("failed to update the users view: %s", e)
+
+
+class UserEventRepository:
+    """
+    access to the append-only events table of the users (OktaUserEvent).
+
+    the events are written with BatchWriteItem and read back with a Query on the user partition, so reading or
+    adding events never touches the user item.
+    """
+
+    # sorts after the '#<digest>' suffix of every event key with the same timestamp.
+    KEY_UPPER_BOUND_SUFFIX = "#~"
+
+    def __init__(self, okta_user_event_model):
+        """
+        :param okta_user_event_model: the OktaUserEvent model.
+        """
+        self.okta_user_event_model = okta_user_event_model
+
+    def add_events(self, events):
+        """
+        write the given events in batches (chunks of 25, unprocessed items are retried by PynamoDB).
+
+        :param events: iterable of (email, event) tuples - event in the user_events format
+         ({'Timestamp': ..., 'Event Description': ...}).
+        :return: number of written events.
+        """
+        written = 0
+
+        try:
+            with self.okta_user_event_model.batch_write() as batch:
+                for email, event in events:
+                    batch.save(self.okta_user_event_model.from_event(email, event))
+                    written += 1
+
+        except PutError as e:
+            raise PutError(f"An error occurred during the batch write operation: {str(e)}")
+
+        return written
+
+    def get_events(self, email, start=None, end=None, limit=None, last_evaluated_key=None, newest_first=False):
+        """
+        :param email: email of the user.
+        :param start: first timestamp of the range, inclusive (e.g. '2025-03-01T00:00:00'), None for no lower bound.
+        :param end: last timestamp of the range, inclusive, None for no upper bound.
+        :param limit: max number of events to return (None for all of them).
+        :param last_evaluated_key: key returned by the previous page (None for the first page).
+        :param newest_first: return the latest events first.
+        :return: tuple of (events, last_evaluated_key) - list of OktaUserEvent, sorted by timestamp.
+         last_evaluated_key is None on the last page.
+        """
+        try:
+            result = self.okta_user_event_model.query(email, range_key_condition=self._time_range(start, end),
+                                                      limit=limit, last_evaluated_key=last_evaluated_key,
+                                                      scan_index_forward=not newest_first)
+            events = list(result)
+            return events, result.last_evaluated_key
+
+        except QueryError as e:
+            raise QueryError(f"An error occurred during the query operation: {str(e)}")
+
+    def iter_events(self, email, start=None, end=None):
+        """
+        :return: iterator of all the events of the user in the time range (see get_events), page by page.
+        """
+        try:
+            yield from self.okta_user_event_model.query(email, range_key_condition=self._time_range(start, end))
+
+        except QueryError as e:
+            raise QueryError(f"An error occurred during the query operation: {str(e)}")
+
+    def _time_range(self, start, end):
+        event_key = self.okta_user_event_model.eventKey
+
+        if start and end:
+            return event_key.between(start, end + self.KEY_UPPER_BOUND_SUFFIX)
+        if start:
+            return event_key >= start
+        if end:
+            return event_key <= end + self.KEY_UPPER_BOUND_SUFFIX
+        return None
+
+
+class AsyncUserRepository:
+    """
+    awaitable facade of UserRepository for the async request handlers.
+
+    PynamoDB (botocore) is blocking, so the calls run on a dedicated thread pool - sized for the DynamoDB
+    concurrency we want - instead of the small default thread pool shared by all the sync handlers.
+    """
+
+    def __init__(self, user_repository, max_workers=64):
+        self.user_repository = user_repository
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="dynamodb")
+
+    async def _run(self, func, *args):
+        # with the context of the request, so its DynamoDB calls are counted in its timings.
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(self.executor, context.run, func, *args)
+
+    async def get_user_by_email(self, email):
+        return await self._run(self.user_repository.get_user_by_email, email)
+
+    async def scan_table(self, total_segments=1, raw=False):
+        return await self._run(self.user_repository.scan_table, total_segments, raw)
+
+    async def scan_page(self, limit, last_evaluated_key=None, raw=False):
+        return await self._run(self.user_repository.scan_page, limit, last_evaluated_key, raw)
+
+    async def get_admins_with_old_password(self, days=7):
+        return await self._run(self.user_repository.get_admins_with_old_password, days)
+
+    async def upload_user_data_to_db(self, users):
+        return await self._run(self.user_repository.upload_user_data_to_db, users)
+
+    async def save_user(self, user):
+        return await self._run(self.user_repository.save_user, user)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
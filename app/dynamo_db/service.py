@@ -1,4 +1,10 @@
-from datetime import datetime, timezone
+import logging
+from itertools import islice
+
+from app.services.timestamps import MAX_EPOCH, MIN_EPOCH, epoch_to_iso, epochs_to_iso
+from app.services.write_scheduler import WriteScheduler
+
+logger = logging.getLogger(__name__)
 
 
 class UserService:
@@ -19,20 +25,103 @@ class UserService:
       and retrieval operations.
       """
 
-    def __init__(self, user_repository):
+    def __init__(self, user_repository, event_repository=None, writers=1, writes_per_second=None):
+        """
+        :param user_repository: UserRepository instance.
+        :param event_repository: optional UserEventRepository instance - if given, the other events are appended
+         to the events table instead of the user_events list of the user item.
+        :param writers: number of concurrent DynamoDB writers the users are sharded to (see WriteScheduler).
+        :param writes_per_second: total write rate of the writers, matched to the table capacity (None for no
+         limit - the writers still back off when throttled).
+        """
         self.user_repository = user_repository
+        self.event_repository = event_repository
+        self.writers = writers
+        self.writes_per_second = writes_per_second
+        # stats of the writes of the last batch (see WriteScheduler.stats).
+        self.last_write_stats = None
 
-    def update_users_from_csv(self, users_data):
+    def update_users_from_csv(self, users_data, batch_size=None):
         """
         get users_data and update the relevant users in DB.
         - if user get admin role -> changed the field in DB to True.
         - if user login in system -> update the lasLogin field in db.
         - if password changed -> update the passwordChanged field in db.
 
-        :param users_data:list[dict] data from s3 link we received from client.
+        the events are first folded per email (see fold_events), then every distinct user is written once
+        with a partial update (see UserRepository.update_user) - no read before the write, and the timestamps
+        only move forward, so concurrent ingestions of overlapping files cannot overwrite newer values.
+
+        :param users_data:list[dict] data from s3 link we received from client (or a lazy iterator of rows).
+        :param batch_size: if given, the rows are consumed in batches of this size, so memory stays bounded
+         when users_data is a stream (each user is then written once per batch).
 
         :return: message of successful update.
         """
+        if batch_size is None:
+            self.apply_folded_events(self.fold_events(users_data))
+        else:
+            rows = iter(users_data)
+            while True:
+                batch = list(islice(rows, batch_size))
+                if not batch:
+                    break
+                self.apply_folded_events(self.fold_events(batch))
+
+        return "users details changes successfully in DB."
+
+    def apply_folded_events(self, folded_events):
+        """
+        write the folded events of a batch of rows (see fold_events, app.services.csv_ingest.merge_folded_events).
+
+        :param folded_events: dict of {email: folded events}.
+        """
+        # the users are written concurrently, sharded by email, and notified together (see batch_writes).
+        with self.user_repository.batch_writes(), \
+                WriteScheduler(workers=self.writers, writes_per_second=self.writes_per_second) as scheduler:
+            for email, user_events in folded_events.items():
+                scheduler.submit(email, self._apply_user_events, email, user_events)
+
+        self.last_write_stats = scheduler.stats()
+        logger.info("wrote %(writes)d users in %(seconds)ss (%(writes_per_sec)s writes/sec, %(throttles)d "
+                    "throttled, %(failed)d failed).", self.last_write_stats)
+
+        if scheduler.failures:
+            # fail the batch, so it is applied again (the updates are idempotent).
+            raise next(iter(scheduler.failures.values()))
+
+        if self.event_repository is not None:
+            # other events of the existing users, written together to the events table.
+            new_events = [(email, event) for email, res in scheduler.results.items() if res is not None
+                          for event in folded_events[email]["user_events"]]
+            if new_events:
+                self.event_repository.add_events(new_events)
+
+    def _apply_user_events(self, email, user_events):
+        # only the existing users are updated.
+        return self.user_repository.update_user(
+            email,
+            fields={"admin": "True"} if user_events["admin"] else None,
+            latest=self.latest_timestamps(user_events),
+            new_events=user_events["user_events"] if self.event_repository is None else None,
+            must_exist=True)
+
+    @staticmethod
+    def fold_events(users_data):
+        """
+        reduce all the csv rows into one summary per email, in one pass over the rows.
+
+        for every user we keep the latest login timestamp, the latest password change timestamp,
+        whether admin role was granted and the list of the other events (in the order of the rows).
+
+        :param users_data: list[dict] (or any iterable of rows) data from s3 link.
+        :return: dict of {email: folded events}.
+        """
+        folded_events = {}
+        # kind of every distinct event description, so the substrings are matched once per description.
+        event_kinds = {}
+        # the other events, their timestamps are formatted together at the end.
+        other_events = []
 
         for user in users_data:
             email = user.get("User Email")
@@ -44,40 +133,62 @@ class UserService:
                 continue
 
             try:
-                formatted_timestamp = datetime.fromtimestamp(int(timestamp), tz=timezone.utc).isoformat() + "Z"
-
+                epoch = int(timestamp)
             except ValueError:
                 continue
 
-            # Fetch user from DB.
-            try:
-                res = self.user_repository.get_user_by_email(email)
-            except self.user_repository.DoesNotExist:
+            # skip the timestamps datetime cannot represent.
+            if not MIN_EPOCH <= epoch <= MAX_EPOCH:
                 continue
 
-            if res:
-                # update lastLogin field.
-                if "Login" in event_description:
-                    res.lastLogin = formatted_timestamp
+            user_events = folded_events.get(email)
+            if user_events is None:
+                user_events = folded_events[email] = {
+                    "lastLogin": None,
+                    "passwordChanged": None,
+                    "admin": False,
+                    "user_events": []
+                }
 
-                # update passwordChanged field
-                elif "Password" in event_description:
-                    res.passwordChanged = formatted_timestamp
+            kind = event_kinds.get(event_description)
+            if kind is None:
+                kind = event_kinds[event_description] = UserService.event_kind(event_description)
 
-                # update admin field if "Admin Role Granted" event occurs
-                elif event_description == "Admin Role Granted":
-                    res.admin = "True"
+            if kind == "lastLogin" or kind == "passwordChanged":
+                if user_events[kind] is None or epoch >= user_events[kind]:
+                    user_events[kind] = epoch
 
-                else:
-                    # for other events -> change in user_events field
-                    if not res.user_events:
-                        res.user_events = []
-                    res.user_events.append({
-                        'Timestamp': datetime.utcfromtimestamp(int(timestamp)).isoformat(),
-                        'Event Description': event_description
-                    })
+            elif kind == "admin":
+                user_events["admin"] = True
 
-                # save changes.
-                res.save()
+            else:
+                event = {'Timestamp': epoch, 'Event Description': event_description}
+                user_events["user_events"].append(event)
+                other_events.append(event)
 
-        return "users details changes successfully in DB."
+        for event, timestamp in zip(other_events, epochs_to_iso([event['Timestamp'] for event in other_events])):
+            event['Timestamp'] = timestamp
+
+        return folded_events
+
+    @staticmethod
+    def event_kind(event_description):
+        """
+        :return: 'lastLogin', 'passwordChanged', 'admin' or 'other' - how an event is folded.
+        """
+        if "Login" in event_description:
+            return "lastLogin"
+        if "Password" in event_description:
+            return "passwordChanged"
+        if event_description == "Admin Role Granted":
+            return "admin"
+        return "other"
+
+    @staticmethod
+    def latest_timestamps(user_events):
+        """
+        :param user_events: folded events of one user (see fold_events).
+        :return: dict of {'lastLogin' / 'passwordChanged': ISO timestamp} of the folded timestamps.
+        """
+        return {field: epoch_to_iso(user_events[field], utc=True) for field in ("lastLogin", "passwordChanged")
+                if user_events[field] is not None}
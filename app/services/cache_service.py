@@ -0,0 +1,361 @@
+import asyncio
+import logging
+import math
+import random
+import threading
+import time
+import uuid
+
+import redis
+
+from app.services.metrics import cache_lookup
+
+logger = logging.getLogger(__name__)
+
+
+class CacheTimeout(Exception):
+    """
+    the value is missing and another worker is still computing it after wait_timeout seconds.
+    """
+
+
+class CacheService:
+    """
+    The CacheService class implements cache-aside on top of RedisService, protected against cache stampedes.
+
+    - single flight: when a value has to be recomputed, only the worker holding the recompute lock
+      (SET NX with a random token) calls the backend, the others wait for its result. the lock is extended while
+      the backend runs, so a slow backend is never called twice at once - a waiter that gives up raises
+      CacheTimeout instead of calling it.
+    - stale-while-revalidate: values are kept in Redis `stale_ttl` seconds after they expire. during that time the
+      stale value is served immediately while one worker refreshes it in the background.
+    - probabilistic early refresh (XFetch): shortly before the expiry, a request may refresh the value early,
+      with a probability that grows as the expiry gets closer and with the time the last recompute took.
+    """
+    LOCK_PREFIX = "lock:"
+
+    def __init__(self, redis_service, lock_timeout=30, wait_timeout=10, poll_interval=0.05, beta=1.0):
+        """
+        :param redis_service: RedisService used to store the values and the locks.
+        :param lock_timeout: seconds after which a recompute lock expires if its holder died - it is extended
+         every lock_timeout / 3 seconds while the holder computes.
+        :param wait_timeout: default max seconds a request waits for another worker to compute a missing value.
+        :param poll_interval: seconds between two checks while waiting for another worker.
+        :param beta: early refresh factor, > 1 favors earlier refreshes, 0 disables them.
+        """
+        self.redis_service = redis_service
+        self.lock_timeout = lock_timeout
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.beta = beta
+
+    def get_or_compute(self, key, compute, ttl, stale_ttl=None, wait_timeout=None):
+        """
+        :param key: cache key.
+        :param compute: function that computes the value from the backend (called without arguments).
+        :param ttl: seconds the value is fresh.
+        :param stale_ttl: seconds the value may be served stale after it expired (default: ttl).
+        :param wait_timeout: overrides the max seconds to wait for another worker computing the value - size it
+         to the time the backend takes.
+        :return: the cached or computed value.
+        :raise CacheTimeout: if the value is still being computed by another worker after wait_timeout seconds.
+        """
+        stale_ttl = ttl if stale_ttl is None else stale_ttl
+        wait_timeout = self.wait_timeout if wait_timeout is None else wait_timeout
+        entry = self._get_entry(key)
+
+        if entry is not None:
+            if not self._should_refresh(entry):
+                cache_lookup("cache_service", "hit")
+                return entry["value"]
+            cache_lookup("cache_service", "stale")
+
+            # expired (or early refresh) - one worker refreshes in the background, everybody gets the last value.
+            token = self._acquire_lock(key)
+            if token is not None and self._refreshed_meanwhile(key, entry, token):
+                token = None
+            if token is not None:
+                threading.Thread(target=self._refresh_in_background, args=(key, compute, ttl, stale_ttl, token),
+                                 daemon=True).start()
+            return entry["value"]
+
+        # nothing to serve - one worker computes, the others wait for its result.
+        cache_lookup("cache_service", "miss")
+        deadline = time.monotonic() + wait_timeout
+        while True:
+            token = self._acquire_lock(key)
+            if token is not None:
+                # the previous lock holder may have stored the value just before we got the lock.
+                entry = self._get_entry(key)
+                if entry is not None:
+                    self._release_lock(key, token)
+                    return entry["value"]
+                return self._refresh(key, compute, ttl, stale_ttl, token)
+
+            time.sleep(self.poll_interval)
+            entry = self._get_entry(key)
+            if entry is not None:
+                return entry["value"]
+
+            if time.monotonic() >= deadline:
+                raise CacheTimeout(f"timeout waiting for another worker to compute {key}.")
+
+    def set(self, key, value, ttl, stale_ttl=None, delta=0.0):
+        """
+        store a value computed outside get_or_compute.
+        """
+        stale_ttl = ttl if stale_ttl is None else stale_ttl
+        entry = {"value": value, "expires": time.time() + ttl, "delta": delta}
+        self.redis_service.set_object(key, entry, ex=max(1, math.ceil(ttl + stale_ttl)))
+
+    def invalidate(self, key):
+        self.redis_service.delete(key)
+
+    def _refresh(self, key, compute, ttl, stale_ttl, token):
+        computed = self._keep_lock(key, token)
+        try:
+            start = time.monotonic()
+            value = compute()
+            delta = time.monotonic() - start
+
+            self.set(key, value, ttl, stale_ttl, delta)
+            return value
+
+        except Exception:
+            logger.exception("failed to compute cache key %s.", key)
+            raise
+
+        finally:
+            computed.set()
+            self._release_lock(key, token)
+
+    def _keep_lock(self, key, token):
+        """
+        extend the lock every lock_timeout / 3 seconds in a background thread, until the returned event is set (or
+        the lock is lost).
+        """
+        computed = threading.Event()
+
+        def extend():
+            while not computed.wait(self.lock_timeout / 3):
+                if not self._extend_lock(key, token):
+                    logger.warning("lost the lock of cache key %s while computing it.", key)
+                    return
+
+        threading.Thread(target=extend, name="cache-lock", daemon=True).start()
+        return computed
+
+    def _refresh_in_background(self, key, compute, ttl, stale_ttl, token):
+        try:
+            self._refresh(key, compute, ttl, stale_ttl, token)
+        except Exception:
+            # already logged, the stale value stays until the next refresh.
+            pass
+
+    def _refreshed_meanwhile(self, key, entry, token):
+        """
+        another worker may have refreshed the value between our read and our lock - release the lock if so.
+        """
+        current = self._get_entry(key)
+        if current is None or current["expires"] == entry["expires"]:
+            return False
+        self._release_lock(key, token)
+        return True
+
+    def _should_refresh(self, entry):
+        """
+        XFetch - refresh when now - delta * beta * log(random) >= expires.
+        """
+        now = time.time()
+        if now >= entry["expires"]:
+            return True
+        if not self.beta or not entry.get("delta"):
+            return False
+        return now - entry["delta"] * self.beta * math.log(1.0 - random.random()) >= entry["expires"]
+
+    def _get_entry(self, key):
+        entry = self.redis_service.get_object(key)
+        # values written without the cache envelope are ignored (treated as a miss).
+        if not isinstance(entry, dict) or "value" not in entry or "expires" not in entry:
+            return None
+        return entry
+
+    def _acquire_lock(self, key):
+        """
+        :return: the lock token if the lock was acquired, None if another worker holds it.
+        """
+        token = uuid.uuid4().hex
+        acquired = self.redis_service.redis_client.set(self.LOCK_PREFIX + key, token, nx=True,
+                                                       px=int(self.lock_timeout * 1000))
+        return token if acquired else None
+
+    def _release_lock(self, key, token):
+        """
+        delete the lock only if it is still ours (it may have expired and been taken by another worker).
+        """
+        self._if_lock_held(key, token, lambda pipe, lock_key: pipe.delete(lock_key))
+
+    def _extend_lock(self, key, token):
+        """
+        :return: True if the lock is still ours and was extended.
+        """
+        return self._if_lock_held(key, token,
+                                  lambda pipe, lock_key: pipe.pexpire(lock_key, int(self.lock_timeout * 1000)))
+
+    def _if_lock_held(self, key, token, command):
+        """
+        run command(pipe, lock key) in a transaction, only if the lock is held by token.
+
+        :return: True if the command ran.
+        """
+        lock_key = self.LOCK_PREFIX + key
+
+        with self.redis_service.pipeline(transaction=True) as pipe:
+            try:
+                pipe.watch(lock_key)
+                current = pipe.get(lock_key)
+                if isinstance(current, bytes):
+                    current = current.decode()
+                if current != token:
+                    pipe.unwatch()
+                    return False
+                pipe.multi()
+                command(pipe, lock_key)
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                # the lock changed meanwhile - it is not ours anymore.
+                return False
+
+
+class AsyncCacheService(CacheService):
+    """
+    asyncio version of CacheService on top of AsyncRedisService - same protections, `compute` is a coroutine
+    function and the background refresh runs as an asyncio task.
+    """
+
+    def __init__(self, redis_service, **kwargs):
+        super().__init__(redis_service, **kwargs)
+        self._background_tasks = set()
+
+    async def get_or_compute(self, key, compute, ttl, stale_ttl=None, wait_timeout=None):
+        stale_ttl = ttl if stale_ttl is None else stale_ttl
+        wait_timeout = self.wait_timeout if wait_timeout is None else wait_timeout
+        entry = await self._get_entry(key)
+
+        if entry is not None:
+            if not self._should_refresh(entry):
+                cache_lookup("cache_service", "hit")
+                return entry["value"]
+            cache_lookup("cache_service", "stale")
+
+            token = await self._acquire_lock(key)
+            if token is not None and await self._refreshed_meanwhile(key, entry, token):
+                token = None
+            if token is not None:
+                task = asyncio.create_task(self._refresh_in_background(key, compute, ttl, stale_ttl, token))
+                # keep a reference until the task is done, so it is not garbage collected.
+                self._background_tasks.add(task)
+                task.add_done_callback(self._background_tasks.discard)
+            return entry["value"]
+
+        cache_lookup("cache_service", "miss")
+        deadline = time.monotonic() + wait_timeout
+        while True:
+            token = await self._acquire_lock(key)
+            if token is not None:
+                entry = await self._get_entry(key)
+                if entry is not None:
+                    await self._release_lock(key, token)
+                    return entry["value"]
+                return await self._refresh(key, compute, ttl, stale_ttl, token)
+
+            await asyncio.sleep(self.poll_interval)
+            entry = await self._get_entry(key)
+            if entry is not None:
+                return entry["value"]
+
+            if time.monotonic() >= deadline:
+                raise CacheTimeout(f"timeout waiting for another worker to compute {key}.")
+
+    async def set(self, key, value, ttl, stale_ttl=None, delta=0.0):
+        stale_ttl = ttl if stale_ttl is None else stale_ttl
+        entry = {"value": value, "expires": time.time() + ttl, "delta": delta}
+        await self.redis_service.set_object(key, entry, ex=max(1, math.ceil(ttl + stale_ttl)))
+
+    async def invalidate(self, key):
+        await self.redis_service.delete(key)
+
+    async def _refresh(self, key, compute, ttl, stale_ttl, token):
+        keeper = asyncio.create_task(self._keep_lock(key, token))
+        try:
+            start = time.monotonic()
+            value = await compute()
+            await self.set(key, value, ttl, stale_ttl, time.monotonic() - start)
+            return value
+
+        except Exception:
+            logger.exception("failed to compute cache key %s.", key)
+            raise
+
+        finally:
+            keeper.cancel()
+            await self._release_lock(key, token)
+
+    async def _keep_lock(self, key, token):
+        while True:
+            await asyncio.sleep(self.lock_timeout / 3)
+            if not await self._extend_lock(key, token):
+                logger.warning("lost the lock of cache key %s while computing it.", key)
+                return
+
+    async def _refresh_in_background(self, key, compute, ttl, stale_ttl, token):
+        try:
+            await self._refresh(key, compute, ttl, stale_ttl, token)
+        except Exception:
+            pass
+
+    async def _refreshed_meanwhile(self, key, entry, token):
+        current = await self._get_entry(key)
+        if current is None or current["expires"] == entry["expires"]:
+            return False
+        await self._release_lock(key, token)
+        return True
+
+    async def _get_entry(self, key):
+        entry = await self.redis_service.get_object(key)
+        if not isinstance(entry, dict) or "value" not in entry or "expires" not in entry:
+            return None
+        return entry
+
+    async def _acquire_lock(self, key):
+        token = uuid.uuid4().hex
+        acquired = await self.redis_service.redis_client.set(self.LOCK_PREFIX + key, token, nx=True,
+                                                             px=int(self.lock_timeout * 1000))
+        return token if acquired else None
+
+    async def _release_lock(self, key, token):
+        await self._if_lock_held(key, token, lambda pipe, lock_key: pipe.delete(lock_key))
+
+    async def _extend_lock(self, key, token):
+        return await self._if_lock_held(key, token,
+                                        lambda pipe, lock_key: pipe.pexpire(lock_key, int(self.lock_timeout * 1000)))
+
+    async def _if_lock_held(self, key, token, command):
+        lock_key = self.LOCK_PREFIX + key
+
+        async with self.redis_service.pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(lock_key)
+                current = await pipe.get(lock_key)
+                if isinstance(current, bytes):
+                    current = current.decode()
+                if current != token:
+                    await pipe.unwatch()
+                    return False
+                pipe.multi()
+                command(pipe, lock_key)
+                await pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
@@ -0,0 +1,269 @@
+"""
+parallel folding of big audit csv files.
+
+the file is split at newline aligned byte ranges, every range is parsed and folded (like UserService.fold_events)
+in its own process into compact per user partial aggregates, and the parent merges them. the ranges are merged in file
+order, so the result is the same as folding the whole file in one pass.
+
+the audit files have no quoted fields spanning several lines - a range always starts at the beginning of a row.
+
+the scan jobs (see ScanJobService) fold big files window by window (see iter_folded_windows), so the memory of the
+merged aggregates stays bounded and the progress is checkpointed after every window.
+"""
+import csv
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from app.dynamo_db.service import UserService
+from app.services.timestamps import MAX_EPOCH, MIN_EPOCH, epochs_to_iso
+
+
+REQUIRED_FIELDS = ("User Email", "Timestamp", "Event Description")
+
+
+def check_fieldnames(fieldnames):
+    """
+    :param fieldnames: the csv header.
+    :raise ValueError: if a column needed by the folding is missing.
+    """
+    missing = [name for name in REQUIRED_FIELDS if name not in (fieldnames or ())]
+    if missing:
+        raise ValueError(f"the csv header {fieldnames} has no {', '.join(missing)} column")
+
+
+def read_csv_header(path):
+    """
+    :param path: path of the csv file.
+    :return: tuple of (fieldnames, offset of the first row) - fieldnames is None for an empty file.
+    """
+    with open(path, "rb") as f:
+        header = f.readline()
+        return next(csv.reader([header.decode("utf-8-sig")]), None), f.tell()
+
+
+def split_byte_ranges(path, parts):
+    """
+    :param path: path of the csv file.
+    :param parts: number of ranges wanted (fewer are returned for small files).
+    :return: tuple of (fieldnames, [(start, end), ...]) - the header and the byte ranges of the rows, every range
+     starts at the beginning of a line.
+    """
+    fieldnames, data_start = read_csv_header(path)
+
+    with open(path, "rb") as f:
+        return fieldnames, _split_range(f, data_start, os.path.getsize(path), parts)
+
+
+def _split_range(f, start, end, parts):
+    """
+    :return: [(start, end), ...] - the bytes from start to end of the open file f cut in up to `parts` ranges,
+     every range starts at the beginning of a line.
+    """
+    boundaries = [start]
+    for i in range(1, parts):
+        position = start + (end - start) * i // parts
+        if position <= boundaries[-1]:
+            continue
+
+        line_start = _next_line_start(f, position)
+        if boundaries[-1] < line_start < end:
+            boundaries.append(line_start)
+
+    boundaries.append(end)
+    return [(range_start, range_end) for range_start, range_end in zip(boundaries, boundaries[1:])
+            if range_end > range_start]
+
+
+def _next_line_start(f, position):
+    """
+    :return: offset of the first line of the open file f starting at or after position (position > 0).
+    """
+    f.seek(position - 1)
+    f.readline()
+    return f.tell()
+
+
+def fold_byte_range(path, start, end, fieldnames):
+    """
+    parse and fold the rows of one byte range of the file (runs in a worker process).
+
+    :return: compact partial aggregate of the rows in the range (see fold_rows).
+    """
+    return _fold_counted_range(path, start, end, fieldnames)[1]
+
+
+def _fold_counted_range(path, start, end, fieldnames):
+    """
+    :return: tuple of (number of rows, partial aggregate) of one byte range of the file.
+    """
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    reader = csv.reader(io.StringIO(data.decode("utf-8")))
+    folded = fold_rows(reader, fieldnames)
+    # no field spans several lines, so every line read is a row.
+    return reader.line_num, folded
+
+
+def fold_rows(rows, fieldnames):
+    """
+    same folding as UserService.fold_events, into a compact form that is cheap to send between processes: the
+    timestamps of the other events stay epochs (formatted once by the parent) and every distinct event description
+    is one shared string.
+
+    :param rows: iterable of csv rows (lists of values).
+    :param fieldnames: the csv header.
+    :return: dict of {email: [lastLogin, passwordChanged, admin, [(epoch, event description), ...]]}.
+    :raise ValueError: if a column needed by the folding is missing from fieldnames.
+    """
+    check_fieldnames(fieldnames)
+    email_index = fieldnames.index("User Email")
+    timestamp_index = fieldnames.index("Timestamp")
+    description_index = fieldnames.index("Event Description")
+    min_length = max(email_index, timestamp_index, description_index) + 1
+
+    # {event description: (shared description, kind)}.
+    event_kinds = {}
+    folded = {}
+
+    for row in rows:
+        if len(row) < min_length:
+            continue
+
+        email, timestamp, event_description = row[email_index], row[timestamp_index], row[description_index]
+        if not email or not timestamp or not event_description:
+            continue
+
+        try:
+            epoch = int(timestamp)
+        except ValueError:
+            continue
+        if not MIN_EPOCH <= epoch <= MAX_EPOCH:
+            continue
+
+        known = event_kinds.get(event_description)
+        if known is None:
+            known = event_kinds[event_description] = (event_description, UserService.event_kind(event_description))
+        event_description, kind = known
+
+        user_events = folded.get(email)
+        if user_events is None:
+            user_events = folded[email] = [None, None, False, []]
+
+        if kind == "lastLogin":
+            if user_events[0] is None or epoch >= user_events[0]:
+                user_events[0] = epoch
+        elif kind == "passwordChanged":
+            if user_events[1] is None or epoch >= user_events[1]:
+                user_events[1] = epoch
+        elif kind == "admin":
+            user_events[2] = True
+        else:
+            user_events[3].append((epoch, event_description))
+
+    return folded
+
+
+def merge_folded_events(partials):
+    """
+    merge the partial aggregates of consecutive parts of a file (in file order).
+
+    :param partials: iterable of compact partial aggregates (see fold_rows).
+    :return: dict of {email: folded events}, same as UserService.fold_events of all the rows.
+    """
+    merged = {}
+
+    for partial in partials:
+        for email, (last_login, password_changed, admin, other_events) in partial.items():
+            current = merged.get(email)
+            if current is None:
+                merged[email] = [last_login, password_changed, admin, other_events]
+                continue
+
+            if last_login is not None and (current[0] is None or last_login >= current[0]):
+                current[0] = last_login
+            if password_changed is not None and (current[1] is None or password_changed >= current[1]):
+                current[1] = password_changed
+            current[2] = current[2] or admin
+            current[3].extend(other_events)
+
+    # the timestamps of all the other events are formatted in one batch.
+    timestamps = iter(epochs_to_iso([epoch for user_events in merged.values() for epoch, _ in user_events[3]]))
+
+    return {email: {"lastLogin": last_login,
+                    "passwordChanged": password_changed,
+                    "admin": admin,
+                    "user_events": [{'Timestamp': next(timestamps), 'Event Description': description}
+                                    for _, description in other_events]}
+            for email, (last_login, password_changed, admin, other_events) in merged.items()}
+
+
+def fold_csv_file(path, workers=None, ranges_per_worker=2):
+    """
+    fold all the rows of a local csv file, in parallel.
+
+    :param path: path of the csv file.
+    :param workers: number of worker processes (default: number of cores), 1 folds in this process.
+    :param ranges_per_worker: the file is split in workers * ranges_per_worker ranges, so a slow range does not
+     leave the other workers idle.
+    :return: dict of {email: folded events}.
+    :raise ValueError: if a column needed by the folding is missing from the header.
+    """
+    workers = workers or os.cpu_count() or 1
+    fieldnames, ranges = split_byte_ranges(path, workers * ranges_per_worker)
+
+    if not fieldnames or not ranges:
+        return {}
+    check_fieldnames(fieldnames)
+
+    if workers == 1:
+        return merge_folded_events(fold_byte_range(path, start, end, fieldnames) for start, end in ranges)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        partials = executor.map(fold_byte_range, [path] * len(ranges), [start for start, _ in ranges],
+                                [end for _, end in ranges], [fieldnames] * len(ranges))
+        return merge_folded_events(partials)
+
+
+def iter_folded_windows(path, fieldnames, start, window_bytes, workers=None, ranges_per_worker=2):
+    """
+    fold the rows of a local csv file window by window, every window in parallel (see fold_csv_file).
+
+    :param path: path of the csv file.
+    :param fieldnames: the csv header.
+    :param start: offset of the first row to fold.
+    :param window_bytes: size of the windows (a window ends at the first line starting after that size).
+    :param workers: number of worker processes (default: number of cores), 1 folds in this process.
+    :param ranges_per_worker: every window is split in workers * ranges_per_worker ranges.
+    :return: iterator of (end offset of the window, number of rows in the window, {email: folded events}).
+    :raise ValueError: if a column needed by the folding is missing from fieldnames.
+    """
+    check_fieldnames(fieldnames)
+    workers = workers or os.cpu_count() or 1
+    size = os.path.getsize(path)
+
+    # the scan jobs run in the threads of a server process - forking it could deadlock the children.
+    executor = None
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+    try:
+        with open(path, "rb") as f:
+            while start < size:
+                end = size if start + window_bytes >= size else _next_line_start(f, start + window_bytes)
+                ranges = _split_range(f, start, end, workers * ranges_per_worker)
+
+                args = ([path] * len(ranges), [range_start for range_start, _ in ranges],
+                        [range_end for _, range_end in ranges], [fieldnames] * len(ranges))
+                results = list(executor.map(_fold_counted_range, *args) if executor else
+                               map(_fold_counted_range, *args))
+
+                yield end, sum(rows for rows, _ in results), merge_folded_events(folded for _, folded in results)
+                start = end
+
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
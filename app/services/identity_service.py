@@ -4,15 +4,48 @@ class IdentityService:
     It fetches and processes user data, extracting relevant fields, while delegating data manipulation to the
     DataProcessor class. This separates the business logic from the data handling.
 
+    async_api_service (e.g. AsyncOktaClient) is the optional asyncio client used by get_users_data_async.
     """
-    def __init__(self, api_service, data_processor):
+    def __init__(self, api_service, data_processor, async_api_service=None):
         self.api_service = api_service
         self.data_processor = data_processor
+        self.async_api_service = async_api_service
 
-    def get_users_data(self, relevant_fields):
+    def get_users_data(self, relevant_fields, admin_group_id=None, updated_since=None):
+        """
+        :param relevant_fields: field we would like to include in DB.
+        :param admin_group_id: if given, the members of this group are fetched concurrently with the users
+         and the 'admin' field of every user is set accordingly.
+        :param updated_since: if given, only the users updated after this Okta timestamp are fetched.
+        :return: dict of all users with relevant data.
+        """
         try:
-            users_data = self.api_service.get_users_data()
-            return self.data_processor.extract_data(users_data, relevant_fields)
+            if admin_group_id is None:
+                users_data = self.api_service.get_users_data(updated_since)
+                return self.data_processor.extract_data(users_data, relevant_fields)
+
+            users_data, admin_users = self.api_service.get_users_and_admin_users(admin_group_id, updated_since)
+            users_data = self.data_processor.extract_data(users_data, relevant_fields)
+            self.data_processor.update_admin_field(admin_users, users_data)
+            return users_data
+
+        except Exception as e:
+            raise ValueError(f"Failed to retrieve users data: {str(e)}")
+
+    async def get_users_data_async(self, relevant_fields, admin_group_id=None, updated_since=None):
+        """
+        asyncio version of get_users_data, with async_api_service.
+        """
+        try:
+            if admin_group_id is None:
+                users_data = await self.async_api_service.get_users_data(updated_since)
+                return self.data_processor.extract_data(users_data, relevant_fields)
+
+            users_data, admin_users = await self.async_api_service.get_users_and_admin_users(admin_group_id,
+                                                                                             updated_since)
+            users_data = self.data_processor.extract_data(users_data, relevant_fields)
+            self.data_processor.update_admin_field(admin_users, users_data)
+            return users_data
 
         except Exception as e:
             raise ValueError(f"Failed to retrieve users data: {str(e)}")
@@ -0,0 +1,197 @@
+"""
+in-process metrics of the calls to the external services (DynamoDB, Redis, S3, Okta), kept with prometheus_client
+and exposed in the Prometheus text format on /metrics.
+
+besides the process wide metrics, the time spent per component can be collected for one unit of work (a request,
+a scan job) with collect_timings - see app.api.metrics.RequestTimingMiddleware.
+"""
+import contextvars
+import functools
+import inspect
+from contextlib import contextmanager
+from time import perf_counter
+
+from prometheus_client import Counter, Histogram
+
+# latency buckets (seconds), from a local redis call to a big S3 download.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# DynamoDB operations which are not metered (table management).
+_UNMETERED_OPERATIONS = frozenset({"DescribeTable", "ListTables", "UpdateTable", "UpdateTimeToLive", "DeleteTable",
+                                   "CreateTable"})
+
+OPERATION_SECONDS = Histogram("external_call_duration_seconds", "latency of the calls to the external services.",
+                              ("component", "operation"), buckets=DEFAULT_BUCKETS)
+OPERATION_ERRORS = Counter("external_call_errors_total", "failed calls to the external services.",
+                           ("component", "operation", "error"))
+BYTES_TRANSFERRED = Counter("external_bytes_total", "bytes sent to / received from the external services.",
+                            ("component", "direction"))
+CACHE_REQUESTS = Counter("cache_requests_total", "cache lookups by result (hit, miss, stale).", ("cache", "result"))
+DYNAMODB_CAPACITY = Counter("dynamodb_consumed_capacity_units_total",
+                            "DynamoDB capacity units consumed, as reported by DynamoDB.", ("table", "operation"))
+HTTP_REQUEST_SECONDS = Histogram("http_request_duration_seconds", "latency of the HTTP requests.",
+                                 ("method", "route", "status"), buckets=DEFAULT_BUCKETS)
+
+
+# {component: [calls, seconds]} of the current unit of work (see collect_timings), None outside of one.
+_timings = contextvars.ContextVar("metrics_timings", default=None)
+
+
+def observe(component, operation, seconds, error=None):
+    """
+    record one call to an external service.
+
+    :param component: the service called (dynamodb, redis, s3, okta...).
+    :param operation: what was called (e.g. GetItem).
+    :param seconds: duration of the call.
+    :param error: error code / exception name if the call failed.
+    """
+    _record(OPERATION_SECONDS.labels(component, operation), component, seconds)
+    if error is not None:
+        OPERATION_ERRORS.labels(component, operation, error).inc()
+
+
+def _record(series, component, seconds):
+    series.observe(seconds)
+
+    timings = _timings.get()
+    if timings is not None:
+        # the calls of a request may run on several threads - a lost update only skews its log line.
+        entry = timings.get(component)
+        if entry is None:
+            timings[component] = [1, seconds]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+
+
+def add_bytes(component, direction, size):
+    """
+    :param direction: "in" (received) or "out" (sent).
+    """
+    if size:
+        BYTES_TRANSFERRED.labels(component, direction).inc(size)
+
+
+def cache_lookup(cache, result):
+    CACHE_REQUESTS.labels(cache, result).inc()
+
+
+class timed:
+    """
+    context manager recording the duration of the block (and its exception, if any) with observe.
+
+        with timed("s3", "head"):
+            response = requests.head(url)
+    """
+    __slots__ = ("component", "operation", "start")
+
+    def __init__(self, component, operation):
+        self.component = component
+        self.operation = operation
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        observe(self.component, self.operation, perf_counter() - self.start,
+                None if exc_type is None else exc_type.__name__)
+        return False
+
+
+def instrumented(component, operation):
+    """
+    decorator recording the calls of a function (or a coroutine function) with observe.
+    """
+    series = OPERATION_SECONDS.labels(component, operation)
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                start = perf_counter()
+                try:
+                    result = await func(*args, **kwargs)
+                except BaseException as e:
+                    observe(component, operation, perf_counter() - start, type(e).__name__)
+                    raise
+                _record(series, component, perf_counter() - start)
+                return result
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except BaseException as e:
+                observe(component, operation, perf_counter() - start, type(e).__name__)
+                raise
+            _record(series, component, perf_counter() - start)
+            return result
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def collect_timings():
+    """
+    collect the calls made in the block - in this thread, and in the threads / tasks started from it with the
+    current context (asyncio tasks, copy_context().run).
+
+    :return: (context manager) dict of {component: {"calls", "ms"}}, filled when the block exits.
+    """
+    timings = {}
+    summary = {}
+    token = _timings.set(timings)
+    try:
+        yield summary
+    finally:
+        _timings.reset(token)
+        summary.update(timings_summary(timings))
+
+
+def timings_summary(timings):
+    return {component: {"calls": calls, "ms": round(seconds * 1000, 2)}
+            for component, (calls, seconds) in sorted(timings.copy().items())}
+
+
+def current_timings():
+    """
+    :return: the raw timings being collected in this context, None outside of collect_timings.
+    """
+    return _timings.get()
+
+
+def observe_dynamodb(operation_name, seconds, data=None, error=None):
+    """
+    record one DynamoDB call - its latency, its error code, and the capacity it consumed (PynamoDB asks for
+    ReturnConsumedCapacity=TOTAL on every data operation), see app.dynamo_db.models.InstrumentedConnection.
+
+    :param operation_name: the DynamoDB operation (e.g. GetItem).
+    :param seconds: duration of the call.
+    :param data: response of the call.
+    :param error: exception raised by the call, if any.
+    """
+    code = None
+    if error is not None:
+        code = getattr(error, "cause_response_code", None)
+        if code is None and hasattr(error, "response"):
+            code = error.response.get("Error", {}).get("Code")
+        code = code or type(error).__name__
+
+    observe("dynamodb", operation_name, seconds, code)
+    if data and operation_name not in _UNMETERED_OPERATIONS:
+        _record_consumed_capacity(operation_name, data.get("ConsumedCapacity"))
+
+
+def _record_consumed_capacity(operation_name, consumed_capacity):
+    # a dict for the single table operations, a list (one per table) for the batch and transaction operations.
+    if isinstance(consumed_capacity, dict):
+        consumed_capacity = [consumed_capacity]
+    for capacity in consumed_capacity or ():
+        units = capacity.get("CapacityUnits")
+        if units:
+            DYNAMODB_CAPACITY.labels(capacity.get("TableName", ""), operation_name).inc(units)
@@ -0,0 +1,134 @@
+import asyncio
+import json
+import time
+
+
+class OktaSyncService:
+    """
+    The OktaSyncService class keeps the users table in sync with Okta.
+
+    Instead of pulling the whole organization on every sync, it keeps a high-water mark (the max 'lastUpdated'
+    seen in Okta) in Redis and only fetches and upserts the users updated since. A full sync is still done
+    when there is no high-water mark yet, when it is requested explicitly, or when the last full sync is older
+    than full_sync_interval (periodic reconciliation, e.g. for users whose changes were missed).
+
+    the users updated at the mark itself are fetched again (lastUpdated ge the mark - another user can be updated
+    in the same millisecond after the sync), the ones already synced at the mark are kept in Redis and skipped.
+    the sync state only moves after the users were fetched (a failed fetch raises) and written.
+    """
+    HIGH_WATER_MARK_KEY = "okta_sync:last_updated"
+    # JSON of {"mark": high-water mark, "ids": ids of the synced users updated at the mark}.
+    HIGH_WATER_MARK_IDS_KEY = "okta_sync:last_updated_ids"
+    LAST_FULL_SYNC_KEY = "okta_sync:last_full_sync"
+
+    def __init__(self, identity_service, user_repository, redis_service, admin_group_id=None,
+                 full_sync_interval=24 * 3600):
+        """
+        :param identity_service: IdentityService used to fetch the users from Okta.
+        :param user_repository: UserRepository used to upsert the users.
+        :param redis_service: RedisService used to persist the sync state.
+        :param admin_group_id: Okta admin group id, used to fill the admin field.
+        :param full_sync_interval: seconds between two full reconciliations (None to disable).
+        """
+        self.identity_service = identity_service
+        self.user_repository = user_repository
+        self.redis_service = redis_service
+        self.admin_group_id = admin_group_id
+        self.full_sync_interval = full_sync_interval
+
+    def sync(self, relevant_fields, full=False):
+        """
+        :param relevant_fields: field we would like to include in DB.
+        :param full: force a full sync of all the users.
+        :return: dict with the sync mode, the fetched users and the upload report.
+        """
+        full, high_water_mark = self._sync_mode(full)
+
+        users_data = self.identity_service.get_users_data(
+            set(relevant_fields) | {"lastUpdated"},
+            admin_group_id=self.admin_group_id,
+            updated_since=None if full else high_water_mark
+        )
+        return self._store(users_data, full, high_water_mark)
+
+    async def sync_async(self, relevant_fields, full=False):
+        """
+        asyncio version of sync - the users are fetched with the async Okta client, the blocking DynamoDB and
+        Redis calls run in a worker thread.
+        """
+        full, high_water_mark = await asyncio.to_thread(self._sync_mode, full)
+
+        users_data = await self.identity_service.get_users_data_async(
+            set(relevant_fields) | {"lastUpdated"},
+            admin_group_id=self.admin_group_id,
+            updated_since=None if full else high_water_mark
+        )
+        return await asyncio.to_thread(self._store, users_data, full, high_water_mark)
+
+    def _sync_mode(self, full):
+        """
+        :return: tuple of (full sync or not, current high-water mark).
+        """
+        high_water_mark = self._get_state(self.HIGH_WATER_MARK_KEY)
+        return full or high_water_mark is None or self._full_sync_due(), high_water_mark
+
+    def _store(self, users_data, full, high_water_mark):
+        """
+        upsert the fetched users and move the sync state forward.
+        """
+        synced_ids = self._ids_at(high_water_mark)
+        if not full:
+            users_data = {user_id: user for user_id, user in users_data.items()
+                          if not (user.get("lastUpdated") == high_water_mark and user_id in synced_ids)}
+
+        report = self.user_repository.upload_user_data_to_db(users_data)
+
+        # Okta timestamps are ISO 8601 in UTC, so they compare as strings.
+        last_updated = max((user["lastUpdated"] for user in users_data.values() if user.get("lastUpdated")),
+                           default=None)
+        # only move the mark if all the fetched users were written (users without email can never be).
+        written = all(reason == "missing email" for reason in report["failed"].values())
+        if last_updated and written and (high_water_mark is None or last_updated >= high_water_mark):
+            ids = {user_id for user_id, user in users_data.items() if user.get("lastUpdated") == last_updated}
+            if last_updated == high_water_mark and not full:
+                ids |= synced_ids
+            self.redis_service.set(self.HIGH_WATER_MARK_IDS_KEY, json.dumps({"mark": last_updated,
+                                                                              "ids": sorted(ids)}))
+            self.redis_service.set(self.HIGH_WATER_MARK_KEY, last_updated)
+
+        if full and written:
+            self.redis_service.set(self.LAST_FULL_SYNC_KEY, str(int(time.time())))
+
+        return {"mode": "full" if full else "incremental", "users_data": users_data, "report": report}
+
+    def reset(self):
+        """
+        forget the sync state, the next sync will be a full sync.
+        """
+        self.redis_service.delete(self.HIGH_WATER_MARK_KEY)
+        self.redis_service.delete(self.HIGH_WATER_MARK_IDS_KEY)
+        self.redis_service.delete(self.LAST_FULL_SYNC_KEY)
+
+    def _ids_at(self, high_water_mark):
+        """
+        :return: ids of the users synced at the high-water mark.
+        """
+        state = self._get_state(self.HIGH_WATER_MARK_IDS_KEY)
+        if high_water_mark is None or state is None:
+            return set()
+        state = json.loads(state)
+        # written before the mark - ids of another mark if the mark was not written after them.
+        return set(state["ids"]) if state["mark"] == high_water_mark else set()
+
+    def _full_sync_due(self):
+        if self.full_sync_interval is None:
+            return False
+
+        last_full_sync = self._get_state(self.LAST_FULL_SYNC_KEY)
+        return last_full_sync is None or time.time() - int(last_full_sync) >= self.full_sync_interval
+
+    def _get_state(self, key):
+        value = self.redis_service.get(key)
+        if isinstance(value, bytes):
+            value = value.decode()
+        return value
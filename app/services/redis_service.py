@@ -1,15 +1,202 @@
+import threading
+
 import redis
+import redis.asyncio
+
+from app.services.metrics import add_bytes, instrumented
+from app.services.serializers import get_serializer
+
+# connection pools shared by all the RedisService instances of the process, by (host, port, db).
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+
+
+def get_connection_pool(host='localhost', port=6379, db=0, max_connections=50):
+    """
+    :return: the process wide connection pool of this redis server.
+    """
+    key = (host, port, db)
+
+    with _connection_pools_lock:
+        if key not in _connection_pools:
+            _connection_pools[key] = redis.ConnectionPool(host=host, port=port, db=db,
+                                                          max_connections=max_connections)
+        return _connection_pools[key]
 
 
 class RedisService:
-    def __init__(self, host='localhost', port=6379, db=0):
-        self.redis_client = redis.Redis(host=host, port=port, db=db)
+    """
+    The RedisService class wraps the redis client used for caching.
+
+    get/set/delete work on raw values. the *_object methods encode the values with the configured serializer
+    (compact JSON by default, zlib compressed above a size threshold), and mget/mset/pipeline send many commands
+    in one round trip.
+    """
+    def __init__(self, host='localhost', port=6379, db=0, max_connections=50, serializer=None,
+                 redis_client=None):
+        """
+        :param max_connections: size of the shared connection pool.
+        :param serializer: serializer of the *_object methods (see app.services.serializers).
+        :param redis_client: use this client instead of a pooled one (e.g. fakeredis in tests).
+        """
+        if redis_client is None:
+            redis_client = redis.Redis(connection_pool=get_connection_pool(host, port, db, max_connections))
 
+        self.redis_client = redis_client
+        self.serializer = serializer or get_serializer()
+
+    @instrumented("redis", "get")
     def get(self, key):
         return self.redis_client.get(key)
 
+    @instrumented("redis", "set")
     def set(self, key, value, ex=None):
         self.redis_client.set(key, value, ex=ex)
 
+    @instrumented("redis", "delete")
     def delete(self, key):
         self.redis_client.delete(key)
+
+    @instrumented("redis", "mget")
+    def mget(self, keys):
+        """
+        :return: list of the raw values of the keys (None for missing keys), in one round trip.
+        """
+        if not keys:
+            return []
+        return self.redis_client.mget(keys)
+
+    @instrumented("redis", "mset")
+    def mset(self, mapping, ex=None):
+        """
+        set all the raw values of mapping ({key: value}) in one round trip.
+        """
+        if not mapping:
+            return
+
+        with self.pipeline() as pipe:
+            for key, value in mapping.items():
+                pipe.set(key, value, ex=ex)
+            pipe.execute()
+
+    def pipeline(self, transaction=False):
+        """
+        :return: redis pipeline - the commands are buffered and sent in one round trip on execute().
+        """
+        return self.redis_client.pipeline(transaction=transaction)
+
+    @instrumented("redis", "get")
+    def get_object(self, key):
+        """
+        :return: the decoded value of key, None if the key does not exist.
+        """
+        data = self.redis_client.get(key)
+        if data is None:
+            return None
+        add_bytes("redis", "in", len(data))
+        return self.serializer.loads(data)
+
+    @instrumented("redis", "set")
+    def set_object(self, key, value, ex=None):
+        data = self.serializer.dumps(value)
+        add_bytes("redis", "out", len(data))
+        self.redis_client.set(key, data, ex=ex)
+
+    def mget_objects(self, keys):
+        """
+        :return: list of the decoded values of the keys (None for missing keys), in one round trip.
+        """
+        values = self.mget(keys)
+        add_bytes("redis", "in", sum(len(data) for data in values if data is not None))
+        return [None if data is None else self.serializer.loads(data) for data in values]
+
+    def mset_objects(self, mapping, ex=None):
+        mapping = {key: self.serializer.dumps(value) for key, value in mapping.items()}
+        add_bytes("redis", "out", sum(len(data) for data in mapping.values()))
+        self.mset(mapping, ex=ex)
+
+
+# async connection pools shared by all the AsyncRedisService instances of the process, by (host, port, db).
+_async_connection_pools = {}
+
+
+def get_async_connection_pool(host='localhost', port=6379, db=0, max_connections=50):
+    """
+    :return: the process wide asyncio connection pool of this redis server.
+    """
+    key = (host, port, db)
+
+    with _connection_pools_lock:
+        if key not in _async_connection_pools:
+            _async_connection_pools[key] = redis.asyncio.ConnectionPool(host=host, port=port, db=db,
+                                                                        max_connections=max_connections)
+        return _async_connection_pools[key]
+
+
+class AsyncRedisService:
+    """
+    asyncio version of RedisService (redis.asyncio), for the async request handlers - same methods, awaitable.
+    """
+    def __init__(self, host='localhost', port=6379, db=0, max_connections=50, serializer=None,
+                 redis_client=None):
+        if redis_client is None:
+            redis_client = redis.asyncio.Redis(
+                connection_pool=get_async_connection_pool(host, port, db, max_connections))
+
+        self.redis_client = redis_client
+        self.serializer = serializer or get_serializer()
+
+    @instrumented("redis", "get")
+    async def get(self, key):
+        return await self.redis_client.get(key)
+
+    @instrumented("redis", "set")
+    async def set(self, key, value, ex=None):
+        await self.redis_client.set(key, value, ex=ex)
+
+    @instrumented("redis", "delete")
+    async def delete(self, key):
+        await self.redis_client.delete(key)
+
+    @instrumented("redis", "mget")
+    async def mget(self, keys):
+        if not keys:
+            return []
+        return await self.redis_client.mget(keys)
+
+    @instrumented("redis", "mset")
+    async def mset(self, mapping, ex=None):
+        if not mapping:
+            return
+
+        async with self.pipeline() as pipe:
+            for key, value in mapping.items():
+                pipe.set(key, value, ex=ex)
+            await pipe.execute()
+
+    def pipeline(self, transaction=False):
+        return self.redis_client.pipeline(transaction=transaction)
+
+    @instrumented("redis", "get")
+    async def get_object(self, key):
+        data = await self.redis_client.get(key)
+        if data is None:
+            return None
+        add_bytes("redis", "in", len(data))
+        return self.serializer.loads(data)
+
+    @instrumented("redis", "set")
+    async def set_object(self, key, value, ex=None):
+        data = self.serializer.dumps(value)
+        add_bytes("redis", "out", len(data))
+        await self.redis_client.set(key, data, ex=ex)
+
+    async def mget_objects(self, keys):
+        values = await self.mget(keys)
+        add_bytes("redis", "in", sum(len(data) for data in values if data is not None))
+        return [None if data is None else self.serializer.loads(data) for data in values]
+
+    async def mset_objects(self, mapping, ex=None):
+        mapping = {key: self.serializer.dumps(value) for key, value in mapping.items()}
+        add_bytes("redis", "out", sum(len(data) for data in mapping.values()))
+        await self.mset(mapping, ex=ex)
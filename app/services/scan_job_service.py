@@ -0,0 +1,403 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import redis
+
+from app.api.utils import open_csv_stream, get_s3_fingerprint, download_csv_from_s3
+from app.services.csv_ingest import iter_folded_windows, read_csv_header
+from app.services.metrics import collect_timings, current_timings, timed, timings_summary
+
+logger = logging.getLogger(__name__)
+
+
+class LockLost(Exception):
+    """
+    the lock of a job expired and was taken by another worker - this worker must stop without writing the job.
+    """
+
+
+def _text(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class ScanJobService:
+    """
+    The ScanJobService class processes the S3 CSV scans in the background, in a pool of worker threads.
+
+    a job is identified by its S3 link and the version of the object behind it - the ETag / Last-Modified of a
+    HEAD request - so submitting an already ingested file is a no-op in O(1) (one HEAD request and one Redis
+    read), and a changed file behind the same link is a new job. the job state is small and constant in size, it
+    is kept in Redis and checkpointed after every batch applied to the DB: the byte offset in the file of the next
+    row, the csv header and the progress counters. if a worker dies (or a batch fails), submitting the same link
+    again resumes the file from the last checkpoint instead of starting over. a batch applied right before a crash,
+    and not yet checkpointed, is applied again on resume. the file is read with If-Match on its ETag, so a job
+    never mixes the rows of two versions of the file.
+
+    the rest of a big file (parallel_min_bytes or more) is downloaded to a temporary file instead, and parsed and
+    folded by parallel_workers processes, one window of parallel_window_bytes at a time (see
+    app.services.csv_ingest.iter_folded_windows) - the job is checkpointed after every window.
+
+    a Redis lock per job makes sure only one worker (of all the processes) runs a job at a time. it expires
+    lock_timeout seconds after the last checkpoint, so the job of a dead worker can be resumed. the state of a job
+    is only written by its worker in a transaction checking that it still holds the lock (and extending it), and
+    by submit in a transaction on the job itself - a stale copy of the job never overwrites a newer state.
+    """
+    KEY_PREFIX = "scan_job:"
+    LOCK_PREFIX = "lock:scan_job:"
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    # max number of error messages kept per job.
+    MAX_ERRORS = 20
+
+    def __init__(self, user_service, redis_service, max_workers=2, batch_size=10000, lock_timeout=300,
+                 job_ttl=7 * 24 * 3600, done_job_ttl=6000, versioned_done_job_ttl=30 * 24 * 3600,
+                 open_stream=open_csv_stream, get_fingerprint=get_s3_fingerprint, parallel_workers=1,
+                 parallel_min_bytes=64 * 1024 * 1024, parallel_window_bytes=64 * 1024 * 1024,
+                 download=download_csv_from_s3, tmp_dir=None):
+        """
+        :param user_service: UserService used to apply the rows.
+        :param redis_service: RedisService used to store the jobs state and locks.
+        :param max_workers: number of jobs processed concurrently by this process.
+        :param batch_size: number of rows applied (and checkpointed) together.
+        :param lock_timeout: seconds after which the lock of a job expires if its worker stopped checkpointing.
+        :param job_ttl: seconds an unfinished job is kept (and can be resumed).
+        :param done_job_ttl: seconds a finished job of a link without ETag / Last-Modified is kept, re-submitting
+         the link during that time is a no-op.
+        :param versioned_done_job_ttl: seconds a finished job of a versioned file is kept, re-submitting the same
+         version during that time is a no-op.
+        :param open_stream: function opening the csv stream of a link (see open_csv_stream).
+        :param get_fingerprint: function returning the version of the object behind a link, or None (see
+         get_s3_fingerprint).
+        :param parallel_workers: number of processes parsing a big file (0 for the number of cores), 1 streams all
+         the files.
+        :param parallel_min_bytes: min number of bytes left to read for a file to be parsed in parallel (its size
+         must be known, from the fingerprint).
+        :param parallel_window_bytes: number of bytes parsed in parallel and applied (and checkpointed) together.
+        :param download: function downloading a link to a local file (see download_csv_from_s3).
+        :param tmp_dir: directory of the downloaded files (default: the system temporary directory).
+        """
+        self.user_service = user_service
+        self.redis_service = redis_service
+        self.batch_size = batch_size
+        self.lock_timeout = lock_timeout
+        self.job_ttl = job_ttl
+        self.done_job_ttl = done_job_ttl
+        self.versioned_done_job_ttl = versioned_done_job_ttl
+        self.open_stream = open_stream
+        self.get_fingerprint = get_fingerprint
+        self.parallel_workers = parallel_workers if parallel_workers > 0 else (os.cpu_count() or 1)
+        self.parallel_min_bytes = parallel_min_bytes
+        self.parallel_window_bytes = parallel_window_bytes
+        self.download = download
+        self.tmp_dir = tmp_dir
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="scan-job")
+        self._queued = set()
+        self._queued_lock = threading.Lock()
+
+    @staticmethod
+    def job_id(s3_link, fingerprint=None):
+        """
+        :param s3_link: link of the file.
+        :param fingerprint: version of the file (see get_s3_fingerprint), None if unknown.
+        :return: id of the job of this version of the file.
+        """
+        key = s3_link
+        if fingerprint:
+            key += "\n" + "\n".join(str(fingerprint[name]) for name in ("etag", "last_modified", "content_length"))
+        return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+    def submit(self, s3_link):
+        """
+        queue the scan of s3_link, or resume it from its last checkpoint if it was already started.
+
+        :return: the progress of the job (see progress).
+        """
+        fingerprint = self.get_fingerprint(s3_link)
+        job_id = self.job_id(s3_link, fingerprint)
+        job = self.get_job(job_id)
+
+        if job is not None and job["status"] == self.DONE:
+            return self.progress(job)
+
+        with self._queued_lock:
+            if job_id in self._queued and job is not None:
+                return self.progress(job)
+            self._queued.add(job_id)
+
+        job = self._queue(job_id, s3_link, fingerprint)
+        if job["status"] == self.DONE:
+            # finished since it was read.
+            with self._queued_lock:
+                self._queued.discard(job_id)
+            return self.progress(job)
+
+        self.executor.submit(self._run, job_id)
+        return self.progress(job)
+
+    def _queue(self, job_id, s3_link, fingerprint):
+        """
+        create the job, or mark it queued unless it is running or done - read and written in a transaction on the
+        job, retried if a worker wrote it meanwhile.
+
+        :return: the current state of the job.
+        """
+        key = self.KEY_PREFIX + job_id
+        serializer = self.redis_service.serializer
+
+        with timed("redis", "scan_job_queue"), self.redis_service.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    data = pipe.get(key)
+                    job = None if data is None else serializer.loads(data)
+                    if job is not None and job["status"] in (self.RUNNING, self.DONE):
+                        pipe.unwatch()
+                        return job
+
+                    if job is None:
+                        job = {"job_id": job_id, "s3_link": s3_link, "fingerprint": fingerprint,
+                               "status": self.QUEUED, "offset": 0, "fieldnames": None,
+                               "total_bytes": None, "rows_processed": 0, "batches_applied": 0, "errors": [],
+                               "created_at": time.time(), "run_started_at": None, "run_start_offset": 0,
+                               "run_rows": 0, "updated_at": time.time(), "finished_at": None, "timings": {}}
+                    else:
+                        job["status"] = self.QUEUED
+
+                    pipe.multi()
+                    pipe.set(key, serializer.dumps(job), ex=self.job_ttl)
+                    pipe.execute()
+                    return job
+
+                except redis.WatchError:
+                    continue
+
+    def get_job(self, job_id):
+        """
+        :return: the stored state of the job, None if it does not exist.
+        """
+        return self.redis_service.get_object(self.KEY_PREFIX + job_id)
+
+    def get_progress(self, job_id):
+        """
+        :return: the progress of the job (see progress), None if it does not exist.
+        """
+        job = self.get_job(job_id)
+        return None if job is None else self.progress(job)
+
+    def progress(self, job):
+        """
+        :return: dict with the status, counters, rows/sec and ETA (seconds, None if unknown) of the job.
+        """
+        elapsed = (job["finished_at"] or job["updated_at"]) - (job["run_started_at"] or job["updated_at"])
+        rows_per_sec = job["run_rows"] / elapsed if elapsed > 0 else 0.0
+
+        eta = None
+        if job["status"] == self.DONE:
+            eta = 0
+        elif job["total_bytes"] and elapsed > 0 and job["offset"] > job["run_start_offset"]:
+            bytes_per_sec = (job["offset"] - job["run_start_offset"]) / elapsed
+            eta = round((job["total_bytes"] - job["offset"]) / bytes_per_sec, 1)
+
+        return {"job_id": job["job_id"], "s3_link": job["s3_link"], "fingerprint": job["fingerprint"],
+                "status": job["status"],
+                "rows_processed": job["rows_processed"], "batches_applied": job["batches_applied"],
+                "bytes_processed": job["offset"], "total_bytes": job["total_bytes"],
+                "rows_per_sec": round(rows_per_sec, 1), "eta_seconds": eta, "errors": job["errors"],
+                "timings": job.get("timings", {})}
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    def _run(self, job_id):
+        try:
+            token = self._acquire_lock(job_id)
+            if token is None:
+                # another worker is running this job.
+                return
+
+            try:
+                self._process(self.get_job(job_id), token)
+            finally:
+                self._release_lock(job_id, token)
+
+        except LockLost:
+            logger.warning("scan job %s: the lock expired and was taken by another worker, stopping.", job_id)
+
+        except Exception:
+            logger.exception("scan job %s failed.", job_id)
+
+        finally:
+            with self._queued_lock:
+                self._queued.discard(job_id)
+
+    def _process(self, job, token):
+        # the time spent per component (s3, dynamodb, redis) and per stage of the current run, in the job state.
+        with collect_timings():
+            self._process_batches(job, token)
+        logger.info("scan job %s %s after %s rows: %s", job["job_id"], job["status"], job["run_rows"],
+                    job["timings"])
+
+    def _process_batches(self, job, token):
+        job.update(status=self.RUNNING, run_started_at=time.time(), run_start_offset=job["offset"], run_rows=0,
+                   updated_at=time.time(), timings={})
+        self._save(job, token)
+        timings = current_timings()
+
+        try:
+            size = (job["fingerprint"] or {}).get("content_length")
+            if self.parallel_workers > 1 and size and size - job["offset"] >= self.parallel_min_bytes:
+                self._process_file(job, token, timings)
+            else:
+                self._process_stream(job, token, timings)
+
+        except LockLost:
+            raise
+
+        except Exception as e:
+            logger.warning("scan job %s stopped at byte %s: %s", job["job_id"], job["offset"], e)
+            job["errors"] = (job["errors"] + [f"byte {job['offset']}: {e}"])[-self.MAX_ERRORS:]
+            job.update(status=self.FAILED, updated_at=time.time(), timings=timings_summary(timings))
+            self._save(job, token)
+            return
+
+        job.update(status=self.DONE, updated_at=time.time(), finished_at=time.time(),
+                   timings=timings_summary(timings))
+        self._save(job, token, ex=self.versioned_done_job_ttl if job["fingerprint"] else self.done_job_ttl)
+
+    def _process_stream(self, job, token, timings):
+        etag = (job["fingerprint"] or {}).get("etag")
+        stream = self.open_stream(job["s3_link"], start_offset=job["offset"], fieldnames=job["fieldnames"],
+                                  if_match=etag)
+        job["total_bytes"] = stream.total_bytes or job["total_bytes"]
+        rows = iter(stream)
+
+        while True:
+            # reading a batch is the S3 download (s3 read_stream) and the csv parsing.
+            with timed("scan_job", "read_batch"):
+                batch = list(islice(rows, self.batch_size))
+            if not batch:
+                break
+
+            with timed("scan_job", "apply_batch"):
+                self.user_service.update_users_from_csv(batch)
+
+            job["fieldnames"] = stream.fieldnames
+            self._checkpoint(job, token, timings, stream.offset, len(batch))
+
+    def _process_file(self, job, token, timings):
+        """
+        download the rest of the file and parse it in parallel, one window at a time.
+        """
+        etag = (job["fingerprint"] or {}).get("etag")
+        job["total_bytes"] = job["fingerprint"]["content_length"]
+
+        with tempfile.TemporaryDirectory(dir=self.tmp_dir) as directory:
+            path = os.path.join(directory, "scan.csv")
+            with timed("scan_job", "download"):
+                self.download(job["s3_link"], path, start_offset=job["offset"], if_match=etag)
+
+            # offsets in the downloaded file are relative to the offset of the job.
+            base, start = job["offset"], 0
+            if not job["fieldnames"]:
+                job["fieldnames"], start = read_csv_header(path)
+                if job["fieldnames"] is None:
+                    return
+
+            windows = iter_folded_windows(path, job["fieldnames"], start, self.parallel_window_bytes,
+                                          workers=self.parallel_workers)
+            while True:
+                with timed("scan_job", "read_batch"):
+                    window = next(windows, None)
+                if window is None:
+                    break
+
+                end, rows, folded_events = window
+                with timed("scan_job", "apply_batch"):
+                    self.user_service.apply_folded_events(folded_events)
+
+                self._checkpoint(job, token, timings, base + end, rows)
+
+    def _checkpoint(self, job, token, timings, offset, rows):
+        """
+        save the progress of the job after a batch of rows was applied - the checkpoint also extends the lock.
+        """
+        job["offset"] = offset
+        job["rows_processed"] += rows
+        job["run_rows"] += rows
+        job["batches_applied"] += 1
+        job["updated_at"] = time.time()
+        job["timings"] = timings_summary(timings)
+        self._save(job, token)
+
+    def _save(self, job, token, ex=None):
+        """
+        write the job and extend its lock, in a transaction - only if the lock is still held by token.
+
+        :raise LockLost: if the lock expired and was taken by another worker.
+        """
+        data = self.redis_service.serializer.dumps(job)
+        job_id = job["job_id"]
+
+        def save(pipe):
+            pipe.set(self.KEY_PREFIX + job_id, data, ex=ex or self.job_ttl)
+            pipe.expire(self.LOCK_PREFIX + job_id, self.lock_timeout)
+
+        with timed("redis", "scan_job_save"):
+            self._while_locked(job_id, token, save)
+
+    def _acquire_lock(self, job_id):
+        token = uuid.uuid4().hex
+        acquired = self.redis_service.redis_client.set(self.LOCK_PREFIX + job_id, token, nx=True,
+                                                       ex=self.lock_timeout)
+        return token if acquired else None
+
+    def _while_locked(self, job_id, token, commands):
+        """
+        run commands(pipe) in a transaction, only if the lock of the job is held by token - the lock is watched, so
+        it cannot expire and be taken by another worker between the check and the transaction.
+
+        :raise LockLost: if the lock is not held by token.
+        """
+        lock_key = self.LOCK_PREFIX + job_id
+
+        with self.redis_service.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    pipe.watch(lock_key)
+                    if _text(pipe.get(lock_key)) != token:
+                        pipe.unwatch()
+                        raise LockLost(job_id)
+                    pipe.multi()
+                    commands(pipe)
+                    pipe.execute()
+                    return
+
+                except redis.WatchError:
+                    continue
+
+    def _release_lock(self, job_id, token):
+        """
+        delete the lock only if it is still ours (it may have expired and been taken by another worker).
+        """
+        lock_key = self.LOCK_PREFIX + job_id
+
+        with self.redis_service.pipeline(transaction=True) as pipe:
+            try:
+                pipe.watch(lock_key)
+                if _text(pipe.get(lock_key)) == token:
+                    pipe.multi()
+                    pipe.delete(lock_key)
+                    pipe.execute()
+            except redis.WatchError:
+                pass
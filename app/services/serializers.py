@@ -0,0 +1,99 @@
+import json
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# first byte of every encoded value, tells how the rest of the value was encoded.
+RAW = b"\x00"
+ZLIB = b"\x01"
+
+
+def dumps_json(value):
+    """
+    :return: compact JSON (bytes) of value - with orjson if the optional 'orjson' package is installed (several
+     times faster), else with the json module.
+    """
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(",", ":")).encode()
+
+
+def loads_json(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class JsonSerializer:
+    """
+    compact JSON (no spaces after separators).
+    """
+    def dumps(self, value):
+        return dumps_json(value)
+
+    def loads(self, data):
+        return loads_json(data)
+
+
+class MsgpackSerializer:
+    """
+    msgpack - smaller and faster than JSON. requires the optional 'msgpack' package.
+    """
+    def __init__(self):
+        try:
+            import msgpack
+        except ImportError:
+            raise ImportError("MsgpackSerializer requires the 'msgpack' package (pip install msgpack).")
+        self.msgpack = msgpack
+
+    def dumps(self, value):
+        return self.msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, data):
+        return self.msgpack.unpackb(data, raw=False)
+
+
+class CompressedSerializer:
+    """
+    wraps a serializer and compresses with zlib the values larger than `threshold` bytes.
+
+    every value is prefixed with one byte (RAW / ZLIB). values without a known prefix are legacy plain JSON values
+    (written before the codec existed) and are decoded as JSON.
+    """
+    def __init__(self, serializer=None, threshold=1024, level=6):
+        self.serializer = serializer or JsonSerializer()
+        self.threshold = threshold
+        self.level = level
+
+    def dumps(self, value):
+        data = self.serializer.dumps(value)
+        if self.threshold is not None and len(data) > self.threshold:
+            return ZLIB + zlib.compress(data, self.level)
+        return RAW + data
+
+    def loads(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+
+        prefix, payload = data[:1], data[1:]
+        if prefix == ZLIB:
+            return self.serializer.loads(zlib.decompress(payload))
+        if prefix == RAW:
+            return self.serializer.loads(payload)
+        return json.loads(data)
+
+
+def get_serializer(name="json", compress_threshold=1024):
+    """
+    :param name: 'json' or 'msgpack'.
+    :param compress_threshold: values larger than this (bytes) are zlib compressed, None to disable compression.
+    :return: serializer for RedisService.
+    """
+    serializers = {"json": JsonSerializer, "msgpack": MsgpackSerializer}
+    if name not in serializers:
+        raise ValueError(f"unknown serializer '{name}', expected one of {list(serializers)}.")
+
+    return CompressedSerializer(serializers[name](), threshold=compress_threshold)
@@ -0,0 +1,95 @@
+"""
+batch conversions between epoch seconds and the ISO strings stored in the users table.
+
+the batch functions convert a whole list in one call with NumPy datetime64 when the optional 'numpy' package is
+installed, and fall back to one datetime call per item otherwise. both paths give exactly the same results, and
+the same strings as the scalar epoch_to_iso.
+"""
+import calendar
+import re
+from datetime import datetime, timezone
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# suffix of the lastLogin / passwordChanged values: datetime.fromtimestamp(epoch, tz=timezone.utc).isoformat() + "Z".
+UTC_SUFFIX = "+00:00Z"
+
+# epochs of 0001-01-01T00:00:00 and 9999-12-31T23:59:59 - datetime raises outside of them.
+MIN_EPOCH = -62135596800
+MAX_EPOCH = 253402300799
+
+# epoch of the empty timestamps in the int64 columns - the smallest int64, like NumPy NaT.
+MISSING_EPOCH = -2 ** 63
+
+# Okta timestamps, e.g. '2025-03-01T10:00:00.000Z'.
+OKTA_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+# layouts read by to_epoch_seconds.
+LAYOUT = re.compile(r"\d{4}-\d{2}-\d{2}(T\d{2}:\d{2}:\d{2}(\.\d{3}Z|\+00:00Z))?")
+
+
+def epoch_to_iso(epoch, utc=False):
+    """
+    :param epoch: epoch seconds (int).
+    :param utc: if True, the format of the lastLogin / passwordChanged fields ('2025-03-01T10:00:00+00:00Z'),
+     else the format of the user_events timestamps ('2025-03-01T10:00:00').
+    :return: the ISO string of the epoch.
+    """
+    value = datetime.fromtimestamp(epoch, tz=timezone.utc)
+    if utc:
+        return value.isoformat() + "Z"
+    return value.replace(tzinfo=None).isoformat()
+
+
+def epochs_to_iso(epochs, utc=False):
+    """
+    :param epochs: list of epoch seconds (ints).
+    :param utc: see epoch_to_iso.
+    :return: list of the ISO strings of the epochs, same as [epoch_to_iso(epoch, utc) for epoch in epochs].
+    """
+    if np is None or not epochs:
+        return [epoch_to_iso(epoch, utc) for epoch in epochs]
+
+    values = np.asarray(epochs, dtype=np.int64)
+    if values.min() < MIN_EPOCH or values.max() > MAX_EPOCH:
+        # let datetime raise, like the scalar conversion.
+        return [epoch_to_iso(epoch, utc) for epoch in epochs]
+
+    strings = np.datetime_as_string(values.astype("datetime64[s]"), unit="s")
+    if utc:
+        strings = np.char.add(strings, UTC_SUFFIX)
+    return strings.tolist()
+
+
+def to_epoch_seconds(dates, missing=MISSING_EPOCH):
+    """
+    :param dates: list of timestamps in any of the layouts of the users table - Okta ('2025-03-01T10:00:00.000Z'),
+     csv ingestion ('2025-03-01T10:00:00+00:00Z', see epoch_to_iso) or a date ('2025-03-01'), all in UTC.
+    :param missing: value of the empty (or unreadable) timestamps - any other layout is unreadable.
+    :return: list of epoch seconds (ints).
+    """
+    # the layouts share their first 19 characters, the rest is the milliseconds or the UTC suffix. NumPy and
+    # fromisoformat read more layouts (e.g. '2020', or offsets) - the others are missing for both paths.
+    prefixes = [date[:19] if date and LAYOUT.fullmatch(date) else "" for date in dates]
+    if np is not None and prefixes:
+        try:
+            epochs = np.array(prefixes, dtype="datetime64[s]").astype(np.int64)
+        except ValueError:
+            # an impossible date (e.g. '2025-02-30') - parse them one by one.
+            pass
+        else:
+            # year 0 is read by NumPy, not by datetime.
+            epochs[epochs < MIN_EPOCH] = missing
+            return epochs.tolist()
+    return [_to_epoch_seconds(prefix, missing) for prefix in prefixes]
+
+
+def _to_epoch_seconds(prefix, missing):
+    try:
+        value = datetime.fromisoformat(prefix)
+    except ValueError:
+        return missing
+    return calendar.timegm(value.timetuple())
@@ -0,0 +1,239 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from app.services.metrics import cache_lookup
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class LocalCache:
+    """
+    in-process bounded LRU cache with a TTL per entry. thread safe.
+    """
+    def __init__(self, max_size=10000, ttl=30):
+        """
+        :param max_size: max number of entries, the least recently used entries are evicted above it.
+        :param ttl: max seconds an entry is kept.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+
+            if entry is not _MISSING and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+            if entry is not _MISSING:
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class TwoTierCache:
+    """
+    The TwoTierCache class puts a LocalCache (L1) in front of RedisService (L2) for hot keys.
+
+    invalidations delete the keys from Redis and are broadcast to all the workers over Redis pub/sub, so every
+    worker evicts them from its L1. if the pub/sub listener is down, L1 entries still expire after the L1 ttl.
+    """
+    CHANNEL = "cache:invalidate"
+
+    # max number of keys deleted / published in one invalidation message.
+    INVALIDATION_CHUNK_SIZE = 1000
+
+    def __init__(self, redis_service, local_cache=None, channel=CHANNEL, listener_retry_interval=30,
+                 async_redis_service=None):
+        """
+        :param redis_service: RedisService (L2), also used for the invalidation listener.
+        :param local_cache: LocalCache (L1).
+        :param async_redis_service: AsyncRedisService used by the async methods (aget_object, aset_object).
+        """
+        self.redis_service = redis_service
+        self.async_redis_service = async_redis_service
+        self.local_cache = local_cache or LocalCache()
+        self.channel = channel
+        self.listener_retry_interval = listener_retry_interval
+        self.l2_hits = 0
+        self.l2_misses = 0
+        self._listener = None
+        self._next_listener_attempt = 0
+        self._listener_starting = False
+        self._listener_lock = threading.Lock()
+
+    def get_object(self, key):
+        """
+        :return: the decoded value of key from L1, else from Redis (and keep it in L1), None if missing.
+        """
+        self.start_invalidation_listener()
+
+        value = self.local_cache.get(key, _MISSING)
+        if value is not _MISSING:
+            cache_lookup("l1", "hit")
+            return value
+        cache_lookup("l1", "miss")
+
+        value = self.redis_service.get_object(key)
+        if value is None:
+            self.l2_misses += 1
+            cache_lookup("l2", "miss")
+            return None
+
+        self.l2_hits += 1
+        cache_lookup("l2", "hit")
+        self.local_cache.set(key, value)
+        return value
+
+    def set_object(self, key, value, ex=None):
+        self.redis_service.set_object(key, value, ex=ex)
+        self.local_cache.set(key, value, ttl=ex)
+
+    async def aget_object(self, key):
+        """
+        asyncio version of get_object (L1 hits do not touch Redis at all).
+        """
+        if self._listener_start_due():
+            # subscribing is blocking - it runs in the threadpool, the read does not wait for it.
+            self._listener_starting = True
+            asyncio.get_running_loop().run_in_executor(None, self._start_listener_in_background)
+
+        value = self.local_cache.get(key, _MISSING)
+        if value is not _MISSING:
+            cache_lookup("l1", "hit")
+            return value
+        cache_lookup("l1", "miss")
+
+        value = await self.async_redis_service.get_object(key)
+        if value is None:
+            self.l2_misses += 1
+            cache_lookup("l2", "miss")
+            return None
+
+        self.l2_hits += 1
+        cache_lookup("l2", "hit")
+        self.local_cache.set(key, value)
+        return value
+
+    async def aset_object(self, key, value, ex=None):
+        await self.async_redis_service.set_object(key, value, ex=ex)
+        self.local_cache.set(key, value, ttl=ex)
+
+    def invalidate(self, *keys):
+        """
+        delete the keys from Redis and from the L1 of all the workers.
+        """
+        self.local_cache.delete(*keys)
+
+        for i in range(0, len(keys), self.INVALIDATION_CHUNK_SIZE):
+            chunk = keys[i:i + self.INVALIDATION_CHUNK_SIZE]
+            with self.redis_service.pipeline() as pipe:
+                pipe.delete(*chunk)
+                pipe.publish(self.channel, json.dumps(chunk))
+                pipe.execute()
+
+    def stats(self):
+        """
+        :return: hit and miss counters per tier.
+        """
+        return {
+            "l1": {"hits": self.local_cache.hits, "misses": self.local_cache.misses,
+                   "evictions": self.local_cache.evictions, "size": len(self.local_cache),
+                   "max_size": self.local_cache.max_size},
+            "l2": {"hits": self.l2_hits, "misses": self.l2_misses},
+        }
+
+    def start_invalidation_listener(self):
+        """
+        subscribe (in a background thread) to the invalidation channel. safe to call many times, a failed
+        subscription is retried after listener_retry_interval seconds.
+        """
+        if self._listener_alive():
+            return
+
+        with self._listener_lock:
+            if self._listener_alive() or time.monotonic() < self._next_listener_attempt:
+                return
+
+            try:
+                pubsub = self.redis_service.redis_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(**{self.channel: self._on_invalidate})
+                self._listener = pubsub.run_in_thread(sleep_time=1, daemon=True,
+                                                      exception_handler=self._on_listener_error)
+
+            except Exception as e:
+                logger.warning("failed to subscribe to %s, L1 entries expire by ttl only: %s", self.channel, e)
+                self._next_listener_attempt = time.monotonic() + self.listener_retry_interval
+
+    def _listener_alive(self):
+        return self._listener is not None and self._listener.is_alive()
+
+    def _listener_start_due(self):
+        """
+        :return: True if the listener is down and (re)subscribing may be attempted - at most one attempt at a time,
+         every listener_retry_interval seconds after a failed one.
+        """
+        return (not self._listener_starting and not self._listener_alive()
+                and time.monotonic() >= self._next_listener_attempt)
+
+    def _start_listener_in_background(self):
+        try:
+            self.start_invalidation_listener()
+        finally:
+            self._listener_starting = False
+
+    def stop_invalidation_listener(self):
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener.join(timeout=5)
+            self._listener = None
+
+    def _on_invalidate(self, message):
+        try:
+            keys = json.loads(message["data"])
+        except (ValueError, TypeError):
+            return
+        self.local_cache.delete(*keys)
+
+    def _on_listener_error(self, error, pubsub, thread):
+        # invalidations may have been missed - drop L1 and let the listener be restarted on the next call.
+        logger.warning("cache invalidation listener failed: %s", error)
+        self.local_cache.clear()
+        thread.stop()
+        pubsub.close()
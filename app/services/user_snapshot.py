@@ -0,0 +1,420 @@
+"""
+columnar in-memory snapshot of the users, for the analytical routes (/users/analytics/...) - a copy of the users
+view (see app.services.users_view) in each worker process, with one NumPy array per attribute instead of one
+object per user:
+ - the timestamps (lastLogin, passwordChanged, statusChanged): int64 epoch seconds, MISSING_EPOCH when empty.
+ - the low cardinality strings (admin): dictionary-encoded, int32 codes into the list of their distinct values.
+ - the emails and names: utf-8, packed in one buffer, with the offset (int64) and length (int32) of each value.
+ - email_hash: int64 hash of the email, to find the rows of the changed users without a per user index.
+that is 60 bytes per user plus its email and name, the filters and aggregations run vectorized over the columns.
+the user events are not part of the snapshot.
+
+refresh reads only the users changed since the last refresh (the changes stream of the view) - the whole view when
+the snapshot is empty, the view was rebuilt or the changes were trimmed meanwhile. with a path, the snapshot is
+saved after every full read and memory-mapped on startup (see open), so a new worker only reads the changes since.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from app.services.timestamps import MISSING_EPOCH, to_epoch_seconds, epochs_to_iso
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+
+def email_hash(email):
+    """
+    :return: stable 64 bits hash of the email (the same in every process, unlike hash()).
+    """
+    return int.from_bytes(hashlib.blake2b(email.encode(), digest_size=8).digest(), "little", signed=True)
+
+
+class UserSnapshot:
+    TIMESTAMP_COLUMNS = ("lastLogin", "passwordChanged", "statusChanged")
+    DICTIONARY_COLUMNS = ("admin",)
+    STRING_COLUMNS = ("email", "name")
+
+    FILE_MAGIC = b"USERSNP1"
+    # offset of the arrays in the file.
+    ALIGNMENT = 64
+    # the strings buffer is compacted when most of it is values replaced since.
+    MIN_COMPACTION = 1 << 20
+
+    def __init__(self, path=None, max_age=1.0, capacity=1024):
+        """
+        :param path: file the snapshot is saved to after every full read of the view, None to only keep it in memory.
+        :param max_age: seconds during which a refresh is skipped after the last one.
+        :param capacity: number of users the columns are allocated for, doubled when full.
+        """
+        if np is None:
+            raise ImportError("UserSnapshot requires the 'numpy' package (pip install numpy).")
+        self.path = path
+        self.max_age = max_age
+        # build of the view and position of its changes stream the snapshot is up to date with.
+        self.build = None
+        self.position = None
+        self.refreshed_at = None
+        self.size = 0
+        self._columns = {name: np.empty(capacity, dtype=dtype) for name, dtype in self._dtypes().items()}
+        self._dictionaries = {name: [] for name in self.DICTIONARY_COLUMNS}
+        self._codes = {name: {} for name in self.DICTIONARY_COLUMNS}
+        self._strings = np.empty(capacity * 32, dtype=np.uint8)
+        self._strings_size = 0
+        # held by the queries and the writes - rows move when users are removed.
+        self._lock = threading.RLock()
+        self._refresh_lock = threading.Lock()
+
+    @classmethod
+    def _dtypes(cls):
+        dtypes = {"email_hash": np.int64}
+        dtypes.update((name, np.int64) for name in cls.TIMESTAMP_COLUMNS)
+        dtypes.update((name, np.int32) for name in cls.DICTIONARY_COLUMNS)
+        for name in cls.STRING_COLUMNS:
+            dtypes[f"{name}.start"] = np.int64
+            dtypes[f"{name}.length"] = np.int32
+        return dtypes
+
+    @property
+    def nbytes(self):
+        """
+        :return: bytes allocated by the columns and the strings buffer.
+        """
+        return sum(column.nbytes for column in self._columns.values()) + self._strings.nbytes
+
+    def refresh(self, users_view, max_age=None):
+        """
+        bring the snapshot up to date with the users view - skipped within max_age seconds of the last refresh.
+
+        :param users_view: UsersView to read.
+        :param max_age: overrides the max age of the snapshot.
+        :return: False if the view is not built yet (the snapshot is still empty), else True.
+        """
+        max_age = self.max_age if max_age is None else max_age
+        with self._refresh_lock:
+            if self.refreshed_at is not None and time.monotonic() - self.refreshed_at < max_age:
+                return True
+
+            changes = None if self.build is None else users_view.changes_since(self.build, self.position)
+            if changes is not None:
+                position, emails = changes
+                if emails:
+                    # the users may be newer than the position - the next refresh applies them again.
+                    self.apply(users_view.read_users(emails))
+                self.position = position
+            else:
+                view = users_view.read_all()
+                if view is None:
+                    return False
+                self.replace(*view)
+                if self.path:
+                    self.save(self.path)
+
+            self.refreshed_at = time.monotonic()
+            return True
+
+    def replace(self, build, position, users):
+        """
+        replace all the users of the snapshot - filled aside, queries keep reading the previous users meanwhile.
+
+        :param build: build of the view.
+        :param position: position of the changes stream of the view.
+        :param users: dict of {email: serialized user}.
+        """
+        snapshot = UserSnapshot(capacity=max(len(users), 1))
+        snapshot.apply(users)
+        with self._lock:
+            self.size = snapshot.size
+            self._columns = snapshot._columns
+            self._dictionaries = snapshot._dictionaries
+            self._codes = snapshot._codes
+            self._strings = snapshot._strings
+            self._strings_size = snapshot._strings_size
+            self.build = build
+            self.position = position
+
+    def apply(self, users):
+        """
+        :param users: dict of {email: serialized user (see serialize_raw_item), None for a removed user}.
+        """
+        removed = [email for email, user in users.items() if user is None]
+        changed = {email: user for email, user in users.items() if user is not None}
+
+        with self._lock:
+            # from the last row, so the last rows moved to the removed ones are never removed after.
+            for row in sorted(self._find(removed).values(), reverse=True):
+                self._remove(row)
+            if changed:
+                self._write(changed)
+            self._compact_strings()
+
+    def _write(self, users):
+        emails = list(users)
+        values = list(users.values())
+        hashes = [email_hash(email) for email in emails]
+        found = self._find(emails, hashes)
+        rows = np.fromiter((found.get(email, -1) for email in emails), dtype=np.int64, count=len(emails))
+
+        new = rows < 0
+        new_rows = int(np.count_nonzero(new))
+        self._reserve(self.size + new_rows)
+        rows[new] = np.arange(self.size, self.size + new_rows)
+        self.size += new_rows
+
+        columns = self._columns
+        columns["email_hash"][rows] = hashes
+        for name in self.TIMESTAMP_COLUMNS:
+            columns[name][rows] = to_epoch_seconds([user.get(name) for user in values])
+        for name in self.DICTIONARY_COLUMNS:
+            columns[name][rows] = self._encode(name, [str(user.get(name) or "") for user in values])
+        for name in self.STRING_COLUMNS:
+            starts, lengths = self._append_strings([user.get(name) or "" for user in values])
+            columns[f"{name}.start"][rows] = starts
+            columns[f"{name}.length"][rows] = lengths
+
+    def _find(self, emails, hashes=None):
+        """
+        :return: dict of {email: row} of the emails in the snapshot.
+        """
+        if not emails or not self.size:
+            return {}
+        if hashes is None:
+            hashes = [email_hash(email) for email in emails]
+        candidates = np.flatnonzero(np.isin(self._columns["email_hash"][:self.size], hashes))
+        # the rows with the same hash, checked with their email.
+        rows = {self._string("email", row): row for row in candidates.tolist()}
+        return {email: rows[email] for email in emails if email in rows}
+
+    def _remove(self, row):
+        last = self.size - 1
+        for column in self._columns.values():
+            column[row] = column[last]
+        self.size = last
+
+    def _reserve(self, size):
+        capacity = len(self._columns["email_hash"])
+        if size <= capacity:
+            return
+        capacity = max(size, capacity * 2)
+        for name, column in self._columns.items():
+            # also moves a memory-mapped column to memory.
+            resized = np.empty(capacity, dtype=column.dtype)
+            resized[:self.size] = column[:self.size]
+            self._columns[name] = resized
+
+    def _encode(self, name, values):
+        codes = self._codes[name]
+        dictionary = self._dictionaries[name]
+        for value in set(values).difference(codes):
+            codes[value] = len(dictionary)
+            dictionary.append(value)
+        return np.fromiter((codes[value] for value in values), dtype=np.int32, count=len(values))
+
+    def _append_strings(self, values):
+        encoded = [value.encode() for value in values]
+        lengths = np.fromiter(map(len, encoded), dtype=np.int32, count=len(encoded))
+        data = b"".join(encoded)
+
+        end = self._strings_size + len(data)
+        if end > len(self._strings):
+            strings = np.empty(max(end, len(self._strings) * 2), dtype=np.uint8)
+            strings[:self._strings_size] = self._strings[:self._strings_size]
+            self._strings = strings
+        self._strings[self._strings_size:end] = np.frombuffer(data, dtype=np.uint8)
+
+        starts = self._strings_size + np.cumsum(lengths, dtype=np.int64) - lengths
+        self._strings_size = end
+        return starts, lengths
+
+    def _compact_strings(self):
+        lengths = [self._columns[f"{name}.length"][:self.size] for name in self.STRING_COLUMNS]
+        used = sum(int(length.sum(dtype=np.int64)) for length in lengths)
+        if self._strings_size < self.MIN_COMPACTION or self._strings_size < 2 * used:
+            return
+
+        starts = np.concatenate([self._columns[f"{name}.start"][:self.size] for name in self.STRING_COLUMNS])
+        lengths = np.concatenate(lengths).astype(np.int64)
+        new_starts = np.cumsum(lengths) - lengths
+        # index of every byte of the values in the current buffer, in their new order.
+        strings = self._strings[np.repeat(starts - new_starts, lengths) + np.arange(used)]
+
+        for i, name in enumerate(self.STRING_COLUMNS):
+            self._columns[f"{name}.start"][:self.size] = new_starts[i * self.size:(i + 1) * self.size]
+        self._strings = strings
+        self._strings_size = used
+
+    def _string(self, name, row):
+        start = int(self._columns[f"{name}.start"][row])
+        return bytes(self._strings[start:start + int(self._columns[f"{name}.length"][row])]).decode()
+
+    def _column(self, name, names):
+        if name not in names:
+            raise ValueError(f"unknown column '{name}', expected one of {', '.join(names)}.")
+        return self._columns[name][:self.size]
+
+    def _mask(self, equals=None, before=None, since=None, missing=()):
+        """
+        :param equals: dict of {dictionary column: value} - the users with this value.
+        :param before: dict of {timestamp column: epoch} - the users with an earlier timestamp (not empty).
+        :param since: dict of {timestamp column: epoch} - the users with this timestamp or a later one.
+        :param missing: timestamp columns - the users with an empty timestamp.
+        :return: boolean array of the selected rows.
+        """
+        mask = np.ones(self.size, dtype=bool)
+        for name, value in (equals or {}).items():
+            codes = self._column(name, self.DICTIONARY_COLUMNS)
+            code = self._codes[name].get(value)
+            if code is None:
+                return np.zeros(self.size, dtype=bool)
+            mask &= codes == code
+        for name, epoch in (before or {}).items():
+            epochs = self._column(name, self.TIMESTAMP_COLUMNS)
+            mask &= (epochs < epoch) & (epochs != MISSING_EPOCH)
+        for name, epoch in (since or {}).items():
+            mask &= self._column(name, self.TIMESTAMP_COLUMNS) >= epoch
+        for name in missing:
+            mask &= self._column(name, self.TIMESTAMP_COLUMNS) == MISSING_EPOCH
+        return mask
+
+    def count(self, **filters):
+        """
+        :param filters: see _mask.
+        :return: number of selected users.
+        """
+        with self._lock:
+            return int(np.count_nonzero(self._mask(**filters)))
+
+    def count_by(self, name, **filters):
+        """
+        :param name: dictionary column.
+        :param filters: see _mask.
+        :return: dict of {value: number of selected users with this value}.
+        """
+        with self._lock:
+            codes = self._column(name, self.DICTIONARY_COLUMNS)[self._mask(**filters)]
+            counts = np.bincount(codes, minlength=len(self._dictionaries[name]))
+            return {value: int(count) for value, count in zip(self._dictionaries[name], counts.tolist()) if count}
+
+    def rows(self, limit=100, order_by=None, descending=False, **filters):
+        """
+        :param limit: maximum number of users returned.
+        :param order_by: timestamp column to sort the users by (the empty timestamps first), None for no order.
+        :param descending: sort from the latest timestamp.
+        :param filters: see _mask.
+        :return: list of the selected users - email, name, admin and the timestamps (ISO, "" when empty).
+        """
+        with self._lock:
+            rows = np.flatnonzero(self._mask(**filters))
+            if order_by is not None:
+                keys = self._column(order_by, self.TIMESTAMP_COLUMNS)[rows]
+                if limit < len(rows):
+                    # only the first rows are sorted.
+                    kth = len(rows) - limit if descending else limit - 1
+                    top = np.argpartition(keys, kth)
+                    top = top[kth:] if descending else top[:limit]
+                else:
+                    top = np.arange(len(rows))
+                order = top[np.argsort(keys[top], kind="stable")]
+                rows = rows[order[::-1] if descending else order]
+            return self._users(rows[:limit])
+
+    def _users(self, rows):
+        users = [{"email": self._string("email", row), "name": self._string("name", row)} for row in rows.tolist()]
+        for name in self.DICTIONARY_COLUMNS:
+            dictionary = self._dictionaries[name]
+            for user, code in zip(users, self._columns[name][rows].tolist()):
+                user[name] = dictionary[code]
+        for name in self.TIMESTAMP_COLUMNS:
+            epochs = self._columns[name][rows]
+            present = epochs != MISSING_EPOCH
+            dates = iter(epochs_to_iso(epochs[present].tolist(), utc=True))
+            for user, is_present in zip(users, present.tolist()):
+                user[name] = next(dates) if is_present else ""
+        return users
+
+    def save(self, path):
+        """
+        write the snapshot to a file (replaced atomically): a JSON header, then the arrays, each at an aligned
+        offset so they can be memory-mapped (see load).
+        """
+        with self._lock:
+            arrays = {name: column[:self.size] for name, column in self._columns.items()}
+            arrays["strings"] = self._strings[:self._strings_size]
+            offsets = {}
+            offset = 0
+            for name, array in arrays.items():
+                offsets[name] = [array.dtype.str, offset, len(array)]
+                offset = self._aligned(offset + array.nbytes)
+
+            header = json.dumps({"build": self.build, "position": self.position, "size": self.size,
+                                 "dictionaries": self._dictionaries, "arrays": offsets}).encode()
+            data_start = self._aligned(len(self.FILE_MAGIC) + 8 + len(header))
+
+            temporary_path = f"{path}.{os.getpid()}.tmp"
+            with open(temporary_path, "wb") as file:
+                file.write(self.FILE_MAGIC + len(header).to_bytes(8, "little") + header)
+                for name, array in arrays.items():
+                    file.seek(data_start + offsets[name][1])
+                    file.write(array.tobytes())
+            os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path, mmap=True, max_age=1.0):
+        """
+        :param path: file written by save.
+        :param mmap: map the arrays of the file (copy-on-write, the file is never changed) instead of reading them -
+         the pages are only read when used.
+        :return: the snapshot saved to the file, refreshed from the position of the view it was saved at.
+        """
+        with open(path, "rb") as file:
+            if file.read(len(cls.FILE_MAGIC)) != cls.FILE_MAGIC:
+                raise ValueError(f"{path} is not a user snapshot file.")
+            length = int.from_bytes(file.read(8), "little")
+            header = json.loads(file.read(length))
+        data_start = cls._aligned(len(cls.FILE_MAGIC) + 8 + length)
+
+        arrays = {}
+        for name, (dtype, offset, count) in header["arrays"].items():
+            if not count:
+                arrays[name] = np.empty(0, dtype=dtype)
+            elif mmap:
+                arrays[name] = np.memmap(path, dtype=dtype, mode="c", offset=data_start + offset, shape=(count,))
+            else:
+                arrays[name] = np.fromfile(path, dtype=dtype, count=count, offset=data_start + offset)
+
+        snapshot = cls(path=path, max_age=max_age, capacity=0)
+        if set(arrays) != set(snapshot._columns) | {"strings"}:
+            raise ValueError(f"{path} does not have the columns of this version.")
+        snapshot._strings = arrays.pop("strings")
+        snapshot._strings_size = len(snapshot._strings)
+        snapshot._columns = arrays
+        snapshot._dictionaries = header["dictionaries"]
+        snapshot._codes = {name: {value: code for code, value in enumerate(values)}
+                           for name, values in snapshot._dictionaries.items()}
+        snapshot.size = header["size"]
+        snapshot.build = header["build"]
+        snapshot.position = header["position"]
+        return snapshot
+
+    @classmethod
+    def open(cls, path=None, max_age=1.0):
+        """
+        :return: the snapshot saved to the path if there is one (see load), else an empty snapshot saved to it.
+        """
+        if path and os.path.exists(path):
+            try:
+                return cls.load(path, max_age=max_age)
+            except (OSError, ValueError) as e:
+                logger.warning("failed to load the user snapshot %s, reading the users view: %s", path, e)
+        return cls(path=path, max_age=max_age)
+
+    @classmethod
+    def _aligned(cls, offset):
+        return -(-offset // cls.ALIGNMENT) * cls.ALIGNMENT
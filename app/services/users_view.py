@@ -0,0 +1,398 @@
+"""
+materialized view of the users list of /users/results - the serialized users, kept in redis and updated by every
+write of UserRepository (its users_view), so the list is served without scanning DynamoDB.
+
+redis keys:
+ - users_view:users: hash of {email: user JSON} - the response is its values joined in email order.
+ - users_view:version: incremented in the transaction of every change of the hash.
+ - users_view:build: id of the build of the view, set once it was filled by a full scan (see build) - the view is
+   not served before. the build id and the version make the ETag of the response.
+ - users_view:changes: stream of the emails of every change, capped to its last CHANGES_MAX_LENGTH changes - the
+   copies of the view (see app.services.user_snapshot) read only the users changed since their last read.
+ - users_view:body: the ETag and the JSON body of the users list, rendered once per version for all the processes.
+
+every process keeps the response of the last version it read, so serving an unchanged view is a single MGET, and a
+new version is rendered by one request of one process - the others wait for it or read it from users_view:body.
+the view is only built in the background (see start_build), the request handlers never scan the table. the view
+can drift from the table (a failed redis update, writes of the same user from several processes applied out
+of order) - reconcile compares it with a full scan and fixes it, the reconcile job runs it periodically.
+"""
+import asyncio
+import logging
+import threading
+import uuid
+
+import redis
+
+from app.api.utils import serialize_okta_user, serialize_raw_item
+from app.services.metrics import timed
+from app.services.serializers import dumps_json, loads_json
+
+logger = logging.getLogger(__name__)
+
+
+def _text(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class UsersView:
+    USERS_KEY = "users_view:users"
+    VERSION_KEY = "users_view:version"
+    BUILD_KEY = "users_view:build"
+    CHANGES_KEY = "users_view:changes"
+    BODY_KEY = "users_view:body"
+    # one worker builds / reconciles the view at a time, and the periodic job runs once per interval.
+    LOCK_KEY = "lock:users_view"
+    JOB_KEY = "users_view:reconciled"
+
+    # number of users written to redis per round trip by build / reconcile.
+    CHUNK_SIZE = 1000
+    # approximate number of changes kept in the changes stream.
+    CHANGES_MAX_LENGTH = 10000
+
+    def __init__(self, redis_service, async_redis_service=None, lock_timeout=600, max_fix_attempts=3):
+        """
+        :param redis_service: RedisService holding the view, used by the writes.
+        :param async_redis_service: AsyncRedisService used by aget (the async request handlers).
+        :param lock_timeout: seconds after which the lock of a build / reconciliation expires (if its worker died).
+        :param max_fix_attempts: how many times reconcile retries its fixes when the view changes meanwhile.
+        """
+        self.redis_service = redis_service
+        self.async_redis_service = async_redis_service
+        self.lock_timeout = lock_timeout
+        self.max_fix_attempts = max_fix_attempts
+        # (etag, response body) of the last version read by this process.
+        self._response = None
+        # {etag: task rendering the response of that version}, shared by the concurrent requests.
+        self._renders = {}
+        self._stopped = threading.Event()
+        self._job = None
+        self._builder = None
+        self._builder_lock = threading.Lock()
+
+    def apply(self, users):
+        """
+        write the users to the view, in one transaction with a new version.
+
+        :param users: dict of {email: serialized user (see serialize_raw_item), None to remove the user}.
+        """
+        with timed("redis", "users_view_apply"), self.redis_service.pipeline(transaction=True) as pipe:
+            self._write(pipe, users)
+            pipe.incr(self.VERSION_KEY)
+            pipe.execute()
+
+    def _write(self, pipe, users):
+        changed = {email: dumps_json(user) for email, user in users.items() if user is not None}
+        removed = [email for email, user in users.items() if user is None]
+        if changed:
+            pipe.hset(self.USERS_KEY, mapping=changed)
+        if removed:
+            pipe.hdel(self.USERS_KEY, *removed)
+        if users:
+            pipe.xadd(self.CHANGES_KEY, {"emails": "\n".join(users)}, maxlen=self.CHANGES_MAX_LENGTH,
+                      approximate=True)
+
+    def read_all(self):
+        """
+        :return: tuple of (build, position, {email: user}) - the whole view with the position of the changes stream
+         it is up to date with, None if the view is not built.
+        """
+        with timed("redis", "users_view_read"), self.redis_service.pipeline(transaction=True) as pipe:
+            pipe.get(self.BUILD_KEY)
+            pipe.xrevrange(self.CHANGES_KEY, count=1)
+            pipe.hgetall(self.USERS_KEY)
+            build, last_change, users = pipe.execute()
+
+        if build is None or not last_change:
+            return None
+        return (_text(build), _text(last_change[0][0]),
+                {_text(email): loads_json(value) for email, value in users.items()})
+
+    def changes_since(self, build, position):
+        """
+        :param build: build of the view the position is from.
+        :param position: position returned by read_all / changes_since.
+        :return: tuple of (position, emails changed after the given position), None if the view was rebuilt or the
+         stream was trimmed past the position since - read_all is needed then.
+        """
+        with timed("redis", "users_view_changes"), self.redis_service.pipeline(transaction=True) as pipe:
+            pipe.get(self.BUILD_KEY)
+            pipe.xrange(self.CHANGES_KEY, min=position)
+            current_build, changes = pipe.execute()
+
+        # the change at the position itself is still in the stream - none after it was trimmed.
+        if _text(current_build) != build or not changes or _text(changes[0][0]) != position:
+            return None
+
+        emails = set()
+        for _, fields in changes[1:]:
+            emails.update(_text(fields[b"emails"]).split("\n"))
+        emails.discard("")
+        return _text(changes[-1][0]), emails
+
+    def read_users(self, emails):
+        """
+        :return: dict of {email: user, None if the user is not in the view}.
+        """
+        emails = list(emails)
+        with timed("redis", "users_view_read"):
+            values = self.redis_service.redis_client.hmget(self.USERS_KEY, emails)
+        return {email: None if value is None else loads_json(value) for email, value in zip(emails, values)}
+
+    async def aget(self):
+        """
+        :return: tuple of (etag, JSON body of the users list) of the current version, None if the view is not built.
+        """
+        client = self.async_redis_service.redis_client
+        with timed("redis", "users_view_version"):
+            build, version = await client.mget([self.BUILD_KEY, self.VERSION_KEY])
+        if build is None:
+            return None
+
+        etag = self._etag(build, version)
+        response = self._response
+        if response is not None and response[0] == etag:
+            return response
+
+        render = self._renders.get(etag)
+        if render is None:
+            render = self._renders[etag] = asyncio.ensure_future(self._render(etag))
+            render.add_done_callback(lambda _: self._renders.pop(etag, None))
+        # shielded - a cancelled request does not cancel the render the other requests wait for.
+        response = await asyncio.shield(render)
+        if response is not None:
+            self._response = response
+        return response
+
+    @property
+    def last_response(self):
+        """
+        :return: tuple of (etag, body) of the last version read by this process (see aget), None if there is none.
+        """
+        return self._response
+
+    async def _render(self, etag):
+        """
+        :return: tuple of (etag, body) of the current version - the body rendered by another process for etag, or
+         rendered from the users and shared with the other processes. None if the view is not built.
+        """
+        client = self.async_redis_service.redis_client
+        with timed("redis", "users_view_body"):
+            cached = await client.get(self.BODY_KEY)
+        if cached is not None:
+            cached_etag, _, body = cached.partition(b"\n")
+            if _text(cached_etag) == etag:
+                return etag, body
+
+        # the users and their version, read together.
+        with timed("redis", "users_view_read"):
+            async with self.async_redis_service.pipeline(transaction=True) as pipe:
+                pipe.mget([self.BUILD_KEY, self.VERSION_KEY])
+                pipe.hgetall(self.USERS_KEY)
+                (build, version), users = await pipe.execute()
+        if build is None:
+            return None
+
+        etag, body = self._etag(build, version), self._body(users)
+        with timed("redis", "users_view_body"):
+            await client.set(self.BODY_KEY, etag.encode() + b"\n" + body)
+        return etag, body
+
+    @staticmethod
+    def _etag(build, version):
+        return f'"{_text(build)}-{int(version or 0)}"'
+
+    @staticmethod
+    def _body(users):
+        # the users JSON are joined as they are, without decoding them.
+        return b"[" + b",".join(users[email] for email in sorted(users)) + b"]"
+
+    def build(self, user_repository, total_segments=1):
+        """
+        fill the view from a full scan of the users table.
+
+        the hash is emptied first, then the scanned users are only added if they are not in it: a user found in
+        the hash was written during the scan, and its view is at least as recent as the scanned one.
+
+        :param user_repository: UserRepository of the users table.
+        :param total_segments: number of segments scanned in parallel.
+        :return: number of users in the view, None if another worker is building or reconciling it.
+        """
+        token = self._acquire_lock()
+        if token is None:
+            return None
+
+        try:
+            client = self.redis_service.redis_client
+            client.delete(self.BUILD_KEY, self.USERS_KEY, self.BODY_KEY)
+
+            chunk = []
+            for item in user_repository.iter_scan(total_segments=total_segments, raw=True):
+                chunk.append(item)
+                if len(chunk) >= self.CHUNK_SIZE:
+                    self._add_missing(user_repository, chunk)
+                    chunk = []
+            self._add_missing(user_repository, chunk)
+
+            with self.redis_service.pipeline(transaction=True) as pipe:
+                pipe.set(self.BUILD_KEY, uuid.uuid4().hex[:12])
+                pipe.incr(self.VERSION_KEY)
+                # the first position of the changes of this build.
+                pipe.xadd(self.CHANGES_KEY, {"emails": ""}, maxlen=self.CHANGES_MAX_LENGTH, approximate=True)
+                pipe.hlen(self.USERS_KEY)
+                users = pipe.execute()[-1]
+
+            logger.info("users view built with %d users.", users)
+            return users
+        finally:
+            self._release_lock(token)
+
+    def start_build(self, user_repository, total_segments=1):
+        """
+        build the view in a background thread, unless this process is already building it - the lock of build
+        keeps the other processes out.
+
+        :return: the thread building the view.
+        """
+        with self._builder_lock:
+            if self._builder is None or not self._builder.is_alive():
+                self._builder = threading.Thread(target=self._build_in_background,
+                                                 args=(user_repository, total_segments), name="users-view-build",
+                                                 daemon=True)
+                self._builder.start()
+            return self._builder
+
+    def _build_in_background(self, user_repository, total_segments):
+        try:
+            self.build(user_repository, total_segments)
+        except Exception as e:
+            logger.warning("users view build failed: %s", e)
+
+    def _add_missing(self, user_repository, items):
+        model = user_repository.okta_user_model
+        with self.redis_service.pipeline() as pipe:
+            for item in items:
+                user = serialize_raw_item(model, item)
+                pipe.hsetnx(self.USERS_KEY, user["email"], dumps_json(user))
+            pipe.execute()
+
+    def reconcile(self, user_repository, total_segments=1):
+        """
+        compare the view with a full (parallel) scan of the users table, and fix the users that differ.
+
+        a user may differ because the scan read it before a write the view already has - the users that differ
+        are read again (consistent read), and a fix is dropped if a writer updated the user in the view meanwhile
+        (its value is newer).
+
+        :param user_repository: UserRepository of the users table.
+        :param total_segments: number of segments scanned in parallel.
+        :return: dict of {"users", "missing", "stale", "extra", "fixed"} counts, None if another worker holds the
+         lock. a view that is not built yet is built instead.
+        """
+        if self.redis_service.redis_client.get(self.BUILD_KEY) is None:
+            users = self.build(user_repository, total_segments)
+            return None if users is None else {"users": users, "missing": users, "stale": 0, "extra": 0,
+                                               "fixed": users}
+
+        token = self._acquire_lock()
+        if token is None:
+            return None
+
+        try:
+            model = user_repository.okta_user_model
+            scanned = {}
+            for item in user_repository.iter_scan(total_segments=total_segments, raw=True):
+                user = serialize_raw_item(model, item)
+                scanned[user["email"]] = user
+
+            # read after the scan, so it has the writes made during the scan.
+            view = {_text(email): value for email, value in
+                    self.redis_service.redis_client.hgetall(self.USERS_KEY).items()}
+
+            missing = [email for email in scanned if email not in view]
+            stale = [email for email in scanned if email in view and loads_json(view[email]) != scanned[email]]
+            extra = [email for email in view if email not in scanned]
+
+            fixed = 0
+            emails = missing + stale + extra
+            for start in range(0, len(emails), self.CHUNK_SIZE):
+                fixed += self._fix(user_repository, emails[start:start + self.CHUNK_SIZE], view)
+
+            report = {"users": len(scanned), "missing": len(missing), "stale": len(stale), "extra": len(extra),
+                      "fixed": fixed}
+            log = logger.warning if fixed else logger.info
+            log("users view reconciled: %(users)d users, %(missing)d missing, %(stale)d stale, %(extra)d extra, "
+                "%(fixed)d fixed.", report)
+            return report
+        finally:
+            self._release_lock(token)
+
+    def _fix(self, user_repository, emails, view):
+        """
+        :param view: {email: user JSON} the differences were found in.
+        :return: number of users fixed.
+        """
+        users = dict.fromkeys(emails)
+        users.update({user.email: serialize_okta_user(user)
+                      for user in user_repository.get_users_by_email(emails, consistent_read=True)})
+
+        for _ in range(self.max_fix_attempts):
+            with self.redis_service.pipeline(transaction=True) as pipe:
+                try:
+                    pipe.watch(self.USERS_KEY)
+                    current = dict(zip(emails, pipe.hmget(self.USERS_KEY, emails)))
+                    # the users written since the view was read are left to their writers.
+                    fixes = {email: user for email, user in users.items() if current[email] == view.get(email)}
+                    pipe.multi()
+                    self._write(pipe, fixes)
+                    pipe.incr(self.VERSION_KEY)
+                    pipe.execute()
+                    return len(fixes)
+                except redis.WatchError:
+                    continue
+
+        logger.warning("users view: gave up fixing %d users, the view kept changing.", len(emails))
+        return 0
+
+    def start_reconcile_job(self, user_repository, interval, total_segments=1):
+        """
+        reconcile the view every `interval` seconds in a background thread - in one of the workers sharing the
+        view per interval. safe to call many times.
+        """
+        if self._job is not None:
+            return
+        self._job = threading.Thread(target=self._reconcile_periodically, args=(user_repository, interval,
+                                                                                 total_segments),
+                                     name="users-view-reconcile", daemon=True)
+        self._job.start()
+
+    def stop_reconcile_job(self):
+        self._stopped.set()
+
+    def _reconcile_periodically(self, user_repository, interval, total_segments):
+        while not self._stopped.wait(interval):
+            try:
+                # the first worker of the interval runs it.
+                if self.redis_service.redis_client.set(self.JOB_KEY, uuid.uuid4().hex, nx=True, ex=interval):
+                    self.reconcile(user_repository, total_segments)
+            except Exception as e:
+                logger.warning("users view reconciliation failed: %s", e)
+
+    def _acquire_lock(self):
+        token = uuid.uuid4().hex
+        acquired = self.redis_service.redis_client.set(self.LOCK_KEY, token, nx=True, ex=self.lock_timeout)
+        return token if acquired else None
+
+    def _release_lock(self, token):
+        """
+        delete the lock only if it is still ours (it may have expired and been taken by another worker).
+        """
+        with self.redis_service.pipeline(transaction=True) as pipe:
+            try:
+                pipe.watch(self.LOCK_KEY)
+                if _text(pipe.get(self.LOCK_KEY)) == token:
+                    pipe.multi()
+                    pipe.delete(self.LOCK_KEY)
+                    pipe.execute()
+            except redis.WatchError:
+                pass
@@ -0,0 +1,224 @@
+"""
+concurrent DynamoDB writes, sharded by key.
+
+the keys (emails) are hashed to a fixed number of writer threads. every writer has a bounded queue and runs its
+writes one at a time, in submission order - so all the writes of a key are applied in order, by the same writer.
+every writer can be limited by a token bucket (its share of the table write capacity), throttled writes are
+retried with exponential backoff and halve the writer rate, which then grows back while the writes succeed.
+"""
+import contextvars
+import logging
+import queue
+import random
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# DynamoDB error codes of a throttled request.
+THROTTLING_ERRORS = frozenset({"ProvisionedThroughputExceededException", "ThrottlingException",
+                               "RequestLimitExceeded"})
+
+
+def error_code(error):
+    """
+    :return: the DynamoDB error code of a PynamoDB / botocore exception, None for other exceptions.
+    """
+    code = getattr(error, "cause_response_code", None)
+    if code is None and hasattr(error, "response"):
+        code = error.response.get("Error", {}).get("Code")
+    return code
+
+
+class TokenBucket:
+    """
+    rate limiter - up to `capacity` operations at once, refilled at `rate` operations per second.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        """
+        :param rate: operations per second.
+        :param capacity: max burst (default: one second of operations).
+        :param clock: monotonic clock (seconds).
+        :param sleep: function used to wait for tokens.
+        """
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated_at = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        take one token, wait until one is available.
+
+        :return: seconds waited.
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+
+                # tolerate the rounding of the refill, a wait of ~0 seconds would not move the clock.
+                if self.tokens >= 1 - 1e-9:
+                    self.tokens = max(0.0, self.tokens - 1)
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+
+            self.sleep(wait)
+            waited += wait
+
+
+class WriteScheduler:
+    """
+    runs write functions on `workers` writer threads, sharded by key (see the module docstring).
+
+    usage:
+        with WriteScheduler(workers=8, writes_per_second=400) as scheduler:
+            for email, user_events in folded_events.items():
+                scheduler.submit(email, write_user, email, user_events)
+        scheduler.results, scheduler.failures, scheduler.stats()
+    """
+    # queued to stop a writer.
+    _stop = object()
+
+    def __init__(self, workers=4, max_pending=100, writes_per_second=None, max_retries=8, backoff_base=0.05,
+                 max_backoff=5.0, min_rate_ratio=0.05):
+        """
+        :param workers: number of writer threads.
+        :param max_pending: max number of writes queued per writer - submit blocks when the queue is full.
+        :param writes_per_second: total write rate of all the writers (None for no limit), split evenly between
+         them since the keys are evenly sharded.
+        :param max_retries: how many times a throttled write is retried before it fails.
+        :param backoff_base: base delay (seconds) of the exponential backoff of a throttled write.
+        :param max_backoff: max delay (seconds) between two attempts.
+        :param min_rate_ratio: the adaptive rate of a writer never goes below this ratio of its configured rate.
+        """
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.max_backoff = max_backoff
+        self.writer_rate = writes_per_second / workers if writes_per_second else None
+        self.min_writer_rate = self.writer_rate * min_rate_ratio if self.writer_rate else None
+
+        self.queues = [queue.Queue(maxsize=max_pending) for _ in range(workers)]
+        self.buckets = [TokenBucket(self.writer_rate) if self.writer_rate else None for _ in range(workers)]
+        self.threads = []
+
+        # {key: result of its last write}, {key: exception of its failed write}.
+        self.results = {}
+        self.failures = {}
+        self.counters = {"writes": 0, "failed": 0, "throttles": 0}
+        self.lock = threading.Lock()
+        self.started_at = None
+        self.finished_at = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def start(self):
+        self.started_at = time.monotonic()
+        self.threads = [threading.Thread(target=self._writer, args=(shard,), name=f"dynamodb-writer-{shard}",
+                                         daemon=True) for shard in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, key, func, *args):
+        """
+        queue func(*args), after all the writes already submitted with the same key.
+
+        :param key: sharding key (e.g. the email of the user).
+        """
+        if not self.threads:
+            self.start()
+        # run in the context of the submitter, so the writes are counted in its timings (see app.services.metrics).
+        self.queues[self.shard(key)].put((key, func, args, contextvars.copy_context()))
+
+    def shard(self, key):
+        # crc32 is stable across processes, unlike hash().
+        return zlib.crc32(key.encode()) % self.workers
+
+    def close(self):
+        """
+        wait until all the submitted writes are done, and stop the writers.
+
+        :return: the stats of the writes (see stats).
+        """
+        for shard_queue in self.queues:
+            shard_queue.put(self._stop)
+        for thread in self.threads:
+            thread.join()
+        self.finished_at = time.monotonic()
+        return self.stats()
+
+    def stats(self):
+        """
+        :return: dict of {"writes", "failed", "throttles", "seconds", "writes_per_sec"} - throttles counts the
+         throttled attempts (retried or not).
+        """
+        with self.lock:
+            stats = dict(self.counters)
+        elapsed = ((self.finished_at or time.monotonic()) - self.started_at) if self.started_at else 0.0
+        stats["seconds"] = round(elapsed, 3)
+        stats["writes_per_sec"] = round(stats["writes"] / elapsed, 1) if elapsed > 0 else 0.0
+        return stats
+
+    def _writer(self, shard):
+        shard_queue, bucket = self.queues[shard], self.buckets[shard]
+
+        while True:
+            item = shard_queue.get()
+            if item is self._stop:
+                return
+
+            key, func, args, context = item
+            attempt = 0
+
+            while True:
+                if bucket is not None:
+                    bucket.acquire()
+
+                try:
+                    result = context.run(func, *args)
+                except Exception as e:
+                    throttled = error_code(e) in THROTTLING_ERRORS
+                    if throttled:
+                        with self.lock:
+                            self.counters["throttles"] += 1
+
+                    if throttled and attempt < self.max_retries:
+                        attempt += 1
+                        self._slow_down(bucket)
+                        delay = min(self.max_backoff, self.backoff_base * 2 ** (attempt - 1))
+                        # jitter, so the throttled writers do not retry all together.
+                        time.sleep(delay * random.uniform(0.5, 1))
+                        continue
+
+                    logger.warning("write of %s failed: %s", key, e)
+                    with self.lock:
+                        self.failures[key] = e
+                        self.counters["failed"] += 1
+                    break
+
+                with self.lock:
+                    self.results[key] = result
+                    self.counters["writes"] += 1
+                self._speed_up(bucket)
+                break
+
+    def _slow_down(self, bucket):
+        if bucket is not None:
+            bucket.rate = max(self.min_writer_rate, bucket.rate / 2)
+
+    def _speed_up(self, bucket):
+        if bucket is not None and bucket.rate < self.writer_rate:
+            bucket.rate = min(self.writer_rate, bucket.rate + self.writer_rate * 0.05)
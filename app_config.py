@@ -1,7 +1,10 @@
-from dotenv import load_dotenv
 import os
 
-load_dotenv()
+# the .env file next to this file, if any - python-dotenv is only imported when there is one.
+ENV_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env")
+if os.path.isfile(ENV_FILE):
+    from dotenv import load_dotenv
+    load_dotenv(ENV_FILE)
 
 
 """   please insert your relevant values in these variables.  """
@@ -11,3 +14,51 @@ OKTA_API_TOKEN = os.getenv("OKTA_API_TOKEN")
 AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
 AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 OKTA_ADMIN_GROUP_ID = os.getenv("OKTA_ADMIN_GROUP_ID")
+
+# number of csv rows folded and written to DB together while streaming a scan file.
+CSV_BATCH_SIZE = int(os.getenv("CSV_BATCH_SIZE", 10000))
+
+# number of scan files processed concurrently in the background by each worker process.
+SCAN_JOB_WORKERS = int(os.getenv("SCAN_JOB_WORKERS", 2))
+
+# scan files with at least CSV_PARALLEL_MIN_BYTES left to read are downloaded to CSV_PARALLEL_TMP_DIR (empty for the
+# system temporary directory) and parsed by CSV_PARALLEL_WORKERS processes (0 for the number of cores, 1 to always
+# stream the files), CSV_PARALLEL_WINDOW_BYTES at a time.
+CSV_PARALLEL_WORKERS = int(os.getenv("CSV_PARALLEL_WORKERS", 0))
+CSV_PARALLEL_MIN_BYTES = int(os.getenv("CSV_PARALLEL_MIN_BYTES", 64 * 1024 * 1024))
+CSV_PARALLEL_WINDOW_BYTES = int(os.getenv("CSV_PARALLEL_WINDOW_BYTES", 64 * 1024 * 1024))
+CSV_PARALLEL_TMP_DIR = os.getenv("CSV_PARALLEL_TMP_DIR", "")
+
+# seconds between two full Okta syncs, the syncs in between only fetch the users updated since the last one.
+OKTA_FULL_SYNC_INTERVAL = int(os.getenv("OKTA_FULL_SYNC_INTERVAL", 24 * 3600))
+
+# max seconds a request waits for the Okta sync run by another worker before answering 503 - above the sync time.
+OKTA_SYNC_WAIT_TIMEOUT = float(os.getenv("OKTA_SYNC_WAIT_TIMEOUT", 120))
+
+# number of concurrent DynamoDB writers of the csv ingestion, and their total write rate (0 for no limit) - set it
+# to the provisioned write capacity of the users table.
+DYNAMODB_WRITERS = int(os.getenv("DYNAMODB_WRITERS", 8))
+DYNAMODB_WRITES_PER_SECOND = int(os.getenv("DYNAMODB_WRITES_PER_SECOND", 0))
+
+# number of segments scanned in parallel when reading the whole users table.
+SCAN_TOTAL_SEGMENTS = int(os.getenv("SCAN_TOTAL_SEGMENTS", 4))
+
+# redis connection and cached values encoding ('json' or 'msgpack', zlib compressed above the threshold in bytes).
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+REDIS_DB = int(os.getenv("REDIS_DB", 0))
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 50))
+REDIS_SERIALIZER = os.getenv("REDIS_SERIALIZER", "json")
+REDIS_COMPRESS_THRESHOLD = int(os.getenv("REDIS_COMPRESS_THRESHOLD", 1024))
+
+# in-process (L1) cache of the user details in front of redis.
+USER_CACHE_L1_SIZE = int(os.getenv("USER_CACHE_L1_SIZE", 10000))
+USER_CACHE_L1_TTL = int(os.getenv("USER_CACHE_L1_TTL", 30))
+
+# seconds between two reconciliations of the users view (see app.services.users_view) with a full scan, 0 to disable.
+USERS_VIEW_RECONCILE_INTERVAL = int(os.getenv("USERS_VIEW_RECONCILE_INTERVAL", 3600))
+
+# file the columnar users snapshot of the analytical routes (see app.services.user_snapshot) is saved to and
+# memory-mapped from on startup, empty to only keep it in memory - and the seconds between two of its refreshes.
+USER_SNAPSHOT_PATH = os.getenv("USER_SNAPSHOT_PATH", "")
+USER_SNAPSHOT_MAX_AGE = float(os.getenv("USER_SNAPSHOT_MAX_AGE", 1))
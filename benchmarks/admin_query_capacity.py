@@ -0,0 +1,92 @@
+"""
+read capacity benchmark - "admins with an old password" with the full-table scan vs the admin_password_index query.
+
+runs against moto. moto does not meter capacity, so the read units are estimated the way DynamoDB charges them:
+the size of the items read (scanned, not returned) rounded up to 4 KB, 0.5 unit per 4 KB for eventually
+consistent reads.
+
+usage:
+    python -m benchmarks.admin_query_capacity --users 20000 --admin-ratio 0.01
+"""
+import argparse
+import math
+import time
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+from moto import mock_aws
+from pynamodb.connection.base import Connection
+
+from app.api.utils import parse_datetime
+from app.dynamo_db.models import OktaUser
+from app.dynamo_db.repositories import UserRepository
+
+
+def measure(func):
+    """
+    :return: (result, seconds, round trips, items read, estimated read units) of func().
+    """
+    pages = []
+    original_make_api_call = Connection._make_api_call
+
+    def recording_make_api_call(self, operation_name, operation_kwargs):
+        data = original_make_api_call(self, operation_name, operation_kwargs)
+        pages.append(data)
+        return data
+
+    with patch.object(Connection, "_make_api_call", recording_make_api_call):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+
+    items_read = sum(page.get("ScannedCount", 0) for page in pages)
+    item_size = average_item_size()
+    read_units = sum(math.ceil(page.get("ScannedCount", 0) * item_size / 4096) * 0.5 for page in pages)
+    return result, elapsed, len(pages), items_read, read_units
+
+
+_average_item_size = None
+
+
+def average_item_size():
+    global _average_item_size
+    if _average_item_size is None:
+        user = next(OktaUser.scan(limit=1))
+        serialized = user.serialize()
+        _average_item_size = sum(len(name) + len(str(value)) for name, value in serialized.items())
+    return _average_item_size
+
+
+def scan_path(user_repository):
+    threshold = datetime.now() - timedelta(days=7)
+    return [admin for admin in user_repository.get_admins_list()
+            if admin.passwordChanged and parse_datetime(admin.passwordChanged) < threshold]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--admin-ratio", type=float, default=0.01)
+    args = parser.parse_args()
+
+    admin_every = max(1, int(1 / args.admin_ratio))
+    old = (datetime.now(timezone.utc) - timedelta(days=30)).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+    with mock_aws():
+        OktaUser.create_table(read_capacity_units=5, write_capacity_units=5, wait=True)
+        with OktaUser.batch_write() as batch:
+            for i in range(args.users):
+                batch.save(OktaUser(email=f"user{i}@example.com", admin=str(i % admin_every == 0), lastLogin="",
+                                    name=f"User {i}", passwordChanged=old, statusChanged="", id=f"00u{i}"))
+
+        user_repository = UserRepository(OktaUser)
+
+        for name, func in (("scan", lambda: scan_path(user_repository)),
+                           ("query", lambda: user_repository.get_admins_with_old_password(7))):
+            admins, elapsed, round_trips, items_read, read_units = measure(func)
+            print(f"{name:>5}: admins={len(admins)} items_read={items_read} round_trips={round_trips} "
+                  f"estimated_read_units={read_units:.1f} elapsed={elapsed * 1000:.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+request latency benchmark - the sync (threadpool) vs the async version of the GET /users/{email} handler under
+concurrent load, with a simulated latency on every Redis and DynamoDB call.
+
+the requests are sent straight to the ASGI app (no network), so the numbers only show how the handlers themselves
+queue: sync handlers run on the starlette threadpool (40 threads), async handlers share the event loop and only
+the DynamoDB calls go to the AsyncUserRepository thread pool.
+
+usage:
+    python -m benchmarks.async_latency --requests 2000 --concurrency 200 --latency-ms 20
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from fastapi import FastAPI, HTTPException
+
+from app.api import users
+from app.api.dependencies import get_async_user_repository, get_user_cache
+from app.dynamo_db.models import OktaUser
+from app.dynamo_db.repositories import AsyncUserRepository
+
+
+class SlowUserRepository:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def get_user_by_email(self, email):
+        time.sleep(self.latency)
+        return OktaUser(email=email, admin="False", lastLogin="2025-03-01T10:00:00Z", name=email,
+                        passwordChanged="", statusChanged="", id=email)
+
+
+class SlowCache:
+    """cache that always misses, with a round trip latency on every call."""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def get_object(self, key):
+        time.sleep(self.latency)
+
+    def set_object(self, key, value, ex=None):
+        time.sleep(self.latency)
+
+    async def aget_object(self, key):
+        await asyncio.sleep(self.latency)
+
+    async def aset_object(self, key, value, ex=None):
+        await asyncio.sleep(self.latency)
+
+
+def make_app(latency):
+    app = FastAPI()
+    user_repository = SlowUserRepository(latency)
+    user_cache = SlowCache(latency)
+
+    @app.get("/sync/{email}")
+    def sync_last_user_login(email):
+        # the handler before the async request path.
+        cached_data = user_cache.get_object(f"user_details:{email}")
+        if cached_data:
+            return cached_data
+        try:
+            user_details = user_repository.get_user_by_email(email)
+            response = {"user": user_details.name, "last_login": user_details.lastLogin}
+            user_cache.set_object(f"user_details:{email}", response, ex=60)
+            return response
+        except Exception:
+            raise HTTPException(status_code=404, detail="User not found.")
+
+    app.add_api_route("/async/{email}", users.get_last_user_login)
+    return app, user_repository, user_cache
+
+
+def provide(service):
+    # a coroutine function, like the app dependencies - a plain function would run in the threadpool.
+    async def dependency():
+        return service
+    return dependency
+
+
+async def request(app, path):
+    """
+    :return: (status, seconds) of one GET request sent to the ASGI app.
+    """
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+             "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "", "headers": [],
+             "client": ("127.0.0.1", 0), "server": ("127.0.0.1", 80)}
+    status = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status.append(message["status"])
+
+    start = time.perf_counter()
+    await app(scope, receive, send)
+    return status[0], time.perf_counter() - start
+
+
+async def run_load(app, prefix, requests, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with semaphore:
+            return await request(app, f"{prefix}/user{i}@example.com")
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*[one(i) for i in range(requests)])
+    elapsed = time.perf_counter() - start
+
+    assert all(status == 200 for status, _ in results), "unexpected response status"
+    return elapsed, sorted(seconds for _, seconds in results)
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    args = parser.parse_args()
+
+    app, user_repository, user_cache = make_app(args.latency_ms / 1000)
+    async_user_repository = AsyncUserRepository(user_repository)
+
+    print(f"requests: {args.requests}, concurrency: {args.concurrency}, backend latency: {args.latency_ms}ms")
+
+    app.dependency_overrides[get_async_user_repository.dependency] = provide(async_user_repository)
+    app.dependency_overrides[get_user_cache.dependency] = provide(user_cache)
+
+    for name, prefix in (("sync", "/sync"), ("async", "/async")):
+        elapsed, latencies = asyncio.run(run_load(app, prefix, args.requests, args.concurrency))
+        print(f"{name:>6}: throughput={args.requests / elapsed:.0f} req/s "
+              f"p50={statistics.median(latencies) * 1000:.0f}ms p99={percentile(latencies, 99) * 1000:.0f}ms")
+
+    async_user_repository.close()
+
+
+if __name__ == "__main__":
+    main()
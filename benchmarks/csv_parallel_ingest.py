@@ -0,0 +1,49 @@
+"""
+throughput benchmark of the parallel csv folding (app.services.csv_ingest) - rows/sec per number of workers.
+
+writes a generated audit csv to a temporary file, then folds it with 1, 4 and 16 worker processes (or --workers).
+the scaling depends on the cores of the machine, the number of cores is printed with the results.
+
+usage:
+    python -m benchmarks.csv_parallel_ingest --rows 2000000 --workers 1 4 16
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from app.services.csv_ingest import fold_csv_file
+
+EVENTS = [b"User Login", b"Password Reset", b"MFA Enabled", b"Admin Role Granted", b"User Logout"]
+
+
+def write_csv(path, rows, users):
+    with open(path, "wb") as f:
+        f.write(b"User Email,Timestamp,Event Description\n")
+        for i in range(0, rows, 10000):
+            f.write(b"".join(b"user%d@example.com,%d,%s\n" % (j % users, 1677660000 + j, EVENTS[j % len(EVENTS)])
+                             for j in range(i, min(i + 10000, rows))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 16])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "audit.csv")
+        write_csv(path, args.rows, args.users)
+        print(f"rows: {args.rows}, file: {os.path.getsize(path) / 1024 / 1024:.0f}MB, cores: {os.cpu_count()}")
+
+        for workers in args.workers:
+            start = time.perf_counter()
+            folded = fold_csv_file(path, workers=workers)
+            elapsed = time.perf_counter() - start
+            print(f"workers={workers:>2}: elapsed={elapsed:.2f}s rows/sec={args.rows / elapsed:,.0f} "
+                  f"users={len(folded)}")
+
+
+if __name__ == "__main__":
+    main()
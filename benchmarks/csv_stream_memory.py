@@ -0,0 +1,121 @@
+"""
+memory benchmark for the /users/scan/ csv ingestion.
+
+serves a generated audit csv (1 GB by default) from a local HTTP stand-in for S3, then reads it in a fresh
+process like a scan job does and reports the peak RSS: with the streaming reader (open_csv_stream + batched
+folding), or with --mode file by downloading it (download_csv_from_s3) and folding it in parallel windows.
+
+usage:
+    python -m benchmarks.csv_stream_memory --size-mb 1024
+    python -m benchmarks.csv_stream_memory --size-mb 1024 --mode file
+"""
+import argparse
+import contextlib
+import http.server
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from itertools import islice
+
+HEADER = b"User Email,Timestamp,Event Description\n"
+EVENTS = [b"User Login", b"Password Reset", b"MFA Enabled", b"Admin Role Granted"]
+
+
+def csv_line(i, users):
+    return b"user%d@example.com,%d,%s\n" % (i % users, 1677660000 + i, EVENTS[i % len(EVENTS)])
+
+
+class CsvHandler(http.server.BaseHTTPRequestHandler):
+    size = 0
+    users = 20000
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/csv")
+        self.send_header("Content-Length", str(self.size))
+        self.end_headers()
+
+        # write the file in chunks of generated lines, cut exactly at `size` bytes.
+        remaining = self.size - len(HEADER)
+        self.wfile.write(HEADER)
+        i = 0
+        while remaining > 0:
+            chunk = b"".join(csv_line(j, self.users) for j in range(i, i + 1000))
+            i += 1000
+            chunk = chunk[:remaining]
+            self.wfile.write(chunk)
+            remaining -= len(chunk)
+
+    def log_message(self, *args):
+        pass
+
+
+class NoopRepository:
+    """repository stand-in - the benchmark measures the ingestion, not DynamoDB."""
+
+    @contextlib.contextmanager
+    def batch_writes(self):
+        yield
+
+    def update_user(self, email, fields=None, latest=None, defaults=None, new_events=None, must_exist=False):
+        return None
+
+
+def consume(url, mode, batch_size):
+    from app.api.utils import open_csv_stream, download_csv_from_s3
+    from app.dynamo_db.service import UserService
+    from app.services.csv_ingest import iter_folded_windows, read_csv_header
+
+    service = UserService(NoopRepository())
+    start = time.perf_counter()
+
+    if mode == "file":
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "scan.csv")
+            download_csv_from_s3(url, path)
+            fieldnames, data_start = read_csv_header(path)
+            for _, _, folded_events in iter_folded_windows(path, fieldnames, data_start, 64 * 1024 * 1024):
+                service.apply_folded_events(folded_events)
+    else:
+        rows = iter(open_csv_stream(url))
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            service.update_users_from_csv(batch)
+
+    elapsed = time.perf_counter() - start
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"mode={mode} elapsed={elapsed:.1f}s peak_rss={peak_rss_mb:.1f}MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=1024)
+    parser.add_argument("--mode", choices=["stream", "file"], default="stream")
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument("--consume", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.consume:
+        consume(args.consume, args.mode, args.batch_size)
+        return
+
+    CsvHandler.size = args.size_mb * 1024 * 1024
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), CsvHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/audit.csv"
+
+    print(f"serving {args.size_mb}MB csv at {url}")
+    # run the reader in a fresh process so its peak RSS is not mixed with the server's.
+    subprocess.run([sys.executable, "-m", "benchmarks.csv_stream_memory", "--consume", url,
+                    "--mode", args.mode, "--batch-size", str(args.batch_size)], check=True)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+synthetic data of the benchmark suite - Okta users and audit log events, generated from a seed so every run
+works on the same data.
+"""
+import random
+from itertools import accumulate
+
+from tests.fake_okta import fake_okta_user
+
+# event descriptions of the audit logs, with their share of the events.
+EVENT_MIX = (("User Login", 0.70), ("Password Changed", 0.08), ("Admin Role Granted", 0.02),
+             ("MFA Enabled", 0.10), ("User Logout", 0.10))
+
+FIRST_TIMESTAMP = 1740000000
+
+
+def okta_users(count):
+    """
+    :return: list of `count` Okta user payloads - the users served by tests.fake_okta.FakeOktaServer.
+    """
+    return [fake_okta_user(i) for i in range(count)]
+
+
+def user_weights(users, skew):
+    """
+    :return: cumulative Zipf weights of the users - user i gets 1 / (i + 1) ** skew of the events (0 for uniform).
+    """
+    return list(accumulate(1.0 / (i + 1) ** skew for i in range(users)))
+
+
+def audit_events(events, users, skew=1.0, seed=0):
+    """
+    :param events: number of events.
+    :param users: number of users the events are spread over (user0@example.com ... the Okta users).
+    :param skew: Zipf exponent of the distribution of the events over the users - with 1.0, the first user gets
+     about 10% of the events of 2000 users, 0 spreads them evenly.
+    :param seed: seed of the random generator.
+    :return: list of csv rows (dicts like csv.DictReader returns), in time order.
+    """
+    rng = random.Random(seed)
+    emails = rng.choices(range(users), cum_weights=user_weights(users, skew), k=events)
+    descriptions = rng.choices([description for description, _ in EVENT_MIX],
+                               weights=[share for _, share in EVENT_MIX], k=events)
+
+    return [{"User Email": f"user{user}@example.com", "Timestamp": str(FIRST_TIMESTAMP + i),
+             "Event Description": description}
+            for i, (user, description) in enumerate(zip(emails, descriptions))]
+
+
+def audit_csv(rows):
+    """
+    :param rows: rows returned by audit_events.
+    :return: bytes of the audit csv file of the rows.
+    """
+    lines = ["User Email,Timestamp,Event Description"]
+    lines += [f"{row['User Email']},{row['Timestamp']},{row['Event Description']}" for row in rows]
+    return ("\n".join(lines) + "\n").encode()
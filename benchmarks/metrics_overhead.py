@@ -0,0 +1,92 @@
+"""
+overhead of the instrumentation (app.services.metrics) - the cost of one recorded call, inside and outside of a
+request (collect_timings), and the overhead on in-process Redis (fakeredis) and DynamoDB (moto) calls.
+
+fakeredis and moto answer in microseconds - much faster than a real server over the network - so their overhead
+ratio is an upper bound. the cost per call is also shown against typical production latencies.
+
+usage:
+    python -m benchmarks.metrics_overhead --calls 200000
+"""
+import argparse
+import time
+from unittest.mock import patch
+
+import fakeredis
+from moto import mock_aws
+from pynamodb.connection.base import Connection
+
+from app.dynamo_db.models import InstrumentedConnection, OktaUser
+from app.services.metrics import collect_timings, instrumented, timed
+from app.services.redis_service import RedisService
+
+# typical latency (seconds) of a call in production, and how it is recorded.
+TYPICAL_LATENCIES = {"redis GET (same AZ)": (0.0003, "decorator"), "DynamoDB GetItem": (0.005, "decorator"),
+                     "S3 HEAD": (0.02, "timed"), "Okta page": (0.2, "timed")}
+
+
+def per_call(func, calls):
+    # warm up (caches, connections) before measuring.
+    for _ in range(min(calls, 100)):
+        func()
+
+    start = time.perf_counter()
+    for _ in range(calls):
+        func()
+    return (time.perf_counter() - start) / calls
+
+
+def empty():
+    pass
+
+
+def empty_timed():
+    with timed("benchmark", "empty"):
+        pass
+
+
+@instrumented("benchmark", "empty")
+def empty_instrumented():
+    pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=200000)
+    parser.add_argument("--io-calls", type=int, default=10000)
+    args = parser.parse_args()
+
+    # inside a request, the time per component is also collected.
+    with collect_timings():
+        baseline = per_call(empty, args.calls)
+        costs = {"decorator": per_call(empty_instrumented, args.calls) - baseline,
+                 "timed": per_call(empty_timed, args.calls) - baseline}
+
+    print(f"recorded call: @instrumented {costs['decorator'] * 1e6:.2f}us, with timed() {costs['timed'] * 1e6:.2f}us")
+    for name, (latency, mechanism) in TYPICAL_LATENCIES.items():
+        print(f"{name:>22}: {latency * 1000:g}ms -> overhead {costs[mechanism] / latency:.3%}")
+
+    # redis: the instrumented get_object against the same calls made directly on the client.
+    redis_service = RedisService(redis_client=fakeredis.FakeRedis())
+    redis_service.set_object("user_details:a", {"email": "a@example.com", "name": "A"})
+    client, serializer = redis_service.redis_client, redis_service.serializer
+
+    plain = per_call(lambda: serializer.loads(client.get("user_details:a")), args.io_calls)
+    recorded = per_call(lambda: redis_service.get_object("user_details:a"), args.io_calls)
+    print(f"fakeredis get_object: {plain * 1e6:.1f}us -> {recorded * 1e6:.1f}us ({(recorded - plain) / plain:+.2%})")
+
+    # dynamodb: GetItem through PynamoDB, with and without the instrumented connection.
+    with mock_aws():
+        OktaUser.create_table(read_capacity_units=5, write_capacity_units=5, wait=True)
+        OktaUser(email="a@example.com", admin="False", lastLogin="", name="A", passwordChanged="", statusChanged="",
+                 id="00u1").save()
+
+        with patch.object(InstrumentedConnection, "dispatch", Connection.dispatch):
+            plain = per_call(lambda: OktaUser.get("a@example.com"), args.io_calls // 4)
+        recorded = per_call(lambda: OktaUser.get("a@example.com"), args.io_calls // 4)
+
+    print(f"moto GetItem: {plain * 1e6:.0f}us -> {recorded * 1e6:.0f}us ({(recorded - plain) / plain:+.2%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+redis benchmark - per key round trips vs pipelined batches, and the size of the cached payloads per codec.
+
+uses the redis server at --host/--port if it is reachable, otherwise fakeredis. fakeredis has no network, so use
+--latency-ms to add a simulated round trip latency to every request sent to the server.
+
+usage:
+    python -m benchmarks.redis_pipeline --keys 1000 --latency-ms 0.5
+"""
+import argparse
+import json
+import time
+from unittest.mock import patch
+
+import redis
+
+from app.services.redis_service import RedisService
+from app.services.serializers import get_serializer, JsonSerializer
+
+
+def make_client(host, port):
+    client = redis.Redis(host=host, port=port, socket_connect_timeout=0.5)
+    try:
+        client.ping()
+        return client, f"redis {host}:{port}"
+    except redis.exceptions.ConnectionError:
+        import fakeredis
+        return fakeredis.FakeRedis(), "fakeredis"
+
+
+def measure(func, latency):
+    """
+    :return: (seconds, round trips) of func().
+    """
+    round_trips = []
+    original_send = redis.connection.AbstractConnection.send_packed_command
+
+    def send_packed_command(self, command, check_health=True):
+        round_trips.append(1)
+        if latency:
+            time.sleep(latency)
+        return original_send(self, command, check_health)
+
+    with patch.object(redis.connection.AbstractConnection, "send_packed_command", send_packed_command):
+        start = time.perf_counter()
+        func()
+        return time.perf_counter() - start, len(round_trips)
+
+
+def okta_users_payload(count):
+    return {f"00u{i}": {"id": f"00u{i}", "email": f"user{i}@example.com", "name": f"User {i}",
+                        "lastLogin": "2025-03-01T10:00:00.000Z", "passwordChanged": "2024-01-01T10:00:00.000Z",
+                        "statusChanged": "2024-03-01T10:00:00.000Z", "admin": i % 100 == 0}
+            for i in range(count)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--keys", type=int, default=1000)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--payload-users", type=int, default=50000)
+    args = parser.parse_args()
+
+    client, server = make_client(args.host, args.port)
+    redis_service = RedisService(redis_client=client)
+    latency = args.latency_ms / 1000
+    values = {f"user_details:user{i}@example.com": {"user": f"User {i}", "last_login": "2025-03-01T10:00:00Z"}
+              for i in range(args.keys)}
+
+    print(f"server: {server}, keys: {args.keys}, simulated latency: {args.latency_ms}ms")
+
+    def per_key_set():
+        for key, value in values.items():
+            redis_service.set_object(key, value, ex=60)
+
+    def per_key_get():
+        for key in values:
+            redis_service.get_object(key)
+
+    def pipelined_set():
+        redis_service.mset_objects(values, ex=60)
+
+    def pipelined_get():
+        redis_service.mget_objects(list(values))
+
+    for name, func in (("per-key set", per_key_set), ("pipelined set", pipelined_set),
+                       ("per-key get", per_key_get), ("pipelined get", pipelined_get)):
+        elapsed, round_trips = measure(func, latency)
+        print(f"{name:>14}: round_trips={round_trips} elapsed={elapsed * 1000:.1f}ms")
+
+    payload = okta_users_payload(args.payload_users)
+    print(f"okta_users_data payload ({args.payload_users} users):")
+    codecs = {"json (legacy)": None, "compact json": JsonSerializer(), "json+zlib": get_serializer("json")}
+    try:
+        codecs["msgpack+zlib"] = get_serializer("msgpack")
+    except ImportError:
+        pass
+
+    for name, codec in codecs.items():
+        start = time.perf_counter()
+        data = json.dumps(payload).encode() if codec is None else codec.dumps(payload)
+        elapsed = time.perf_counter() - start
+        print(f"{name:>14}: size={len(data) / 1024:.0f}KB encode={elapsed * 1000:.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
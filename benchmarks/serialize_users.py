@@ -0,0 +1,65 @@
+"""
+benchmark of the /users/results serialization - building OktaUser models from the scanned items, serializing them
+and encoding the response with FastAPI's default encoder (before), against serialize_raw_item on the raw items and
+one dumps_json call (orjson if installed, else the json module).
+
+usage:
+    python -m benchmarks.serialize_users --users 50000
+"""
+import argparse
+import json
+import time
+from unittest.mock import patch
+
+from fastapi.encoders import jsonable_encoder
+
+from app.api.utils import serialize_okta_user, serialize_raw_item
+from app.dynamo_db.models import OktaUser
+from app.services import serializers
+
+
+def raw_items(count, events_per_user):
+    return [OktaUser(email=f"user{i}@example.com", admin=str(i % 100 == 0), lastLogin="2025-03-01T10:00:00+00:00Z",
+                     name=f"User {i}", passwordChanged="2025-01-01T10:00:00+00:00Z",
+                     statusChanged="2024-03-01T10:00:00.000Z", id=f"00u{i}",
+                     user_events=[{"Timestamp": f"2025-02-{1 + j % 28:02d}T10:00:00",
+                                   "Event Description": "MFA Enabled"}
+                                  for j in range(events_per_user)]).serialize()
+            for i in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50000)
+    parser.add_argument("--events-per-user", type=int, default=3)
+    args = parser.parse_args()
+
+    items = raw_items(args.users, args.events_per_user)
+
+    def models_and_default_encoder():
+        users = [serialize_okta_user(OktaUser.from_raw_data(item)) for item in items]
+        return json.dumps(jsonable_encoder(users)).encode()
+
+    def raw_items_and_dumps_json():
+        return serializers.dumps_json([serialize_raw_item(OktaUser, item) for item in items])
+
+    cases = [("models + jsonable_encoder", models_and_default_encoder, True)]
+    if serializers.orjson is not None:
+        cases.append(("raw items + orjson", raw_items_and_dumps_json, True))
+    cases.append(("raw items + json", raw_items_and_dumps_json, False))
+
+    print(f"users: {args.users}, events per user: {args.events_per_user}")
+    results = []
+    for name, func, with_orjson in cases:
+        with patch.object(serializers, "orjson", serializers.orjson if with_orjson else None):
+            start = time.perf_counter()
+            body = func()
+            elapsed = time.perf_counter() - start
+        results.append(json.loads(body))
+        print(f"{name:>26}: elapsed={elapsed:.3f}s users/sec={args.users / elapsed:,.0f} size={len(body) / 1024:.0f}KB")
+
+    assert all(result == results[0] for result in results), "the serializations differ"
+
+
+if __name__ == "__main__":
+    main()
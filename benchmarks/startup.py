@@ -0,0 +1,153 @@
+"""
+startup benchmark - the import time of the app (python -X importtime), the time from the start of a uvicorn
+process to its first served request, and the memory (RSS) of each worker.
+
+two requests are timed: /metrics, which needs none of the services, then /users/cache/stats, which needs the user
+cache (redis clients) - the first request using a service also pays for its creation. no external service is
+called: the redis clients do not connect before their first command, the invalidation listener retries in the
+background.
+
+usage:
+    python -m benchmarks.startup --runs 5 --workers 1
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FIRST_REQUESTS = ("/metrics", "/users/cache/stats")
+
+
+def import_times(module="main"):
+    """
+    :return: tuple of (seconds to import the module, {top level package: seconds}) in a new interpreter - the
+     packages are the ones imported by the module, with the time spent in their own modules.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=ROOT,
+                            capture_output=True, text=True, check=True)
+    lines = []
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "cumulative" not in line:
+            own, cumulative, name = line[len("import time:"):].split("|")
+            lines.append((int(own) / 1e6, int(cumulative) / 1e6, name.rstrip()))
+
+    # the modules are listed after the modules they import, one more space of indentation per level: the module
+    # is the last line, its imports are the indented lines just before it.
+    total = lines[-1][1]
+    packages = {}
+    for own, _, name in reversed(lines[:-1]):
+        if not name.startswith("  "):
+            break
+        package = name.strip().split(".")[0]
+        packages[package] = packages.get(package, 0.0) + own
+    return total, packages
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def get(url, timeout=1.0):
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except OSError:
+        return None
+
+
+def rss_mb(pid):
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def worker_pids(pid):
+    """
+    :return: pids of the uvicorn workers - the process itself when it runs a single worker.
+    """
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as children:
+            pids = [int(child) for child in children.read().split()]
+    except OSError:
+        pids = []
+
+    workers = []
+    for child in pids:
+        with open(f"/proc/{child}/cmdline", "rb") as cmdline:
+            # with --workers, the supervisor also starts the multiprocessing resource tracker.
+            if b"resource_tracker" not in cmdline.read():
+                workers.append(child)
+    return workers or [pid]
+
+
+def serve_once(workers, timeout=60):
+    """
+    start uvicorn, and time its first requests.
+
+    :return: tuple of ({path: seconds from the start of the process to its response}, [RSS of each worker (MB)]).
+    """
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    env = dict(os.environ, AWS_DEFAULT_REGION=os.environ.get("AWS_DEFAULT_REGION", "us-east-1"))
+    process = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--workers",
+                                str(workers), "--log-level", "warning"], cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    start = time.perf_counter()
+    times = {}
+    try:
+        while get(base_url + FIRST_REQUESTS[0], timeout=0.5) != 200:
+            if process.poll() is not None or time.perf_counter() - start > timeout:
+                raise RuntimeError("uvicorn did not start.")
+            time.sleep(0.01)
+        times[FIRST_REQUESTS[0]] = time.perf_counter() - start
+
+        for path in FIRST_REQUESTS[1:]:
+            status = get(base_url + path, timeout=timeout)
+            if status != 200:
+                raise RuntimeError(f"{path} answered {status}.")
+            times[path] = time.perf_counter() - start
+
+        return times, [rss_mb(pid) for pid in worker_pids(process.pid)]
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--top", type=int, default=8, help="number of packages shown in the import breakdown.")
+    args = parser.parse_args()
+
+    imports = [import_times() for _ in range(args.runs)]
+    totals = [total for total, _ in imports]
+    print(f"import main: median {statistics.median(totals) * 1000:.0f}ms (min {min(totals) * 1000:.0f}ms)")
+    packages = imports[totals.index(statistics.median_low(totals))][1]
+    for package, seconds in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"{package:>24}: {seconds * 1000:.0f}ms")
+
+    runs = [serve_once(args.workers) for _ in range(args.runs)]
+    for path in FIRST_REQUESTS:
+        seconds = [times[path] for times, _ in runs]
+        print(f"first {path}: median {statistics.median(seconds) * 1000:.0f}ms after the start of the process")
+
+    rss = [mb for _, workers in runs for mb in workers]
+    print(f"RSS per worker ({args.workers} worker(s)): median {statistics.median(rss):.1f}MB, max {max(rss):.1f}MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,428 @@
+"""
+benchmark suite - times the core functions and every route of the app against local stand-ins for the external
+services: the Okta API (tests.fake_okta), the S3 object (tests.fake_s3), DynamoDB (moto) and Redis (fakeredis).
+
+the data is generated from a seed (benchmarks.data): --users Okta users, and an audit csv of --events events whose
+users follow a Zipf distribution of exponent --skew. every benchmark is run --repeat times and its median is kept.
+
+the results are written as JSON (--output). with --compare, the results are compared with a previous results file
+and the command fails (exit code 1) when a benchmark got slower by more than --threshold (and by more than
+--min-delta-ms, so the fastest routes do not fail on noise). --against compares two results files without running.
+only compare results of the same parameters on the same machine.
+
+usage:
+    python -m benchmarks.suite --output baseline.json
+    python -m benchmarks.suite --compare baseline.json --threshold 0.25 --output results.json
+    python -m benchmarks.suite --compare baseline.json --against results.json
+    python -m benchmarks.suite --only core/ --users 5000 --events 100000 --skew 1.2
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from contextlib import ExitStack
+from datetime import datetime, timezone
+from unittest.mock import patch
+
+import fakeredis
+from moto import mock_aws
+
+from benchmarks.data import okta_users, audit_events, audit_csv
+from tests.fake_okta import FakeOktaServer
+from tests.fake_s3 import FakeS3Server
+
+# the relevant fields of the Okta sync route.
+RELEVANT_FIELDS = ("id", "statusChanged", "lastLogin", "passwordChanged", "name", "email")
+
+
+class StandIns:
+    """
+    the local stand-ins of the external services, wired into the services of the app (app.api.dependencies).
+    DynamoDB is mocked by moto for the whole run (mock_aws must be started before the services are created).
+    """
+
+    def __init__(self, users, events, skew, admin_every):
+        self.users = users
+        self.admin_every = admin_every
+        self.raw_users = okta_users(users)
+        self.rows = audit_events(events, users, skew)
+        self._stack = ExitStack()
+
+    def __enter__(self):
+        stack = self._stack
+        stack.enter_context(mock_aws())
+
+        import main
+        from app.api import dependencies as services
+        self.app = main.app
+        self.services = services
+
+        self.okta = stack.enter_context(FakeOktaServer(user_count=self.users, admin_every=self.admin_every,
+                                                       max_limit=200))
+        self.s3 = stack.enter_context(FakeS3Server(audit_csv(self.rows)))
+
+        redis_server = fakeredis.FakeServer()
+        self.redis = fakeredis.FakeRedis(server=redis_server)
+        for target, attribute, value in (
+                (services.get_redis_service(), "redis_client", fakeredis.FakeRedis(server=redis_server)),
+                (services.get_async_redis_service(), "redis_client", fakeredis.FakeAsyncRedis(server=redis_server)),
+                (services.get_okta_client(), "base_url", self.okta.base_url),
+                (services.get_async_okta_client(), "base_url", self.okta.base_url)):
+            stack.enter_context(patch.object(target, attribute, value))
+
+        self.reset_tables()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stack.close()
+
+    def reset_tables(self):
+        from app.dynamo_db.models import OktaUser, OktaUserEvent
+
+        for model in (OktaUser, OktaUserEvent):
+            if model.exists():
+                model.delete_table()
+            model.create_table(read_capacity_units=5, write_capacity_units=5, wait=True)
+
+    def flush_caches(self):
+        self.redis.flushall()
+        self.services.get_user_cache().local_cache.clear()
+        # like a new worker, without a last version of the users list to serve while the view is built.
+        self.services.get_users_view()._response = None
+
+    def extracted_users(self):
+        from app.api.utils import DataProcessor
+
+        users_data = DataProcessor.extract_data(self.raw_users, RELEVANT_FIELDS)
+        DataProcessor.update_admin_field(self.raw_users[::self.admin_every], users_data)
+        return users_data
+
+    def load_users(self, with_events=False):
+        """
+        empty tables and caches, with the users (and their events) loaded.
+        """
+        self.reset_tables()
+        self.flush_caches()
+        self.services.get_user_repository().upload_user_data_to_db(self.extracted_users())
+        if with_events:
+            self.services.get_user_service().update_users_from_csv(self.rows)
+
+
+def run(func, setup=None, repeat=3):
+    """
+    :return: list of the durations (seconds) of func(), setup() runs before every call and is not timed.
+    """
+    durations = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+async def run_async(func, setup=None, repeat=3):
+    durations = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        await func()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def result(durations, items, unit):
+    """
+    :param items: number of items (users, rows, requests) processed by one run.
+    :param unit: what one run is, e.g. "20 requests".
+    """
+    seconds = statistics.median(durations)
+    return {"seconds": round(seconds, 6), "min_seconds": round(min(durations), 6),
+            "runs": [round(duration, 6) for duration in durations], "unit": unit, "items": items,
+            "items_per_sec": round(items / seconds, 1) if seconds > 0 else None}
+
+
+def core_benchmarks(env):
+    """
+    :return: list of (name, func, setup, items, unit).
+    """
+    from app.api.utils import DataProcessor, open_csv_stream
+    from app_config import SCAN_TOTAL_SEGMENTS
+
+    services = env.services
+    users_data = env.extracted_users()
+
+    def read_csv_stream():
+        for _ in open_csv_stream(env.s3.url):
+            pass
+
+    return [
+        ("core/extract_data", lambda: DataProcessor.extract_data(env.raw_users, RELEVANT_FIELDS), None,
+         env.users, "users"),
+        ("core/upload_user_data_to_db", lambda: services.get_user_repository().upload_user_data_to_db(users_data),
+         env.reset_tables, env.users, "users"),
+        ("core/read_csv_stream", read_csv_stream, None, len(env.rows), "rows"),
+        ("core/update_users_from_csv", lambda: services.get_user_service().update_users_from_csv(env.rows),
+         env.load_users, len(env.rows), "rows"),
+        ("core/scan_table", lambda: services.get_user_repository().scan_table(SCAN_TOTAL_SEGMENTS, raw=True),
+         None, env.users, "users"),
+    ]
+
+
+async def request(app, method, path, body=None):
+    """
+    :return: tuple of (status, body) of one request sent to the ASGI app.
+    """
+    path, _, query = path.partition("?")
+    headers = [(b"content-type", b"application/json")] if body is not None else []
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": method, "scheme": "http",
+             "path": path, "raw_path": path.encode(), "query_string": query.encode(), "root_path": "",
+             "headers": headers, "client": ("127.0.0.1", 0), "server": ("127.0.0.1", 80)}
+    messages = []
+    pending = [{"type": "http.request", "body": json.dumps(body).encode() if body is not None else b"",
+                "more_body": False}]
+
+    async def receive():
+        if pending:
+            return pending.pop()
+        # the client never disconnects - streaming responses wait for it until they are done.
+        await asyncio.Event().wait()
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    status = next(message["status"] for message in messages if message["type"] == "http.response.start")
+    return status, b"".join(message.get("body", b"") for message in messages if message["type"] == "http.response.body")
+
+
+def requests_of(env, method, paths, body=None, statuses=(200,)):
+    """
+    :return: coroutine function sending the requests one after the other, failing on an unexpected status.
+    """
+    async def send_requests():
+        for path in paths:
+            status, content = await request(env.app, method, path, body)
+            if status not in statuses:
+                raise RuntimeError(f"{method} {path} returned {status}: {content[:200]!r}")
+
+    return send_requests
+
+
+def until_served(env, path):
+    """
+    :return: coroutine function requesting path until it is served - the 503 answered while the users view is built
+     in the background are retried.
+    """
+    async def send_requests():
+        while True:
+            status, content = await request(env.app, "GET", path)
+            if status == 200:
+                return
+            if status != 503:
+                raise RuntimeError(f"GET {path} returned {status}: {content[:200]!r}")
+            await asyncio.sleep(0.01)
+
+    return send_requests
+
+
+def scan_job(env):
+    """
+    :return: coroutine function submitting the audit csv (POST /users/scan/) and polling the job until it is done.
+    """
+    async def ingest():
+        status, content = await request(env.app, "POST", "/users/scan/", {"s3_link": env.s3.url})
+        if status != 202:
+            raise RuntimeError(f"POST /users/scan/ returned {status}: {content[:200]!r}")
+        job_id = json.loads(content)["job_id"]
+
+        while True:
+            status, content = await request(env.app, "GET", f"/users/scan/{job_id}")
+            progress = json.loads(content)
+            if progress["status"] == "failed":
+                raise RuntimeError(f"scan job failed: {progress['errors']}")
+            if progress["status"] == "done":
+                return
+            await asyncio.sleep(0.01)
+
+    return ingest
+
+
+def route_benchmarks(env):
+    """
+    :return: list of (name, coroutine function, setup, items, unit) - the users and events are loaded before the
+     routes run, the sync and scan routes load them again.
+    """
+    emails = [f"user{i}@example.com" for i in range(0, env.users, max(1, env.users // 100))]
+    admins = [f"user{i}@example.com" for i in range(0, env.users, env.admin_every)][:20]
+    # the users with the most events come first with a skewed distribution.
+    active = [f"user{i}@example.com" for i in range(min(env.users, 20))]
+
+    def cold(setup=None):
+        def reset():
+            if setup is not None:
+                setup()
+            env.flush_caches()
+        return reset
+
+    def paths(template, values):
+        return [template.format(value) for value in values]
+
+    return [
+        ("route/GET /users/ (full Okta sync)", requests_of(env, "GET", ["/users/?full=true"]),
+         cold(env.reset_tables), env.users, "users"),
+        ("route/POST /users/scan/ (until done)", scan_job(env), cold(env.load_users), len(env.rows), "rows"),
+        ("route/GET /users/results (cold, until built)", until_served(env, "/users/results"), cold(), 1,
+         "request"),
+        ("route/GET /users/results (cached)", requests_of(env, "GET", ["/users/results"] * 20), None, 20,
+         "requests"),
+        ("route/GET /users/results?limit=100", requests_of(env, "GET", ["/users/results?limit=100"] * 10), None, 10,
+         "requests"),
+        ("route/GET /users/results/stream", requests_of(env, "GET", ["/users/results/stream"]), None, 1, "request"),
+        ("route/GET /users/{email} (cold)", requests_of(env, "GET", paths("/users/{}", emails)), cold(),
+         len(emails), "requests"),
+        ("route/GET /users/{email} (cached)", requests_of(env, "GET", paths("/users/{}", emails)), None,
+         len(emails), "requests"),
+        # the admin details cannot be cached (see the route) and are answered with a 404 on a cache miss.
+        ("route/GET /users/admin/{email}", requests_of(env, "GET", paths("/users/admin/{}", admins),
+                                                       statuses=(200, 404)), cold(), len(admins), "requests"),
+        ("route/GET /users/admin/", requests_of(env, "GET", ["/users/admin/?days=7"] * 10), None, 10, "requests"),
+        ("route/GET /users/analytics/users", requests_of(env, "GET", [
+            "/users/analytics/users?admin=true&inactive_days=30&order_by=lastLogin"] * 10), None, 10, "requests"),
+        ("route/GET /users/analytics/summary", requests_of(env, "GET", ["/users/analytics/summary?days=30"] * 10),
+         None, 10, "requests"),
+        ("route/GET /users/{email}/events", requests_of(env, "GET", paths("/users/{}/events?limit=100", active)),
+         None, len(active), "requests"),
+        ("route/GET /users/cache/stats", requests_of(env, "GET", ["/users/cache/stats"] * 50), None, 50,
+         "requests"),
+        ("route/GET /metrics", requests_of(env, "GET", ["/metrics"] * 10), None, 10, "requests"),
+    ]
+
+
+def run_suite(args):
+    results = {}
+
+    def selected(name):
+        return not args.only or any(pattern in name for pattern in args.only)
+
+    def report(name, durations, items, unit):
+        results[name] = result(durations, items, unit)
+        print(f"{name:<45} {results[name]['seconds'] * 1000:>10.1f}ms  ({items} {unit}, "
+              f"{results[name]['items_per_sec']:,.0f}/s)", flush=True)
+
+    with StandIns(args.users, args.events, args.skew, args.admin_every) as env:
+        for name, func, setup, items, unit in core_benchmarks(env):
+            if selected(name):
+                report(name, run(func, setup, args.repeat), items, unit)
+
+        async def run_routes():
+            # the users and events read by the routes, even if the sync and scan routes are not selected.
+            env.load_users(with_events=True)
+            try:
+                for name, func, setup, items, unit in route_benchmarks(env):
+                    if selected(name):
+                        report(name, await run_async(func, setup, args.repeat), items, unit)
+            finally:
+                await env.services.get_async_okta_client().close()
+
+        asyncio.run(run_routes())
+        env.services.get_scan_job_service().shutdown()
+
+    return {"meta": metadata(args), "results": results}
+
+
+def metadata(args):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {"created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"), "commit": commit,
+            "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+            "parameters": {"users": args.users, "events": args.events, "skew": args.skew,
+                           "admin_every": args.admin_every, "repeat": args.repeat}}
+
+
+def compare(baseline, current, threshold, min_delta):
+    """
+    :param baseline: results of the reference run.
+    :param current: results to check.
+    :param threshold: max allowed slowdown ratio (0.25 for 25% slower).
+    :param min_delta: max allowed slowdown in seconds - a benchmark regresses only if both are exceeded.
+    :return: tuple of (rows of (name, baseline seconds, current seconds, change), names of the regressions).
+    """
+    rows, regressions = [], []
+    for name in sorted(set(baseline["results"]) | set(current["results"])):
+        before = baseline["results"].get(name, {}).get("seconds")
+        after = current["results"].get(name, {}).get("seconds")
+        change = after / before - 1 if before and after is not None else None
+        rows.append((name, before, after, change))
+
+        if change is not None and change > threshold and after - before > min_delta:
+            regressions.append(name)
+    return rows, regressions
+
+
+def print_comparison(rows, regressions, threshold):
+    def milliseconds(seconds):
+        return "-" if seconds is None else f"{seconds * 1000:.1f}ms"
+
+    print(f"\n{'benchmark':<45} {'baseline':>12} {'current':>12} {'change':>9}")
+    for name, before, after, change in rows:
+        mark = "  REGRESSION" if name in regressions else ""
+        change = "-" if change is None else f"{change:+.1%}"
+        print(f"{name:<45} {milliseconds(before):>12} {milliseconds(after):>12} {change:>9}{mark}")
+
+    if regressions:
+        print(f"\n{len(regressions)} benchmark(s) more than {threshold:.0%} slower than the baseline.")
+    else:
+        print(f"\nno benchmark more than {threshold:.0%} slower than the baseline.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--skew", type=float, default=1.0, help="Zipf exponent of the events per user (0: uniform)")
+    parser.add_argument("--admin-every", type=int, default=20, help="every n-th Okta user is an admin")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", nargs="*", help="only the benchmarks whose name contains one of these strings")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="baseline results file to compare with")
+    parser.add_argument("--against", help="results file compared with --compare, instead of running the suite")
+    parser.add_argument("--threshold", type=float, default=0.25)
+    parser.add_argument("--min-delta-ms", type=float, default=2.0)
+    args = parser.parse_args()
+
+    if args.against:
+        if not args.compare:
+            parser.error("--against requires --compare")
+        with open(args.against) as f:
+            current = json.load(f)
+    else:
+        current = run_suite(args)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(current, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline["meta"].get("parameters") != current["meta"].get("parameters"):
+            print("warning: the baseline was run with other parameters.")
+
+        rows, regressions = compare(baseline, current, args.threshold, args.min_delta_ms / 1000)
+        print_comparison(rows, regressions, args.threshold)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
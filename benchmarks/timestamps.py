@@ -0,0 +1,59 @@
+"""
+microbenchmark of the batch timestamp conversions (app.services.timestamps) against one datetime call per item.
+
+usage:
+    python -m benchmarks.timestamps --rows 1000000
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timezone
+from unittest.mock import patch
+
+from app.services import timestamps
+
+
+def measure(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    epochs = [rng.randint(1_500_000_000, 1_750_000_000) for _ in range(args.rows)]
+    dates = [datetime.fromtimestamp(epoch, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z") for epoch in epochs]
+
+    cases = {
+        "epochs -> event timestamps": (
+            lambda: [datetime.fromtimestamp(e, tz=timezone.utc).replace(tzinfo=None).isoformat() for e in epochs],
+            lambda: timestamps.epochs_to_iso(epochs)),
+        "epochs -> lastLogin values": (
+            lambda: [datetime.fromtimestamp(e, tz=timezone.utc).isoformat() + "Z" for e in epochs],
+            lambda: timestamps.epochs_to_iso(epochs, utc=True)),
+        "okta dates -> epoch seconds": (
+            lambda: [int(datetime.strptime(date, timestamps.OKTA_FORMAT).replace(tzinfo=timezone.utc).timestamp())
+                     for date in dates],
+            lambda: timestamps.to_epoch_seconds(dates)),
+    }
+
+    backend = "numpy" if timestamps.np is not None else "pure python (numpy not installed)"
+    print(f"rows: {args.rows}, batch backend: {backend}")
+
+    for name, (scalar, batch) in cases.items():
+        scalar_time, scalar_result = measure(scalar)
+        batch_time, batch_result = measure(batch)
+        with patch.object(timestamps, "np", None):
+            fallback_time, fallback_result = measure(batch)
+
+        identical = scalar_result == batch_result == fallback_result
+        print(f"{name:>28}: per-item={scalar_time:.2f}s batch={batch_time:.2f}s "
+              f"fallback={fallback_time:.2f}s speedup={scalar_time / batch_time:.1f}x identical={identical}")
+
+
+if __name__ == "__main__":
+    main()
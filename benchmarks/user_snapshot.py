@@ -0,0 +1,124 @@
+"""
+benchmark of the columnar user snapshot (app.services.user_snapshot) of the analytical routes - its memory per
+user against OktaUser models and the serialized users (dicts), the time to fill it and to apply changes, and the
+latency of its filters and aggregations, against the same filter as a loop over the dicts.
+
+usage:
+    python -m benchmarks.user_snapshot --users 1000000
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+from app.api.utils import serialize_raw_item
+from app.dynamo_db.models import OktaUser
+from app.services.serializers import dumps_json, loads_json
+from app.services.timestamps import MISSING_EPOCH, epoch_to_iso, to_epoch_seconds
+from app.services.user_snapshot import UserSnapshot
+
+NOW = 1741000000
+DAY = 86400
+CHUNK = 100000
+
+
+def serialized_users(start, count):
+    users = {}
+    for i in range(start, start + count):
+        email = f"user{i}@example.com"
+        users[email] = {"email": email, "name": f"User {i}", "admin": str(i % 100 == 0), "id": f"00u{i}",
+                        "lastLogin": epoch_to_iso(NOW - (i * 7919) % (365 * DAY)) + ".000Z" if i % 10 else "",
+                        "passwordChanged": epoch_to_iso(NOW - (i * 104729) % (730 * DAY), utc=True),
+                        "statusChanged": "2024-03-01T10:00:00.000Z", "user_events": []}
+    return users
+
+
+def allocated_per_user(build, count):
+    tracemalloc.start()
+    objects = build()
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objects
+    return allocated / count
+
+
+def timed(func, runs):
+    seconds = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = func()
+        seconds.append(time.perf_counter() - start)
+    return statistics.median(seconds), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000000)
+    parser.add_argument("--sample", type=int, default=20000, help="number of users of the memory comparison.")
+    parser.add_argument("--changes", type=int, default=1000, help="number of users changed by an incremental apply.")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    sample = serialized_users(0, args.sample)
+
+    def raw_items():
+        # copies of the values, the models and dicts keep references to the strings of the items.
+        return [loads_json(dumps_json(OktaUser(**user).serialize())) for user in sample.values()]
+
+    models = allocated_per_user(lambda: [OktaUser.from_raw_data(item) for item in raw_items()], args.sample)
+    dicts = allocated_per_user(lambda: [serialize_raw_item(OktaUser, item) for item in raw_items()], args.sample)
+
+    snapshot = UserSnapshot(capacity=args.users)
+    filled = 0.0
+    for first in range(0, args.users, CHUNK):
+        users = serialized_users(first, min(CHUNK, args.users - first))
+        seconds, _ = timed(lambda: snapshot.apply(users), 1)
+        filled += seconds
+    columns = snapshot.nbytes / args.users
+
+    print(f"memory per user: OktaUser model {models:,.0f}B, serialized dict {dicts:,.0f}B, snapshot {columns:,.0f}B "
+          f"({columns / models:.1%} of a model)")
+    print(f"fill {args.users:,} users: {filled:.2f}s")
+
+    changes = {email: dict(user, lastLogin=epoch_to_iso(NOW) + ".000Z") for email, user in
+               serialized_users(args.users // 2, args.changes).items()}
+    changes[f"user{args.users - 1}@example.com"] = None
+    seconds, _ = timed(lambda: snapshot.apply(changes), 1)
+    print(f"apply {len(changes):,} changes: {seconds * 1000:.1f}ms")
+
+    threshold = NOW - 90 * DAY
+    queries = [
+        ("count inactive admins", lambda: snapshot.count(equals={"admin": "True"}, before={"lastLogin": threshold})),
+        ("count never logged in", lambda: snapshot.count(missing=["lastLogin"])),
+        ("count by admin, old password", lambda: snapshot.count_by("admin", before={"passwordChanged": threshold})),
+        ("100 oldest logins", lambda: snapshot.rows(limit=100, order_by="lastLogin",
+                                                     before={"lastLogin": threshold})),
+    ]
+    for name, query in queries:
+        seconds, _ = timed(query, args.runs)
+        print(f"{name:>30}: {seconds * 1000:.1f}ms")
+
+    # the same count as a loop over the serialized users, scaled to the number of users.
+    users = list(sample.values())
+
+    def count_inactive_admins():
+        epochs = to_epoch_seconds([user["lastLogin"] for user in users])
+        return sum(1 for user, epoch in zip(users, epochs)
+                   if MISSING_EPOCH < epoch < threshold and user["admin"] == "True")
+
+    seconds, _ = timed(count_inactive_admins, args.runs)
+    print(f"{'count inactive admins (dicts)':>30}: {seconds * args.users / args.sample * 1000:.1f}ms")
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "users.snapshot")
+        saved, _ = timed(lambda: snapshot.save(path), 1)
+        loaded, mapped = timed(lambda: UserSnapshot.load(path), 1)
+        print(f"save: {saved * 1000:.0f}ms ({os.path.getsize(path) / 2 ** 20:.0f}MB), memory-mapped load: "
+              f"{loaded * 1000:.1f}ms")
+        assert mapped.count(missing=["lastLogin"]) == snapshot.count(missing=["lastLogin"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+write capacity benchmark - applying a csv batch with a read and a full save() per user (before), against one
+partial UpdateItem per user (UserService.update_users_from_csv), with the other events embedded in the user item
+or appended to the events table.
+
+runs against moto. moto does not meter capacity, so the units are estimated the way DynamoDB charges them: a read
+is 0.5 unit per 4 KB (eventually consistent), a write is 1 unit per 1 KB of the larger of the item before and after
+the write - for a PutItem and an UpdateItem alike, so the users are created with some embedded history to show it
+(the events table case starts from migrated users, without embedded history).
+
+usage:
+    python -m benchmarks.write_capacity --users 2000 --events-per-user 20
+"""
+import argparse
+import math
+import time
+from unittest.mock import patch
+
+from moto import mock_aws
+from pynamodb.connection.base import Connection
+
+from app.dynamo_db.models import OktaUser, OktaUserEvent
+from app.dynamo_db.repositories import UserRepository, UserEventRepository
+from app.dynamo_db.service import UserService
+from app.services.timestamps import epoch_to_iso
+
+WRITE_OPERATIONS = ("PutItem", "UpdateItem")
+
+
+def value_size(value):
+    (value_type, data), = value.items()
+    if value_type in ("S", "N"):
+        return len(data.encode())
+    if value_type == "L":
+        return 3 + sum(value_size(element) + 1 for element in data)
+    if value_type == "M":
+        return 3 + sum(len(key.encode()) + value_size(element) + 1 for key, element in data.items())
+    return 1
+
+
+def item_size(item):
+    return sum(len(name.encode()) + value_size(value) for name, value in (item or {}).items())
+
+
+def measure(func):
+    """
+    :return: (seconds, {operation: count}, estimated read units, estimated write units) of func().
+    """
+    operations = {}
+    units = {"read": 0.0, "write": 0.0}
+    original_make_api_call = Connection._make_api_call
+
+    def stored_item(self, operation_kwargs):
+        data = original_make_api_call(self, "GetItem", {"TableName": operation_kwargs["TableName"],
+                                                        "Key": operation_kwargs.get("Key") or
+                                                        {"email": operation_kwargs["Item"]["email"]},
+                                                        "ConsistentRead": True})
+        return data.get("Item")
+
+    def metering_make_api_call(self, operation_name, operation_kwargs):
+        operations[operation_name] = operations.get(operation_name, 0) + 1
+
+        if operation_name == "BatchWriteItem":
+            units["write"] += sum(math.ceil(item_size(request["PutRequest"]["Item"]) / 1024)
+                                  for requests in operation_kwargs["RequestItems"].values() for request in requests)
+            return original_make_api_call(self, operation_name, operation_kwargs)
+
+        if operation_name not in WRITE_OPERATIONS:
+            data = original_make_api_call(self, operation_name, operation_kwargs)
+            units["read"] += math.ceil(max(item_size(data.get("Item")), 1) / 4096) * 0.5
+            return data
+
+        before = item_size(stored_item(self, operation_kwargs))
+        try:
+            return original_make_api_call(self, operation_name, operation_kwargs)
+        finally:
+            # a failed condition check still consumes the write.
+            after = item_size(stored_item(self, operation_kwargs))
+            units["write"] += math.ceil(max(before, after, 1) / 1024)
+
+    with patch.object(Connection, "_make_api_call", metering_make_api_call):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+
+    return elapsed, operations, units["read"], units["write"]
+
+
+def read_and_save(user_repository, users_data):
+    """the previous implementation - read every user, apply the folded events and save() the whole item."""
+    for email, user_events in UserService.fold_events(users_data).items():
+        user = user_repository.get_user_by_email(email)
+        if not user:
+            continue
+        if user_events["lastLogin"] is not None:
+            user.lastLogin = epoch_to_iso(user_events["lastLogin"], utc=True)
+        if user_events["passwordChanged"] is not None:
+            user.passwordChanged = epoch_to_iso(user_events["passwordChanged"], utc=True)
+        if user_events["admin"]:
+            user.admin = "True"
+        user.user_events = (user.user_events or []) + user_events["user_events"]
+        user_repository.save_user(user)
+
+
+def reset_users(count, events_per_user, embedded=True):
+    with OktaUser.batch_write() as batch:
+        for i in range(count):
+            batch.save(OktaUser(email=f"user{i}@example.com", admin="False", lastLogin="", name=f"User {i}",
+                                passwordChanged="", statusChanged="", id=f"00u{i}",
+                                user_events=[{"Timestamp": f"2025-02-{1 + j % 28:02d}T10:00:00",
+                                              "Event Description": "MFA Enabled"}
+                                             for j in range(events_per_user if embedded else 0)]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--events-per-user", type=int, default=20)
+    args = parser.parse_args()
+
+    # one login per user, a password reset for every 10th user and an other event for every 5th user.
+    users_data = [{"User Email": f"user{i}@example.com", "Timestamp": str(1740000000 + i),
+                   "Event Description": "User Login"} for i in range(args.users)]
+    users_data += [{"User Email": f"user{i}@example.com", "Timestamp": str(1740000000 + i),
+                    "Event Description": "Password Reset"} for i in range(0, args.users, 10)]
+    users_data += [{"User Email": f"user{i}@example.com", "Timestamp": str(1740000000 + i),
+                    "Event Description": "MFA Enabled"} for i in range(0, args.users, 5)]
+
+    with mock_aws():
+        OktaUser.create_table(read_capacity_units=5, write_capacity_units=5, wait=True)
+        OktaUserEvent.create_table(read_capacity_units=5, write_capacity_units=5, wait=True)
+        user_repository = UserRepository(OktaUser)
+        events_service = UserService(user_repository, event_repository=UserEventRepository(OktaUserEvent))
+
+        print(f"users: {args.users}, embedded events per user: {args.events_per_user}")
+        for name, func, embedded in (
+                ("read + save()", lambda: read_and_save(user_repository, users_data), True),
+                ("UpdateItem", lambda: UserService(user_repository).update_users_from_csv(users_data), True),
+                ("+ events table", lambda: events_service.update_users_from_csv(users_data), False)):
+            reset_users(args.users, args.events_per_user, embedded)
+            elapsed, operations, read_units, write_units = measure(func)
+            calls = " ".join(f"{operation}={count}" for operation, count in sorted(operations.items()))
+            print(f"{name:>14}: {calls} estimated_read_units={read_units:.1f} "
+                  f"estimated_write_units={write_units:.0f} elapsed={elapsed:.2f}s")
+
+        # the same batch again - every timestamp is already stored, the condition rejects the writes.
+        elapsed, operations, read_units, write_units = measure(lambda: events_service.update_users_from_csv(users_data))
+        calls = " ".join(f"{operation}={count}" for operation, count in sorted(operations.items()))
+        print(f"{'replayed':>14}: {calls} estimated_read_units={read_units:.1f} "
+              f"estimated_write_units={write_units:.0f} elapsed={elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
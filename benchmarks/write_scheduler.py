@@ -0,0 +1,73 @@
+"""
+benchmark of the DynamoDB write phase of the csv ingestion - one writer (before), N unlimited writers, and N writers
+limited by token buckets matched to the table capacity (WriteScheduler).
+
+runs against a simulated provisioned table rather than moto (which neither meters capacity nor throttles): every
+write takes --latency-ms, and the table accepts --capacity writes per second with one second of burst - writes above
+it fail with ProvisionedThroughputExceededException, like DynamoDB.
+
+usage:
+    python -m benchmarks.write_scheduler --writes 2000 --capacity 500 --workers 16
+"""
+import argparse
+import threading
+import time
+
+from botocore.exceptions import ClientError
+from pynamodb.exceptions import UpdateError
+
+from app.services.write_scheduler import WriteScheduler
+
+
+class ProvisionedTable:
+
+    def __init__(self, capacity, latency):
+        self.capacity = capacity
+        self.latency = latency
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def write(self, email):
+        time.sleep(self.latency)
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.capacity)
+            self.updated_at = now
+            if self.tokens < 1:
+                raise UpdateError("Failed to update item", ClientError(
+                    {"Error": {"Code": "ProvisionedThroughputExceededException", "Message": "throttled"}},
+                    "UpdateItem"))
+            self.tokens -= 1
+        return email
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--writes", type=int, default=2000)
+    parser.add_argument("--capacity", type=int, default=500)
+    parser.add_argument("--latency-ms", type=float, default=5)
+    parser.add_argument("--workers", type=int, default=16)
+    args = parser.parse_args()
+
+    cases = [("1 writer", 1, None),
+             (f"{args.workers} writers", args.workers, None),
+             (f"{args.workers} writers + bucket", args.workers, args.capacity)]
+
+    print(f"writes: {args.writes}, table capacity: {args.capacity}/s, latency: {args.latency_ms}ms")
+    for name, workers, writes_per_second in cases:
+        table = ProvisionedTable(args.capacity, args.latency_ms / 1000)
+
+        with WriteScheduler(workers=workers, writes_per_second=writes_per_second, max_retries=20) as scheduler:
+            for i in range(args.writes):
+                email = f"user{i}@example.com"
+                scheduler.submit(email, table.write, email)
+
+        stats = scheduler.stats()
+        print(f"{name:>22}: writes/sec={stats['writes_per_sec']:,.0f} throttles={stats['throttles']} "
+              f"failed={stats['failed']} elapsed={stats['seconds']:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
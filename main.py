@@ -1,13 +1,23 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
-import uvicorn
 from app.api import users
+from app.api.dependencies import close_services
+from app.api.metrics import metrics, RequestTimingMiddleware
 from fastapi.middleware.cors import CORSMiddleware
 
 
+@asynccontextmanager
+async def lifespan(app):
+    # the services are created by the requests (see app.api.dependencies), only the created ones are closed.
+    yield
+    await close_services()
+
+
 # create application.
 app = FastAPI(
     title='inventory microservice',
-    description='A project designed to transfer information from a monolithic system to a microservices-based system.'
+    description='A project designed to transfer information from a monolithic system to a microservices-based system.',
+    lifespan=lifespan
 )
 
 app.add_middleware(
@@ -18,9 +28,14 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# latency histograms and one timing log line per request.
+app.add_middleware(RequestTimingMiddleware)
+
 # include relevant routers for application.
 app.include_router(users.users)
+app.include_router(metrics)
 
 
 if __name__ == '__main__':
+    import uvicorn
     uvicorn.run("main:app", host="127.0.0.1", port=8001, reload=True)
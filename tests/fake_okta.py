@@ -0,0 +1,121 @@
+"""
+local stand-in for the Okta users API, used by the tests and the benchmarks.
+
+serves `user_count` generated users on /api/v1/users and every `admin_every`-th user on
+/api/v1/groups/{group_id}/users, paginated with 'limit'/'after' and 'Link: rel="next"' headers like Okta.
+"""
+import http.server
+import json
+import threading
+import time
+from urllib.parse import urlparse, parse_qs
+
+
+def fake_okta_user(i):
+    return {
+        "id": f"00u{i}",
+        "status": "ACTIVE",
+        "statusChanged": "2024-03-01T10:00:00.000Z",
+        "lastLogin": "2025-03-01T10:00:00.000Z",
+        "passwordChanged": "2024-01-01T10:00:00.000Z",
+        "lastUpdated": "2025-03-01T10:00:00.000Z",
+        "profile": {"firstName": "User", "lastName": str(i), "email": f"user{i}@example.com"},
+    }
+
+
+class FakeOktaServer:
+
+    def __init__(self, user_count=100, admin_every=10, rate_limit=None, max_limit=1000):
+        """
+        :param user_count: number of users in the fake organization.
+        :param admin_every: every n-th user is a member of the admin group.
+        :param rate_limit: if given, number of requests allowed per rate limit window (X-Rate-Limit-* headers).
+        :param max_limit: max page size the server accepts.
+        """
+        self.user_count = user_count
+        self.admin_every = admin_every
+        self.rate_limit = rate_limit
+        self.max_limit = max_limit
+        self.requests = []
+        self.throttled_requests = 0
+        self._window_requests = 0
+        self._lock = threading.Lock()
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler(self):
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake.requests.append(self.path)
+                parsed = urlparse(self.path)
+                query = parse_qs(parsed.query)
+
+                if parsed.path == "/api/v1/users":
+                    indexes = range(fake.user_count)
+                elif parsed.path.startswith("/api/v1/groups/") and parsed.path.endswith("/users"):
+                    indexes = range(0, fake.user_count, fake.admin_every)
+                else:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+
+                headers = fake._rate_limit_headers()
+                if headers is None:
+                    self.send_response(429)
+                    self.send_header("X-Rate-Limit-Reset", str(int(time.time())))
+                    self.end_headers()
+                    return
+
+                limit = min(int(query.get("limit", [200])[0]), fake.max_limit)
+                after = int(query.get("after", [-1])[0])
+                start = indexes.index(after) + 1 if after >= 0 else 0
+                page = list(indexes[start:start + limit])
+                body = json.dumps([fake_okta_user(i) for i in page]).encode()
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                if page and page[-1] != indexes[-1]:
+                    next_url = f"{fake.base_url}{parsed.path}?limit={limit}&after={page[-1]}"
+                    self.send_header("Link", f'<{next_url}>; rel="next"')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def _rate_limit_headers(self):
+        """
+        :return: X-Rate-Limit-* headers of the current request, or None if the request is throttled (429).
+        """
+        if self.rate_limit is None:
+            return {}
+
+        with self._lock:
+            if self._window_requests >= self.rate_limit:
+                # new window - the fake window resets immediately after a rejected request.
+                self._window_requests = 0
+                self.throttled_requests += 1
+                return None
+
+            self._window_requests += 1
+            return {
+                "X-Rate-Limit-Limit": str(self.rate_limit),
+                "X-Rate-Limit-Remaining": str(self.rate_limit - self._window_requests),
+                "X-Rate-Limit-Reset": str(int(time.time())),
+            }
@@ -0,0 +1,103 @@
+"""
+local stand-in for a public S3 object, used by the tests and the benchmarks.
+
+serves `content` on any path, with 'Range: bytes=N-' support (206 responses), HEAD requests and ETag /
+Last-Modified / If-Match headers like S3. `content` can be replaced while serving, to change the object.
+"""
+import hashlib
+import http.server
+import threading
+from email.utils import formatdate
+
+
+def audit_csv(rows, users=100):
+    """
+    :return: bytes of an audit csv file with `rows` events spread over `users` users.
+    """
+    events = ["User Login", "Password Changed", "Admin Role Granted", "User Logout"]
+    lines = ["User Email,Timestamp,Event Description"]
+    lines += [f"user{i % users}@example.com,{1700000000 + i},{events[i % len(events)]}" for i in range(rows)]
+    return ("\n".join(lines) + "\n").encode()
+
+
+class FakeS3Server:
+
+    def __init__(self, content, support_range=True, versioned=True):
+        """
+        :param content: bytes of the object.
+        :param support_range: if False, Range headers are ignored and the whole object is always sent.
+        :param versioned: if False, no ETag / Last-Modified headers are sent.
+        """
+        self.content = content
+        self.support_range = support_range
+        self.versioned = versioned
+        # Range header of every GET request, and number of HEAD requests.
+        self.requests = []
+        self.head_requests = 0
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.url = f"http://127.0.0.1:{self.server.server_port}/audit.csv"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler(self):
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def send_version_headers(self, content):
+                if fake.versioned:
+                    self.send_header("ETag", f'"{hashlib.md5(content).hexdigest()}"')
+                    self.send_header("Last-Modified", formatdate(1700000000 + len(content), usegmt=True))
+
+            def do_HEAD(self):
+                fake.head_requests += 1
+                self.send_response(200)
+                self.send_version_headers(fake.content)
+                self.send_header("Content-Length", str(len(fake.content)))
+                self.end_headers()
+
+            def do_GET(self):
+                range_header = self.headers.get("Range")
+                fake.requests.append(range_header)
+                content = fake.content
+                size = len(content)
+
+                if_match = self.headers.get("If-Match")
+                if fake.versioned and if_match and if_match != f'"{hashlib.md5(content).hexdigest()}"':
+                    self.send_response(412)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                if range_header and fake.support_range:
+                    start = int(range_header.removeprefix("bytes=").split("-")[0])
+                    if start >= size:
+                        self.send_response(416)
+                        self.send_header("Content-Range", f"bytes */{size}")
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+
+                    body = content[start:]
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{size - 1}/{size}")
+                else:
+                    body = content
+                    self.send_response(200)
+
+                self.send_version_headers(content)
+                self.send_header("Content-Type", "text/csv")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
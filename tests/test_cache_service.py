@@ -0,0 +1,166 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import fakeredis
+import fakeredis.aioredis
+import pytest
+from app.services.cache_service import CacheService, AsyncCacheService, CacheTimeout
+from app.services.redis_service import RedisService, AsyncRedisService
+
+
+@pytest.fixture
+def cache_service():
+    return CacheService(RedisService(redis_client=fakeredis.FakeRedis()), poll_interval=0.01)
+
+
+class SlowBackend:
+    """backend stand-in that counts its calls."""
+
+    def __init__(self, delay=0.2):
+        self.delay = delay
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            self.calls += 1
+            call = self.calls
+        time.sleep(self.delay)
+        return {"version": call}
+
+
+def run_concurrently(func, requests=200):
+    barrier = threading.Barrier(requests)
+
+    def request():
+        barrier.wait()
+        return func()
+
+    with ThreadPoolExecutor(max_workers=requests) as executor:
+        return list(executor.map(lambda _: request(), range(requests)))
+
+
+def test_get_or_compute_caches_value(cache_service):
+    backend = SlowBackend(delay=0)
+
+    assert cache_service.get_or_compute("key", backend, ttl=60) == {"version": 1}
+    assert cache_service.get_or_compute("key", backend, ttl=60) == {"version": 1}
+    assert backend.calls == 1
+
+
+def test_single_flight_on_concurrent_misses(cache_service):
+    backend = SlowBackend()
+
+    results = run_concurrently(lambda: cache_service.get_or_compute("scan results", backend, ttl=60))
+
+    # 200 concurrent misses -> one backend call, every request gets its result.
+    assert backend.calls == 1
+    assert results == [{"version": 1}] * 200
+
+
+def test_stale_while_revalidate(cache_service):
+    backend = SlowBackend()
+    cache_service.set("okta_users_data", {"version": 0}, ttl=-1, stale_ttl=60)
+
+    start = time.monotonic()
+    results = run_concurrently(lambda: cache_service.get_or_compute("okta_users_data", backend, ttl=60))
+
+    # all the requests are served the stale value without waiting for the backend.
+    assert results == [{"version": 0}] * 200
+    assert time.monotonic() - start < backend.delay * 5
+
+    # one background refresh.
+    deadline = time.monotonic() + 5
+    while cache_service.get_or_compute("okta_users_data", backend, ttl=60) != {"version": 1}:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert backend.calls == 1
+
+
+def test_early_refresh_probability(cache_service):
+    not_expiring = {"value": 1, "expires": time.time() + 3600, "delta": 0.1}
+    about_to_expire = {"value": 1, "expires": time.time() + 0.001, "delta": 10}
+
+    assert not any(cache_service._should_refresh(not_expiring) for _ in range(1000))
+    assert sum(cache_service._should_refresh(about_to_expire) for _ in range(1000)) > 900
+
+
+def test_lock_released_after_backend_error(cache_service):
+    def failing_backend():
+        raise RuntimeError("backend down")
+
+    with pytest.raises(RuntimeError):
+        cache_service.get_or_compute("key", failing_backend, ttl=60)
+
+    assert cache_service.get_or_compute("key", SlowBackend(delay=0), ttl=60) == {"version": 1}
+
+
+def test_backend_slower_than_wait_timeout():
+    cache_service = CacheService(RedisService(redis_client=fakeredis.FakeRedis()), lock_timeout=0.3,
+                                 wait_timeout=0.2, poll_interval=0.01)
+    backend = SlowBackend(delay=1.0)
+
+    def request():
+        try:
+            return cache_service.get_or_compute("scan results", backend, ttl=60)
+        except CacheTimeout:
+            return "timeout"
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # the lock is extended while the backend runs - a request after lock_timeout still waits for it.
+        late = executor.submit(lambda: (time.sleep(0.5),
+                                        cache_service.get_or_compute("scan results", backend, ttl=60,
+                                                                     wait_timeout=2))[1])
+        results = run_concurrently(request, requests=20)
+
+        # the waiters give up after wait_timeout instead of calling the backend.
+        assert late.result() == {"version": 1}
+    assert backend.calls == 1
+    assert results.count({"version": 1}) == 1
+    assert results.count("timeout") == 19
+
+
+def test_async_backend_slower_than_wait_timeout():
+    cache_service = AsyncCacheService(AsyncRedisService(redis_client=fakeredis.aioredis.FakeRedis()),
+                                      lock_timeout=0.3, wait_timeout=0.2, poll_interval=0.01)
+    calls = []
+
+    async def backend():
+        calls.append(1)
+        await asyncio.sleep(1.0)
+        return {"version": len(calls)}
+
+    async def late():
+        await asyncio.sleep(0.5)
+        return await cache_service.get_or_compute("scan results", backend, ttl=60, wait_timeout=2)
+
+    async def run():
+        return await asyncio.gather(late(), *[cache_service.get_or_compute("scan results", backend, ttl=60)
+                                              for _ in range(20)], return_exceptions=True)
+
+    results = asyncio.run(run())
+
+    assert len(calls) == 1
+    assert results[:2] == [{"version": 1}] * 2
+    assert all(isinstance(result, CacheTimeout) for result in results[2:])
+
+
+def test_async_single_flight_on_concurrent_misses():
+    cache_service = AsyncCacheService(AsyncRedisService(redis_client=fakeredis.aioredis.FakeRedis()),
+                                      poll_interval=0.01)
+    calls = []
+
+    async def backend():
+        calls.append(1)
+        await asyncio.sleep(0.2)
+        return {"version": len(calls)}
+
+    async def run():
+        return await asyncio.gather(*[cache_service.get_or_compute("scan results", backend, ttl=60)
+                                      for _ in range(200)])
+
+    results = asyncio.run(run())
+
+    assert len(calls) == 1
+    assert results == [{"version": 1}] * 200
@@ -0,0 +1,115 @@
+import csv
+import pytest
+import requests
+from app.api.utils import download_csv_from_s3, get_s3_fingerprint
+from app.dynamo_db.service import UserService
+from app.services.csv_ingest import (split_byte_ranges, fold_csv_file, fold_rows, merge_folded_events,
+                                     iter_folded_windows, read_csv_header)
+from tests.fake_s3 import FakeS3Server, audit_csv
+
+
+@pytest.fixture
+def csv_file(tmp_path):
+    path = tmp_path / "audit.csv"
+    path.write_bytes(audit_csv(rows=5000, users=300))
+    return str(path)
+
+
+def test_split_byte_ranges_are_line_aligned(csv_file):
+    with open(csv_file, "rb") as f:
+        content = f.read()
+
+    fieldnames, ranges = split_byte_ranges(csv_file, 16)
+
+    assert fieldnames == ["User Email", "Timestamp", "Event Description"]
+    assert len(ranges) == 16
+    assert ranges[0][0] == content.index(b"\n") + 1
+    assert ranges[-1][1] == len(content)
+    for (_, end), (start, _) in zip(ranges, ranges[1:]):
+        assert end == start
+        assert content[start - 1:start] == b"\n"
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_fold_csv_file_parity_with_single_pass(csv_file, workers):
+    with open(csv_file) as f:
+        expected = UserService.fold_events(csv.DictReader(f))
+
+    assert fold_csv_file(csv_file, workers=workers) == expected
+
+
+def test_folded_windows_cover_the_file(csv_file):
+    with open(csv_file, "rb") as f:
+        content = f.read()
+    fieldnames, start = read_csv_header(csv_file)
+
+    windows = list(iter_folded_windows(csv_file, fieldnames, start, window_bytes=len(content) // 7, workers=1))
+
+    assert len(windows) in (7, 8)
+    assert windows[-1][0] == len(content)
+    assert all(content[end - 1:end] == b"\n" for end, _, _ in windows)
+    assert sum(rows for _, rows, _ in windows) == 5000
+    logouts = [event for _, _, folded in windows for user_events in folded.values()
+               for event in user_events["user_events"]]
+    assert len(logouts) == 1250
+
+
+def test_header_without_the_needed_columns(tmp_path):
+    path = tmp_path / "audit.csv"
+    path.write_bytes(b"email,Timestamp,Event Description\nuser@example.com,1700000000,User Login\n")
+
+    with pytest.raises(ValueError, match="no User Email column"):
+        fold_csv_file(str(path), workers=1)
+    with pytest.raises(ValueError, match="no Event Description column"):
+        fold_rows([], ["User Email", "Timestamp"])
+
+
+def test_merge_folded_events_keeps_latest_timestamps():
+    fieldnames = ["User Email", "Timestamp", "Event Description"]
+    rows = [["a@example.com", str(ts), description]
+            for ts, description in [(30, "User Login"), (10, "MFA Enabled"), (20, "User Login"),
+                                    (40, "Admin Role Granted"), (50, "Password Changed"), (60, "MFA Enabled")]]
+    rows += [["", "70", "User Login"], ["a@example.com", "not a number", "User Login"], [],
+             ["a@example.com", "1000000000000000", "User Login"], ["a@example.com", "-99999999999999", "MFA Enabled"]]
+
+    partials = [fold_rows(rows[:3], fieldnames), fold_rows(rows[3:], fieldnames)]
+
+    assert merge_folded_events(partials) == UserService.fold_events(dict(zip(fieldnames, row)) for row in rows)
+
+
+def test_download_csv_from_s3(tmp_path):
+    content = audit_csv(rows=100)
+    path = tmp_path / "audit.csv"
+
+    with FakeS3Server(content) as server:
+        assert download_csv_from_s3(server.url, str(path), chunk_size=256) == len(content)
+
+    assert path.read_bytes() == content
+
+
+def test_download_csv_from_s3_resumes_at_an_offset(tmp_path):
+    content = audit_csv(rows=100)
+    path = tmp_path / "audit.csv"
+
+    for support_range in (True, False):
+        with FakeS3Server(content, support_range=support_range) as server:
+            etag = get_s3_fingerprint(server.url)["etag"]
+            assert download_csv_from_s3(server.url, str(path), chunk_size=256, start_offset=1000,
+                                        if_match=etag) == len(content) - 1000
+            assert path.read_bytes() == content[1000:]
+
+            assert download_csv_from_s3(server.url, str(path), start_offset=len(content)) == 0
+
+            with pytest.raises(requests.exceptions.RequestException, match="changed"):
+                download_csv_from_s3(server.url, str(path), if_match='"other"')
+
+
+def test_fold_skips_out_of_range_timestamps():
+    rows = [{"User Email": "a@example.com", "Timestamp": "1000000000000000", "Event Description": "MFA Enabled"},
+            {"User Email": "a@example.com", "Timestamp": "1000000000000000", "Event Description": "User Login"},
+            {"User Email": "a@example.com", "Timestamp": "1700000000", "Event Description": "MFA Enabled"},
+            {"User Email": "b@example.com", "Timestamp": "-99999999999999", "Event Description": "Admin Role Granted"}]
+
+    assert UserService.fold_events(rows) == {
+        "a@example.com": {"lastLogin": None, "passwordChanged": None, "admin": False,
+                          "user_events": [{"Timestamp": "2023-11-14T22:13:20", "Event Description": "MFA Enabled"}]}}
@@ -1,8 +1,16 @@
 import pytest
+from datetime import datetime, timezone
+import threading
+from unittest.mock import patch
+from botocore.exceptions import ClientError
 from moto import mock_aws
-from app.dynamo_db.models import OktaUser
-from app.dynamo_db.repositories import UserRepository
+from pynamodb.connection.base import Connection
+from pynamodb.exceptions import UpdateError
+from app.dynamo_db.models import OktaUser, OktaUserEvent
+from app.dynamo_db.repositories import UserRepository, UserEventRepository
 from app.dynamo_db.service import UserService
+from app.api.utils import serialize_okta_user, serialize_raw_item
+from app.dynamo_db.migrations import add_admin_password_index, migrate_user_events
 
 
 @pytest.fixture(scope="module", autouse=True)
@@ -15,6 +23,7 @@ def setup_dynamodb():
             write_capacity_units=5,
             wait=True
         )
+        OktaUserEvent.create_table(read_capacity_units=5, write_capacity_units=5, wait=True)
         # create list with 2 users.
         users = [
             OktaUser(
@@ -120,3 +129,456 @@ def test_update_users_from_csv_admin_role_granted(setup_dynamodb):
 
     assert user.admin == "True"
     assert response == "users details changes successfully in DB."
+
+
+def test_upload_user_data_to_db_report(setup_dynamodb):
+    user_repository = UserRepository(OktaUser)
+
+    users = {
+        "user_1": {"email": "user1@example.com", "lastLogin": "2025-01-01T00:00:00.000Z"},
+        "user_new": {"email": "new@example.com", "name": "New User", "admin": False},
+        "user_no_email": {"name": "No Email"},
+    }
+
+    report = user_repository.upload_user_data_to_db(users)
+
+    assert report["updated"] == ["user1@example.com"]
+    assert report["created"] == ["new@example.com"]
+    assert list(report["failed"]) == ["user_no_email"]
+
+    user = user_repository.get_user_by_email("user1@example.com")
+    assert user.lastLogin == "2025-01-01T00:00:00.000Z"
+    # fields that Okta did not send keep their values.
+    assert user.passwordChanged == "2024-02-28"
+
+    OktaUser.get("new@example.com").delete()
+
+
+def test_upload_user_data_to_db_without_reads(setup_dynamodb):
+    user_repository = UserRepository(OktaUser)
+    users = {f"bulk_{i}": {"email": f"bulk{i}@example.com", "name": f"Bulk {i}"} for i in range(1000)}
+
+    calls = []
+    original_make_api_call = Connection._make_api_call
+
+    def counting_make_api_call(self, operation_name, operation_kwargs):
+        calls.append(operation_name)
+        return original_make_api_call(self, operation_name, operation_kwargs)
+
+    with patch.object(Connection, "_make_api_call", counting_make_api_call):
+        report = user_repository.upload_user_data_to_db(users)
+
+    assert len(report["created"]) == 1000
+    assert not report["failed"]
+
+    # one partial UpdateItem per user, no read before the write.
+    assert calls.count("UpdateItem") == 1000
+    assert len(calls) == 1000
+
+    with OktaUser.batch_write() as batch:
+        for user in OktaUser.batch_get([data["email"] for data in users.values()]):
+            batch.delete(user)
+
+
+def test_upload_user_data_to_db_retries_failed_updates(setup_dynamodb):
+    user_repository = UserRepository(OktaUser)
+    users = {"retry_1": {"email": "retry1@example.com"}, "retry_2": {"email": "retry2@example.com"}}
+
+    original_update_item = Connection.update_item
+    attempts = []
+
+    def flaky_update_item(self, table_name, hash_key, *args, **kwargs):
+        attempts.append(hash_key)
+        if attempts.count("retry2@example.com") == 1 and hash_key == "retry2@example.com":
+            raise UpdateError("Failed to update item", ClientError(
+                {"Error": {"Code": "ProvisionedThroughputExceededException", "Message": "throttled"}}, "UpdateItem"))
+        return original_update_item(self, table_name, hash_key, *args, **kwargs)
+
+    with patch.object(Connection, "update_item", flaky_update_item):
+        report = user_repository.upload_user_data_to_db(users, backoff_base=0)
+
+    assert sorted(report["created"]) == ["retry1@example.com", "retry2@example.com"]
+    assert attempts.count("retry2@example.com") == 2
+    assert OktaUser.get("retry2@example.com").id == "retry_2"
+
+    OktaUser.get("retry1@example.com").delete()
+    OktaUser.get("retry2@example.com").delete()
+
+
+def _update_users_row_by_row(user_repository, users_data):
+    """reference implementation - one read and one write per csv row."""
+    for user in users_data:
+        email = user.get("User Email")
+        timestamp = user.get("Timestamp")
+        event_description = user.get("Event Description")
+
+        if not email or not timestamp or not event_description:
+            continue
+        try:
+            formatted_timestamp = datetime.fromtimestamp(int(timestamp), tz=timezone.utc).isoformat() + "Z"
+        except ValueError:
+            continue
+
+        res = user_repository.get_user_by_email(email)
+        if res:
+            if "Login" in event_description:
+                res.lastLogin = formatted_timestamp
+            elif "Password" in event_description:
+                res.passwordChanged = formatted_timestamp
+            elif event_description == "Admin Role Granted":
+                res.admin = "True"
+            else:
+                if not res.user_events:
+                    res.user_events = []
+                res.user_events.append({
+                    'Timestamp': datetime.utcfromtimestamp(int(timestamp)).isoformat(),
+                    'Event Description': event_description
+                })
+            res.save()
+
+
+def test_update_users_from_csv_parity_with_row_by_row(setup_dynamodb):
+    user_repository = UserRepository(OktaUser)
+    user_service = UserService(user_repository)
+    emails = ["parity1@example.com", "parity2@example.com"]
+
+    def reset_users():
+        for i, email in enumerate(emails):
+            OktaUser(email=email, admin="False", lastLogin="", name=f"Parity {i}", passwordChanged="",
+                     statusChanged="", id=f"parity_{i}",
+                     user_events=[{"Timestamp": "2020-01-01T00:00:00", "Event Description": "Old Event"}]).save()
+
+    # audit log rows ordered by time.
+    users_data = [
+        {"User Email": emails[0], "Timestamp": "1677660000", "Event Description": "User Login"},
+        {"User Email": emails[1], "Timestamp": "1677660010", "Event Description": "MFA Enabled"},
+        {"User Email": emails[0], "Timestamp": "1677660020", "Event Description": "Password Reset"},
+        {"User Email": emails[0], "Timestamp": "1677660030", "Event Description": "Profile Updated"},
+        {"User Email": emails[1], "Timestamp": "1677660040", "Event Description": "Admin Role Granted"},
+        {"User Email": emails[0], "Timestamp": "not a number", "Event Description": "User Login"},
+        {"User Email": "", "Timestamp": "1677660050", "Event Description": "User Login"},
+        {"User Email": "missing@example.com", "Timestamp": "1677660060", "Event Description": "User Login"},
+        {"User Email": emails[1], "Timestamp": "1677660070", "Event Description": "Device Added"},
+        {"User Email": emails[0], "Timestamp": "1677660080", "Event Description": "User Login"},
+        {"User Email": emails[1], "Timestamp": "1677660090", "Event Description": "MFA Enabled"},
+    ]
+
+    reset_users()
+    _update_users_row_by_row(user_repository, users_data)
+    expected = [serialize_okta_user(OktaUser.get(email)) for email in emails]
+
+    reset_users()
+    calls = []
+    original_make_api_call = Connection._make_api_call
+
+    def counting_make_api_call(self, operation_name, operation_kwargs):
+        calls.append(operation_name)
+        return original_make_api_call(self, operation_name, operation_kwargs)
+
+    with patch.object(Connection, "_make_api_call", counting_make_api_call):
+        user_service.update_users_from_csv(users_data)
+
+    assert [serialize_okta_user(OktaUser.get(email)) for email in emails] == expected
+    # one partial update per distinct user, the missing user costs a failed update and a read.
+    assert calls.count("UpdateItem") == 3
+    assert calls.count("GetItem") == 1
+    assert calls.count("PutItem") == 0
+
+    for email in emails:
+        OktaUser.get(email).delete()
+
+
+def test_get_admins_with_old_password(setup_dynamodb):
+    user_repository = UserRepository(OktaUser)
+    recent = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+    OktaUser(email="recent_admin@example.com", admin="True", lastLogin="", name="Recent Admin",
+             passwordChanged=recent, statusChanged="", id="recent_admin").save()
+    OktaUser(email="no_password_admin@example.com", admin="True", lastLogin="", name="No Password Admin",
+             passwordChanged="", statusChanged="", id="no_password_admin").save()
+
+    admin_emails = [admin.email for admin in user_repository.get_admins_with_old_password(days=7)]
+
+    assert "user2@example.com" in admin_emails
+    assert "recent_admin@example.com" not in admin_emails
+    assert "no_password_admin@example.com" not in admin_emails
+
+    # sorted by the password change date.
+    admin_emails = [admin.email for admin in user_repository.get_admins_with_old_password(days=-1)]
+    assert admin_emails[-1] == "recent_admin@example.com"
+    assert "no_password_admin@example.com" not in admin_emails
+
+    OktaUser.get("recent_admin@example.com").delete()
+    OktaUser.get("no_password_admin@example.com").delete()
+
+
+def test_backfill_admin_password_index(setup_dynamodb):
+    user_repository = UserRepository(OktaUser)
+
+    # admin saved before the index existed - without the index keys.
+    OktaUser._get_connection().put_item("old_admin@example.com", attributes={
+        "admin": {"S": "True"}, "lastLogin": {"S": ""}, "name": {"S": "Old Admin"},
+        "passwordChanged": {"S": "2020-01-01T00:00:00.000Z"}, "statusChanged": {"S": ""}, "id": {"S": "old_admin"}
+    })
+    assert "old_admin@example.com" not in [admin.email for admin in user_repository.get_admins_with_old_password()]
+
+    assert add_admin_password_index() == 1
+
+    assert "old_admin@example.com" in [admin.email for admin in user_repository.get_admins_with_old_password()]
+
+    OktaUser.get("old_admin@example.com").delete()
+
+
+def test_scan_table_parallel_segments(setup_dynamodb):
+    user_repository = UserRepository(OktaUser)
+
+    sequential = sorted(user.email for user in user_repository.scan_table())
+    parallel = sorted(user.email for user in user_repository.scan_table(total_segments=4))
+
+    assert parallel == sequential
+
+
+def test_scan_page(setup_dynamodb):
+    user_repository = UserRepository(OktaUser)
+    all_emails = sorted(user.email for user in user_repository.scan_table())
+
+    emails, last_evaluated_key = [], None
+    while True:
+        page, last_evaluated_key = user_repository.scan_page(limit=1, last_evaluated_key=last_evaluated_key)
+        emails.extend(user.email for user in page)
+        if last_evaluated_key is None:
+            break
+
+    assert sorted(emails) == all_emails
+
+
+def test_scan_raw_items(setup_dynamodb):
+    user_repository = UserRepository(OktaUser)
+
+    def by_email(users):
+        return sorted(users, key=lambda user: user["email"])
+
+    expected = by_email(serialize_okta_user(user) for user in user_repository.scan_table())
+
+    for total_segments in (1, 4):
+        raw_items = user_repository.scan_table(total_segments=total_segments, raw=True)
+        assert by_email(serialize_raw_item(OktaUser, item) for item in raw_items) == expected
+
+    page, last_evaluated_key = user_repository.scan_page(limit=1, raw=True)
+    assert len(page) == 1 and "email" in page[0] and last_evaluated_key is not None
+
+
+def test_on_users_written_callback(setup_dynamodb):
+    written = []
+    user_repository = UserRepository(OktaUser, on_users_written=written.extend)
+
+    user_repository.upload_user_data_to_db({"user_1": {"email": "user1@example.com"}})
+    user_repository.save_user(user_repository.get_user_by_email("user2@example.com"))
+
+    assert written == ["user1@example.com", "user2@example.com"]
+
+
+def test_user_events_time_range_pagination(setup_dynamodb):
+    event_repository = UserEventRepository(OktaUserEvent)
+    events = [("events@example.com", {"Timestamp": f"2025-03-{day:02d}T10:00:00", "Event Description": "MFA Enabled"})
+              for day in range(1, 11)]
+    # two events in the same second, and an event of another user.
+    events.append(("events@example.com", {"Timestamp": "2025-03-05T10:00:00", "Event Description": "Device Added"}))
+    events.append(("other@example.com", {"Timestamp": "2025-03-05T10:00:00", "Event Description": "MFA Enabled"}))
+
+    assert event_repository.add_events(events) == 12
+    # writing the same events again does not duplicate them.
+    event_repository.add_events(events[:3])
+
+    timestamps, last_evaluated_key = [], None
+    while True:
+        page, last_evaluated_key = event_repository.get_events("events@example.com", start="2025-03-03T00:00:00",
+                                                               end="2025-03-05T10:00:00", limit=2,
+                                                               last_evaluated_key=last_evaluated_key)
+        timestamps.extend(event.timestamp for event in page)
+        if last_evaluated_key is None:
+            break
+
+    assert timestamps == ["2025-03-03T10:00:00", "2025-03-04T10:00:00", "2025-03-05T10:00:00",
+                          "2025-03-05T10:00:00"]
+
+    latest, _ = event_repository.get_events("events@example.com", limit=1, newest_first=True)
+    assert latest[0].to_event() == {"Timestamp": "2025-03-10T10:00:00", "Event Description": "MFA Enabled"}
+    assert len(list(event_repository.iter_events("events@example.com", end="2025-03-02T10:00:00"))) == 2
+    assert len(list(event_repository.iter_events("events@example.com"))) == 11
+
+    with OktaUserEvent.batch_write() as batch:
+        for email in ("events@example.com", "other@example.com"):
+            for event in OktaUserEvent.query(email):
+                batch.delete(event)
+
+
+def test_update_users_from_csv_appends_to_events_table(setup_dynamodb):
+    event_repository = UserEventRepository(OktaUserEvent)
+    user_service = UserService(UserRepository(OktaUser), event_repository=event_repository)
+    OktaUser(email="appender@example.com", admin="False", lastLogin="", name="Appender", passwordChanged="",
+             statusChanged="", id="appender").save()
+
+    users_data = [
+        {"User Email": "appender@example.com", "Timestamp": "1677660000", "Event Description": "MFA Enabled"},
+        {"User Email": "appender@example.com", "Timestamp": "1677660010", "Event Description": "User Login"},
+        {"User Email": "appender@example.com", "Timestamp": "1677660020", "Event Description": "Device Added"},
+        {"User Email": "missing@example.com", "Timestamp": "1677660030", "Event Description": "MFA Enabled"},
+    ]
+    user_service.update_users_from_csv(users_data)
+
+    user = OktaUser.get("appender@example.com")
+    assert user.lastLogin == "2023-03-01T08:40:10+00:00Z"
+    # the user item does not grow with the events.
+    assert user.user_events == []
+    assert [event.to_event() for event in event_repository.iter_events("appender@example.com")] == [
+        {"Timestamp": "2023-03-01T08:40:00", "Event Description": "MFA Enabled"},
+        {"Timestamp": "2023-03-01T08:40:20", "Event Description": "Device Added"},
+    ]
+    assert list(event_repository.iter_events("missing@example.com")) == []
+
+    user.delete()
+    for event in OktaUserEvent.query("appender@example.com"):
+        event.delete()
+
+
+def test_migrate_user_events(setup_dynamodb):
+    embedded = [{"Timestamp": f"2020-01-0{i}T00:00:00", "Event Description": "Old Event"} for i in range(1, 4)]
+    OktaUser(email="embedded@example.com", admin="True", lastLogin="", name="Embedded", passwordChanged="2020",
+             statusChanged="", id="embedded", user_events=embedded).save()
+
+    report = migrate_user_events()
+
+    assert report == {"users": 1, "events": 3, "skipped": 0}
+    user = OktaUser.get("embedded@example.com")
+    assert user.user_events == []
+    # the rest of the item is untouched.
+    assert user.name == "Embedded" and user.adminPasswordChanged == "2020"
+    assert [event.to_event() for event in OktaUserEvent.query("embedded@example.com")] == embedded
+
+    # nothing left to migrate.
+    assert migrate_user_events() == {"users": 0, "events": 0, "skipped": 0}
+
+    user.delete()
+    for event in OktaUserEvent.query("embedded@example.com"):
+        event.delete()
+
+
+def test_update_users_from_csv_keeps_timestamps_monotonic(setup_dynamodb):
+    user_repository = UserRepository(OktaUser)
+    user_service = UserService(user_repository)
+    OktaUser(email="monotonic@example.com", admin="True", lastLogin="", name="Monotonic", passwordChanged="",
+             statusChanged="", id="monotonic").save()
+
+    newer = [{"User Email": "monotonic@example.com", "Timestamp": "1677660100", "Event Description": "User Login"},
+             {"User Email": "monotonic@example.com", "Timestamp": "1677660100", "Event Description": "Password Reset"}]
+    older = [{"User Email": "monotonic@example.com", "Timestamp": "1677660000", "Event Description": "User Login"},
+             {"User Email": "monotonic@example.com", "Timestamp": "1677660000", "Event Description": "Password Reset"},
+             {"User Email": "monotonic@example.com", "Timestamp": "1677660000", "Event Description": "MFA Enabled"}]
+
+    # the older file is ingested last.
+    user_service.update_users_from_csv(newer)
+    user_service.update_users_from_csv(older)
+
+    user = OktaUser.get("monotonic@example.com")
+    assert user.lastLogin == "2023-03-01T08:41:40+00:00Z"
+    assert user.passwordChanged == "2023-03-01T08:41:40+00:00Z"
+    # the rest of the older file is still applied.
+    assert user.user_events == [{"Timestamp": "2023-03-01T08:40:00", "Event Description": "MFA Enabled"}]
+    # the admin index keys follow the partial updates.
+    assert user.adminKey == "True" and user.adminPasswordChanged == user.passwordChanged
+    assert "monotonic@example.com" in [admin.email for admin in user_repository.get_admins_with_old_password()]
+
+    user.delete()
+
+
+def test_upload_user_data_to_db_keeps_admin_index_keys(setup_dynamodb):
+    user_repository = UserRepository(OktaUser)
+
+    user_repository.upload_user_data_to_db({"okta_admin": {"email": "okta_admin@example.com", "admin": True,
+                                                           "passwordChanged": "2020-01-01T00:00:00.000Z"}})
+    user = OktaUser.get("okta_admin@example.com")
+    assert user.adminKey == "True" and user.adminPasswordChanged == "2020-01-01T00:00:00.000Z"
+
+    user_repository.upload_user_data_to_db({"okta_admin": {"email": "okta_admin@example.com",
+                                                           "passwordChanged": "2020-02-01T00:00:00.000Z"}})
+    assert OktaUser.get("okta_admin@example.com").adminPasswordChanged == "2020-02-01T00:00:00.000Z"
+
+    user.delete()
+
+
+def test_interleaved_ingesters_do_not_lose_updates(setup_dynamodb):
+    OktaUser(email="interleaved@example.com", admin="False", lastLogin="", name="Interleaved", passwordChanged="",
+             statusChanged="", id="interleaved").save()
+
+    # two overlapping audit files, ingested at the same time.
+    first = [{"User Email": "interleaved@example.com", "Timestamp": "1677660200", "Event Description": "User Login"},
+             {"User Email": "interleaved@example.com", "Timestamp": "1677660010", "Event Description": "MFA Enabled"}]
+    second = [{"User Email": "interleaved@example.com", "Timestamp": "1677660100", "Event Description": "User Login"},
+              {"User Email": "interleaved@example.com", "Timestamp": "1677660100",
+               "Event Description": "Password Reset"},
+              {"User Email": "interleaved@example.com", "Timestamp": "1677660020",
+               "Event Description": "Admin Role Granted"},
+              {"User Email": "interleaved@example.com", "Timestamp": "1677660030", "Event Description": "Device Added"}]
+
+    # both ingesters reach DynamoDB before any of them wrote.
+    barrier = threading.Barrier(2, timeout=5)
+    # DynamoDB applies every UpdateItem (condition included) atomically, moto does not lock the item.
+    item_lock = threading.Lock()
+    original_update_item = Connection.update_item
+
+    def interleaved_update_item(self, *args, **kwargs):
+        if threading.current_thread() is not threading.main_thread() and not barrier.broken:
+            try:
+                barrier.wait()
+            except threading.BrokenBarrierError:
+                pass
+        with item_lock:
+            return original_update_item(self, *args, **kwargs)
+
+    errors = []
+
+    def ingest(users_data):
+        try:
+            UserService(UserRepository(OktaUser)).update_users_from_csv(users_data)
+        except Exception as e:
+            errors.append(e)
+
+    with patch.object(Connection, "update_item", interleaved_update_item):
+        ingesters = [threading.Thread(target=ingest, args=(users_data,)) for users_data in (first, second)]
+        for ingester in ingesters:
+            ingester.start()
+        for ingester in ingesters:
+            ingester.join()
+
+    assert not errors
+    user = OktaUser.get("interleaved@example.com")
+    # every field keeps the newest value written by any of the ingesters.
+    assert user.lastLogin == "2023-03-01T08:43:20+00:00Z"
+    assert user.passwordChanged == "2023-03-01T08:41:40+00:00Z"
+    assert user.admin == "True"
+    assert user.adminPasswordChanged == user.passwordChanged
+    assert sorted(event["Event Description"] for event in user.user_events) == ["Device Added", "MFA Enabled"]
+
+    user.delete()
+
+
+def test_update_users_from_csv_concurrent_writers(setup_dynamodb):
+    user_service = UserService(UserRepository(OktaUser), writers=4, writes_per_second=1000)
+    emails = [f"writer{i}@example.com" for i in range(20)]
+    with OktaUser.batch_write() as batch:
+        for i, email in enumerate(emails):
+            batch.save(OktaUser(email=email, admin="False", lastLogin="", name=f"Writer {i}", passwordChanged="",
+                                statusChanged="", id=f"writer_{i}"))
+
+    users_data = [{"User Email": email, "Timestamp": str(1677660000 + i), "Event Description": "User Login"}
+                  for i, email in enumerate(emails)]
+    user_service.update_users_from_csv(users_data)
+
+    assert [OktaUser.get(email).lastLogin for email in emails] == [
+        datetime.fromtimestamp(1677660000 + i, tz=timezone.utc).isoformat() + "Z" for i in range(20)]
+    assert user_service.last_write_stats["writes"] == 20
+    assert user_service.last_write_stats["throttles"] == 0
+
+    with OktaUser.batch_write() as batch:
+        for email in emails:
+            batch.delete(OktaUser(email=email))
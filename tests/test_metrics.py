@@ -0,0 +1,149 @@
+import asyncio
+import json
+import logging
+import fakeredis
+import pytest
+from fastapi import FastAPI
+from moto import mock_aws
+from prometheus_client import REGISTRY
+from pynamodb.connection.base import Connection
+from pynamodb.exceptions import GetError
+from app.api.metrics import metrics, RequestTimingMiddleware
+from app.dynamo_db.models import OktaUser
+from app.dynamo_db.repositories import UserRepository
+from app.services.metrics import collect_timings, observe, timed
+from app.services.redis_service import RedisService
+from app.services.two_tier_cache import TwoTierCache, LocalCache
+
+
+def sample(name, **labels):
+    """
+    :return: current value of a sample of the metrics, 0 if it was never recorded.
+    """
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_timed_records_latency_errors_and_timings():
+    calls = sample("external_call_duration_seconds_count", component="test", operation="ok")
+    errors = sample("external_call_errors_total", component="test", operation="fail", error="KeyError")
+
+    with collect_timings() as timings:
+        with timed("test", "ok"):
+            pass
+        with pytest.raises(KeyError):
+            with timed("test", "fail"):
+                raise KeyError("missing")
+        observe("other", "call", 0.25)
+
+    assert sample("external_call_duration_seconds_count", component="test", operation="ok") == calls + 1
+    assert sample("external_call_errors_total", component="test", operation="fail", error="KeyError") == errors + 1
+    assert timings["test"]["calls"] == 2
+    assert timings["other"] == {"calls": 1, "ms": 250.0}
+
+    # nothing is collected outside of collect_timings.
+    with collect_timings() as timings:
+        pass
+    observe("test", "ok", 0.1)
+    assert timings == {}
+
+
+def test_redis_bytes_and_cache_hits():
+    redis_service = RedisService(redis_client=fakeredis.FakeRedis())
+    cache = TwoTierCache(redis_service, LocalCache(max_size=10, ttl=60))
+    bytes_out = sample("external_bytes_total", component="redis", direction="out")
+    bytes_in = sample("external_bytes_total", component="redis", direction="in")
+    l1_hits = sample("cache_requests_total", cache="l1", result="hit")
+    l2_misses = sample("cache_requests_total", cache="l2", result="miss")
+
+    with collect_timings() as timings:
+        redis_service.set_object("user_details:a", {"email": "a@example.com"})
+        assert cache.get_object("user_details:b") is None
+        cache.get_object("user_details:a")
+        cache.get_object("user_details:a")
+
+    size = len(redis_service.serializer.dumps({"email": "a@example.com"}))
+    assert sample("external_bytes_total", component="redis", direction="out") == bytes_out + size
+    assert sample("external_bytes_total", component="redis", direction="in") == bytes_in + size
+    assert sample("cache_requests_total", cache="l1", result="hit") == l1_hits + 1
+    assert sample("cache_requests_total", cache="l2", result="miss") == l2_misses + 1
+    # one set, two gets (the second one is served by the L1).
+    assert timings["redis"]["calls"] == 3
+
+
+def test_models_record_dynamodb_calls_and_consumed_capacity():
+    with mock_aws():
+        OktaUser.create_table(read_capacity_units=5, write_capacity_units=5, wait=True)
+        user_repository = UserRepository(OktaUser)
+        table = OktaUser.Meta.table_name
+        units = sample("dynamodb_consumed_capacity_units_total", table=table, operation="UpdateItem")
+        errors = sample("external_call_errors_total", component="dynamodb", operation="GetItem",
+                        error="ResourceNotFoundException")
+
+        with collect_timings() as timings:
+            user_repository.update_user("a@example.com", defaults={"name": "A"})
+            assert user_repository.get_user_by_email("a@example.com").name == "A"
+
+        OktaUser.delete_table()
+        with pytest.raises(GetError):
+            user_repository.get_user_by_email("a@example.com")
+
+    assert sample("dynamodb_consumed_capacity_units_total", table=table, operation="UpdateItem") > units
+    assert sample("external_call_errors_total", component="dynamodb", operation="GetItem",
+                  error="ResourceNotFoundException") == errors + 1
+    assert timings["dynamodb"]["calls"] == 2
+
+    # the other users of PynamoDB are not instrumented.
+    with mock_aws(), collect_timings() as timings:
+        Connection(region="eu-north-1").list_tables()
+    assert timings == {}
+
+
+def call_asgi(app, method, path):
+    """
+    :return: tuple of (status, body) of the request.
+    """
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": method, "path": path,
+             "raw_path": path.encode(), "root_path": "", "scheme": "http", "query_string": b"", "headers": [],
+             "server": ("testserver", 80), "client": ("testclient", 50000)}
+    asyncio.run(app(scope, receive, send))
+
+    status = next(message["status"] for message in messages if message["type"] == "http.response.start")
+    body = b"".join(message.get("body", b"") for message in messages if message["type"] == "http.response.body")
+    return status, body
+
+
+def test_request_timing_middleware_and_metrics_endpoint(caplog):
+    app = FastAPI()
+    app.add_middleware(RequestTimingMiddleware)
+    app.include_router(metrics)
+
+    @app.get("/items/{item_id}")
+    def get_item(item_id: str):
+        # runs in the thread pool, with the context of the request.
+        observe("redis", "get", 0.002)
+        return {"item_id": item_id}
+
+    requests_count = sample("http_request_duration_seconds_count", method="GET", route="/items/{item_id}",
+                            status="200")
+
+    with caplog.at_level(logging.INFO, logger="app.api.metrics"):
+        assert call_asgi(app, "GET", "/items/1") == (200, b'{"item_id":"1"}')
+
+    assert sample("http_request_duration_seconds_count", method="GET", route="/items/{item_id}",
+                  status="200") == requests_count + 1
+    record = json.loads(caplog.records[-1].getMessage())
+    assert record["route"] == "/items/{item_id}" and record["path"] == "/items/1" and record["status"] == 200
+    assert record["components"]["redis"] == {"calls": 1, "ms": 2.0}
+
+    status, body = call_asgi(app, "GET", "/metrics")
+    assert status == 200
+    assert "# TYPE external_call_duration_seconds histogram" in body.decode()
+    assert 'http_request_duration_seconds_count{method="GET",route="/items/{item_id}",status="200"}' in body.decode()
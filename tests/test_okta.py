@@ -1,7 +1,9 @@
+import asyncio
 import pytest
 from unittest.mock import patch
 from requests.models import Response
-from app.api.okta import OktaClient
+from app.api.okta import OktaClient, AsyncOktaClient
+from tests.fake_okta import FakeOktaServer
 
 
 @pytest.fixture
@@ -23,27 +25,87 @@ def mocked_okta_users_response():
 
 
 def test_get_users_data(okta_client, mocked_okta_users_response):
-    with patch('requests.get', return_value=mocked_okta_users_response) as mock_get:
+    with patch.object(okta_client.session, 'get', return_value=mocked_okta_users_response) as mock_get:
         users = okta_client.get_users_data()
 
         assert len(users) == 2
 
         mock_get.assert_called_once_with(
             "https://example.okta.com/api/v1/users",
-            headers={"Authorization": "SSWS fake_api_key"}
+            params={"limit": 200}
         )
+        assert okta_client.session.headers["Authorization"] == "SSWS fake_api_key"
 
 
 def test_get_admin_users(okta_client, mocked_okta_users_response):
 
     admin_group_id = 'group_example_123'
 
-    with patch('requests.get', return_value=mocked_okta_users_response) as mock_get:
+    with patch.object(okta_client.session, 'get', return_value=mocked_okta_users_response) as mock_get:
         admin_users = okta_client.get_admin_users(admin_group_id)
 
         assert len(admin_users) == 2
 
         mock_get.assert_called_once_with(
             f"https://example.okta.com/api/v1/groups/{admin_group_id}/users",
-            headers={"Authorization": "SSWS fake_api_key"}
+            params={"limit": 200}
         )
+
+
+def test_get_users_data_follows_pagination():
+    with FakeOktaServer(user_count=100_000) as server:
+        okta_client = OktaClient("example.okta.com", "fake_api_key", page_limit=1000, base_url=server.base_url)
+
+        users = okta_client.get_users_data()
+
+    assert len(users) == 100_000
+    assert len({user["id"] for user in users}) == 100_000
+    assert len(server.requests) == 100
+
+
+def test_get_users_and_admin_users_concurrently():
+    with FakeOktaServer(user_count=1000, admin_every=10) as server:
+        okta_client = OktaClient("example.okta.com", "fake_api_key", page_limit=50, base_url=server.base_url)
+
+        users, admin_users = okta_client.get_users_and_admin_users("admins_group")
+
+    assert len(users) == 1000
+    assert [user["id"] for user in admin_users] == [f"00u{i}" for i in range(0, 1000, 10)]
+
+
+def test_get_users_data_rate_limit():
+    with FakeOktaServer(user_count=500, rate_limit=3) as server:
+        okta_client = OktaClient("example.okta.com", "fake_api_key", page_limit=50, base_url=server.base_url,
+                                 rate_limit_threshold=1)
+
+        users = okta_client.get_users_data()
+
+    # the 429 responses are retried after the reset and no page is lost.
+    assert len(users) == 500
+    assert server.throttled_requests > 0
+
+
+def test_get_users_data_updated_since(okta_client, mocked_okta_users_response):
+    with patch.object(okta_client.session, 'get', return_value=mocked_okta_users_response) as mock_get:
+        okta_client.get_users_data(updated_since="2025-03-01T10:00:00.000Z")
+
+        mock_get.assert_called_once_with(
+            "https://example.okta.com/api/v1/users",
+            params={"limit": 200, "filter": 'lastUpdated ge "2025-03-01T10:00:00.000Z"'}
+        )
+
+
+def test_async_get_users_and_admin_users():
+    async def fetch(base_url):
+        okta_client = AsyncOktaClient("example.okta.com", "fake_api_key", page_limit=50, base_url=base_url)
+        try:
+            return await okta_client.get_users_and_admin_users("admins_group")
+        finally:
+            await okta_client.close()
+
+    with FakeOktaServer(user_count=1000, admin_every=10) as server:
+        users, admin_users = asyncio.run(fetch(server.base_url))
+
+    assert len(users) == 1000
+    assert len({user["id"] for user in users}) == 1000
+    assert [user["id"] for user in admin_users] == [f"00u{i}" for i in range(0, 1000, 10)]
@@ -0,0 +1,92 @@
+import asyncio
+import json
+import fakeredis
+import fakeredis.aioredis
+import pytest
+from app.services.redis_service import RedisService, AsyncRedisService, get_connection_pool
+from app.services.serializers import get_serializer, CompressedSerializer, JsonSerializer
+
+
+@pytest.fixture
+def redis_service():
+    return RedisService(redis_client=fakeredis.FakeRedis())
+
+
+def test_get_set_delete(redis_service):
+    redis_service.set("key", "value", ex=60)
+
+    assert redis_service.get("key") == b"value"
+
+    redis_service.delete("key")
+    assert redis_service.get("key") is None
+
+
+def test_set_object_get_object(redis_service):
+    value = {"user": "John Doe", "last_login": "2025-03-01T12:00:00Z", "events": [1, 2, 3]}
+
+    redis_service.set_object("user_details:john", value, ex=60)
+
+    assert redis_service.get_object("user_details:john") == value
+    assert redis_service.get_object("missing") is None
+
+
+def test_get_object_legacy_json_value(redis_service):
+    # values written before the codec existed are plain JSON.
+    redis_service.set("scan results", json.dumps([{"email": "john@example.com"}]))
+
+    assert redis_service.get_object("scan results") == [{"email": "john@example.com"}]
+
+
+def test_mset_objects_mget_objects(redis_service):
+    values = {f"user_details:user{i}": {"user": f"User {i}"} for i in range(100)}
+
+    redis_service.mset_objects(values, ex=60)
+
+    assert redis_service.mget_objects(list(values) + ["missing"]) == list(values.values()) + [None]
+    assert redis_service.redis_client.ttl("user_details:user1") > 0
+
+
+def test_compressed_serializer_threshold():
+    serializer = CompressedSerializer(JsonSerializer(), threshold=100)
+    small = {"a": 1}
+    large = {"users": ["user@example.com"] * 100}
+
+    assert serializer.dumps(small) == b'\x00{"a":1}'
+    assert serializer.dumps(large)[:1] == b"\x01"
+    assert len(serializer.dumps(large)) < len(json.dumps(large))
+    assert serializer.loads(serializer.dumps(large)) == large
+
+
+def test_msgpack_serializer():
+    pytest.importorskip("msgpack")
+    serializer = get_serializer("msgpack", compress_threshold=10)
+    value = {"users": {"00u1": {"email": "user1@example.com", "admin": True}}}
+
+    assert serializer.loads(serializer.dumps(value)) == value
+
+
+def test_get_serializer_unknown():
+    with pytest.raises(ValueError):
+        get_serializer("pickle")
+
+
+def test_connection_pool_is_shared():
+    assert get_connection_pool("redis.local", 6379, 0) is get_connection_pool("redis.local", 6379, 0)
+    assert RedisService("redis.local").redis_client.connection_pool is get_connection_pool("redis.local", 6379, 0)
+
+
+def test_async_redis_service():
+    redis_service = AsyncRedisService(redis_client=fakeredis.aioredis.FakeRedis())
+    values = {f"user_details:user{i}": {"user": f"User {i}"} for i in range(10)}
+
+    async def run():
+        await redis_service.set_object("key", {"user": "John Doe"}, ex=60)
+        await redis_service.mset_objects(values, ex=60)
+        return (await redis_service.get_object("key"), await redis_service.get_object("missing"),
+                await redis_service.mget_objects(list(values) + ["missing"]))
+
+    value, missing, batch = asyncio.run(run())
+
+    assert value == {"user": "John Doe"}
+    assert missing is None
+    assert batch == list(values.values()) + [None]
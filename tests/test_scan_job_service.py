@@ -0,0 +1,217 @@
+import time
+import fakeredis
+import pytest
+from unittest.mock import patch
+from app.api.utils import get_s3_fingerprint
+from app.services.redis_service import RedisService
+from app.services.scan_job_service import ScanJobService
+from tests.fake_s3 import FakeS3Server, audit_csv
+
+
+class RecordingUserService:
+    """UserService stand-in that records the applied rows (or folded events), and can fail on a given batch."""
+
+    def __init__(self, fail_on_batch=None):
+        self.fail_on_batch = fail_on_batch
+        self.batches = []
+
+    def update_users_from_csv(self, users_data, batch_size=None):
+        self._check_failure()
+        self.batches.append(list(users_data))
+
+    def apply_folded_events(self, folded_events):
+        self._check_failure()
+        self.batches.append(folded_events)
+
+    def _check_failure(self):
+        if len(self.batches) + 1 == self.fail_on_batch:
+            self.fail_on_batch = None
+            raise RuntimeError("DynamoDB unavailable")
+
+
+@pytest.fixture
+def redis_service():
+    return RedisService(redis_client=fakeredis.FakeRedis())
+
+
+def wait_for_job(service, job_id, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        progress = service.get_progress(job_id)
+        if progress["status"] in (ScanJobService.DONE, ScanJobService.FAILED):
+            return progress
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_scan_job_processes_file_in_background(redis_service):
+    user_service = RecordingUserService()
+    service = ScanJobService(user_service, redis_service, batch_size=100)
+
+    with FakeS3Server(audit_csv(rows=1000)) as server:
+        job = service.submit(server.url)
+        progress = wait_for_job(service, job["job_id"])
+
+    assert job["status"] == ScanJobService.QUEUED
+    assert progress["status"] == ScanJobService.DONE
+    assert progress["rows_processed"] == 1000
+    assert progress["batches_applied"] == 10
+    assert progress["bytes_processed"] == progress["total_bytes"]
+    assert progress["eta_seconds"] == 0
+    assert sum(len(batch) for batch in user_service.batches) == 1000
+    # 11 batch reads (the last one is empty) and 10 batch applies, the file request and its download.
+    assert progress["timings"]["scan_job"]["calls"] == 21
+    assert progress["timings"]["s3"]["calls"] == 2
+    assert progress["timings"]["redis"]["calls"] >= 10
+
+
+def test_scan_job_resumes_from_checkpoint(redis_service):
+    user_service = RecordingUserService(fail_on_batch=4)
+    service = ScanJobService(user_service, redis_service, batch_size=100)
+    content = audit_csv(rows=1000)
+
+    with FakeS3Server(content) as server:
+        job_id = service.submit(server.url)["job_id"]
+        failed = wait_for_job(service, job_id)
+
+        # the same link resumes the job after the last applied batch.
+        assert service.submit(server.url)["job_id"] == job_id
+        progress = wait_for_job(service, job_id)
+
+    assert failed["status"] == ScanJobService.FAILED
+    assert failed["rows_processed"] == 300
+    assert "DynamoDB unavailable" in failed["errors"][0]
+
+    assert progress["status"] == ScanJobService.DONE
+    assert progress["rows_processed"] == 1000
+    assert server.requests[1] == f"bytes={failed['bytes_processed']}-"
+
+    # every row applied exactly once.
+    rows = [row["Timestamp"] for batch in user_service.batches for row in batch]
+    assert rows == [str(1700000000 + i) for i in range(1000)]
+
+
+def test_scan_job_parses_big_files_in_parallel(redis_service, tmp_path):
+    user_service = RecordingUserService(fail_on_batch=3)
+    content = audit_csv(rows=1000)
+    service = ScanJobService(user_service, redis_service, parallel_workers=2, parallel_min_bytes=len(content) // 2,
+                             parallel_window_bytes=len(content) // 5, tmp_dir=str(tmp_path))
+
+    with FakeS3Server(content) as server:
+        job_id = service.submit(server.url)["job_id"]
+        failed = wait_for_job(service, job_id, timeout=60)
+        service.submit(server.url)
+        progress = wait_for_job(service, job_id, timeout=60)
+
+    assert failed["status"] == ScanJobService.FAILED and failed["batches_applied"] == 2
+    assert progress["status"] == ScanJobService.DONE
+    assert progress["rows_processed"] == 1000
+    assert progress["bytes_processed"] == progress["total_bytes"] == len(content)
+    # the rest of the file is downloaded from the last checkpoint.
+    assert server.requests == [None, f"bytes={failed['bytes_processed']}-"]
+
+    # every row applied exactly once.
+    logouts = [event["Timestamp"] for batch in user_service.batches for user_events in batch.values()
+               for event in user_events["user_events"]]
+    assert len(logouts) == len(set(logouts)) == 250
+    assert not list(tmp_path.iterdir())
+
+
+def test_scan_job_fails_on_a_header_without_the_needed_columns(redis_service):
+    service = ScanJobService(RecordingUserService(), redis_service, parallel_workers=2, parallel_min_bytes=0)
+
+    with FakeS3Server(b"User Email,Time,Event Description\nuser@example.com,1700000000,User Login\n") as server:
+        progress = wait_for_job(service, service.submit(server.url)["job_id"])
+
+    assert progress["status"] == ScanJobService.FAILED
+    assert "no Timestamp column" in progress["errors"][0]
+
+
+def test_scan_job_done_is_not_processed_again(redis_service):
+    user_service = RecordingUserService()
+    service = ScanJobService(user_service, redis_service, batch_size=100)
+
+    with FakeS3Server(audit_csv(rows=10)) as server:
+        job_id = service.submit(server.url)["job_id"]
+        wait_for_job(service, job_id)
+
+        assert service.submit(server.url)["status"] == ScanJobService.DONE
+
+    assert len(server.requests) == 1
+    assert service.get_progress("missing") is None
+
+
+def test_scan_job_changed_file_is_ingested_again(redis_service):
+    user_service = RecordingUserService()
+    service = ScanJobService(user_service, redis_service, batch_size=100)
+
+    with FakeS3Server(audit_csv(rows=200)) as server:
+        first = service.submit(server.url)
+        wait_for_job(service, first["job_id"])
+
+        # same version - skipped with a HEAD request, the file is not downloaded again.
+        assert service.submit(server.url)["status"] == ScanJobService.DONE
+        assert len(server.requests) == 1
+
+        # new version behind the same link - a new job.
+        server.content = audit_csv(rows=300)
+        second = service.submit(server.url)
+        progress = wait_for_job(service, second["job_id"])
+
+    assert second["job_id"] != first["job_id"]
+    assert progress["status"] == ScanJobService.DONE
+    assert progress["rows_processed"] == 300
+    assert progress["fingerprint"]["content_length"] == len(server.content)
+    assert sum(len(batch) for batch in user_service.batches) == 500
+    # only the small job states are stored, whatever the size of the files.
+    assert sorted(redis_service.redis_client.keys()) == sorted(
+        f"{ScanJobService.KEY_PREFIX}{job_id}".encode() for job_id in (first["job_id"], second["job_id"]))
+
+
+def test_scan_job_without_version_headers_uses_link(redis_service):
+    service = ScanJobService(RecordingUserService(), redis_service, batch_size=100)
+
+    with FakeS3Server(audit_csv(rows=10), versioned=False) as server:
+        job = service.submit(server.url)
+        progress = wait_for_job(service, job["job_id"])
+
+    assert job["job_id"] == ScanJobService.job_id(server.url)
+    assert progress["fingerprint"] is None
+    assert redis_service.redis_client.ttl(ScanJobService.KEY_PREFIX + job["job_id"]) <= service.done_job_ttl
+
+
+def test_scan_job_submit_does_not_overwrite_a_newer_state(redis_service):
+    service = ScanJobService(RecordingUserService(), redis_service, get_fingerprint=lambda s3_link: None)
+    job_id = service.job_id("https://bucket/file.csv")
+    job = service._queue(job_id, "https://bucket/file.csv", None)
+
+    # the job finished between the read of submit and its write.
+    done = dict(job, status=ScanJobService.DONE, offset=100, rows_processed=10)
+    redis_service.set_object(ScanJobService.KEY_PREFIX + job_id, done)
+    with patch.object(service, "get_job", return_value=dict(job, status=ScanJobService.FAILED)):
+        assert service.submit("https://bucket/file.csv")["status"] == ScanJobService.DONE
+
+    assert service.get_job(job_id) == done
+
+
+def test_scan_job_stops_when_its_lock_was_taken(redis_service):
+    service = ScanJobService(None, redis_service, batch_size=100)
+
+    class StolenLockUserService(RecordingUserService):
+        def update_users_from_csv(self, users_data, batch_size=None):
+            super().update_users_from_csv(users_data, batch_size)
+            # the lock expired during the batch, and another worker took the job.
+            redis_service.redis_client.set(ScanJobService.LOCK_PREFIX + job_id, "another worker")
+
+    service.user_service = StolenLockUserService()
+    with FakeS3Server(audit_csv(rows=1000)) as server:
+        job_id = service.job_id(server.url, get_s3_fingerprint(server.url))
+        service.submit(server.url)
+        service.shutdown()
+
+    # no checkpoint, failure or lock extension after the lock was lost.
+    job = service.get_job(job_id)
+    assert job["status"] == ScanJobService.RUNNING and job["batches_applied"] == 0
+    assert len(service.user_service.batches) == 1
+    assert redis_service.redis_client.get(ScanJobService.LOCK_PREFIX + job_id) == b"another worker"
+    assert redis_service.redis_client.ttl(ScanJobService.LOCK_PREFIX + job_id) == -1
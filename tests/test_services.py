@@ -0,0 +1,115 @@
+import pytest
+import requests
+from unittest.mock import MagicMock
+from app.services.identity_service import IdentityService
+from app.services.okta_sync_service import OktaSyncService
+from app.api.utils import DataProcessor
+
+
+class FakeRedisService:
+    """in memory stand-in for RedisService."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value.encode() if isinstance(value, str) else value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+def okta_user(user_id, last_updated):
+    return {"id": user_id, "lastUpdated": last_updated,
+            "profile": {"firstName": "User", "lastName": user_id, "email": f"{user_id}@example.com"}}
+
+
+def make_sync_service(okta_client, redis_service=None, full_sync_interval=24 * 3600):
+    identity_service = IdentityService(api_service=okta_client, data_processor=DataProcessor(okta_client))
+    user_repository = MagicMock()
+    user_repository.upload_user_data_to_db.return_value = {"created": [], "updated": [], "failed": {}}
+    return OktaSyncService(identity_service, user_repository, redis_service or FakeRedisService(),
+                           full_sync_interval=full_sync_interval)
+
+
+def test_okta_sync_first_sync_is_full():
+    okta_client = MagicMock()
+    okta_client.get_users_data.return_value = [okta_user("u1", "2025-03-01T10:00:00.000Z"),
+                                               okta_user("u2", "2025-03-02T10:00:00.000Z")]
+    sync_service = make_sync_service(okta_client)
+
+    result = sync_service.sync({"id", "email"})
+
+    assert result["mode"] == "full"
+    okta_client.get_users_data.assert_called_once_with(None)
+    assert sync_service.redis_service.get(OktaSyncService.HIGH_WATER_MARK_KEY) == b"2025-03-02T10:00:00.000Z"
+    assert set(sync_service.user_repository.upload_user_data_to_db.call_args.args[0]) == {"u1", "u2"}
+
+
+def test_okta_sync_incremental_uses_high_water_mark():
+    okta_client = MagicMock()
+    okta_client.get_users_data.return_value = [okta_user("u1", "2025-03-01T10:00:00.000Z")]
+    sync_service = make_sync_service(okta_client)
+    sync_service.sync({"id", "email"})
+
+    okta_client.get_users_data.return_value = [okta_user("u3", "2025-03-05T10:00:00.000Z")]
+    result = sync_service.sync({"id", "email"})
+
+    assert result["mode"] == "incremental"
+    okta_client.get_users_data.assert_called_with("2025-03-01T10:00:00.000Z")
+    assert list(result["users_data"]) == ["u3"]
+    assert sync_service.redis_service.get(OktaSyncService.HIGH_WATER_MARK_KEY) == b"2025-03-05T10:00:00.000Z"
+
+    # no changes -> the high-water mark stays.
+    okta_client.get_users_data.return_value = []
+    sync_service.sync({"id", "email"})
+    assert sync_service.redis_service.get(OktaSyncService.HIGH_WATER_MARK_KEY) == b"2025-03-05T10:00:00.000Z"
+
+
+def test_okta_sync_periodic_full_reconciliation():
+    okta_client = MagicMock()
+    okta_client.get_users_data.return_value = [okta_user("u1", "2025-03-01T10:00:00.000Z")]
+    sync_service = make_sync_service(okta_client, full_sync_interval=0)
+    sync_service.sync({"id", "email"})
+
+    result = sync_service.sync({"id", "email"})
+
+    assert result["mode"] == "full"
+    okta_client.get_users_data.assert_called_with(None)
+
+
+def test_okta_sync_failed_fetch_keeps_the_sync_state():
+    okta_client = MagicMock()
+    okta_client.get_users_data.side_effect = requests.exceptions.ConnectionError("okta is down")
+    sync_service = make_sync_service(okta_client)
+
+    with pytest.raises(ValueError):
+        sync_service.sync({"id", "email"})
+
+    # the next sync is still a full one.
+    assert sync_service.redis_service.data == {}
+    sync_service.user_repository.upload_user_data_to_db.assert_not_called()
+
+
+def test_okta_sync_users_updated_at_the_high_water_mark():
+    okta_client = MagicMock()
+    okta_client.get_users_data.return_value = [okta_user("u1", "2025-03-01T10:00:00.000Z")]
+    sync_service = make_sync_service(okta_client)
+    sync_service.sync({"id", "email"})
+
+    # u2 was updated in the same millisecond as u1, after the first sync.
+    okta_client.get_users_data.return_value = [okta_user("u1", "2025-03-01T10:00:00.000Z"),
+                                               okta_user("u2", "2025-03-01T10:00:00.000Z")]
+    result = sync_service.sync({"id", "email"})
+
+    assert result["mode"] == "incremental" and list(result["users_data"]) == ["u2"]
+    assert sync_service.redis_service.get(OktaSyncService.HIGH_WATER_MARK_KEY) == b"2025-03-01T10:00:00.000Z"
+
+    # both were synced.
+    assert list(sync_service.sync({"id", "email"})["users_data"]) == []
+
+    okta_client.get_users_data.return_value += [okta_user("u3", "2025-03-02T10:00:00.000Z")]
+    assert list(sync_service.sync({"id", "email"})["users_data"]) == ["u3"]
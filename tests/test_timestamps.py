@@ -0,0 +1,60 @@
+import random
+from datetime import datetime, timezone, timedelta
+from unittest.mock import patch
+import pytest
+from app.services import timestamps
+from app.services.timestamps import epoch_to_iso, epochs_to_iso, to_epoch_seconds
+
+EPOCHS = [0, -1, 1, 1616152892, 1700000000, timestamps.MIN_EPOCH, timestamps.MAX_EPOCH] + \
+         [random.Random(i).randint(-2_000_000_000, 4_000_000_000) for i in range(1000)]
+
+
+@pytest.fixture(params=["numpy", "fallback"])
+def backend(request):
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+        yield
+    else:
+        with patch.object(timestamps, "np", None):
+            yield
+
+
+def test_epoch_to_iso_matches_previous_formatting():
+    for epoch in EPOCHS[:6]:
+        assert epoch_to_iso(epoch) == datetime.fromtimestamp(epoch, tz=timezone.utc).replace(tzinfo=None).isoformat()
+        assert epoch_to_iso(epoch, utc=True) == datetime.fromtimestamp(epoch, tz=timezone.utc).isoformat() + "Z"
+
+    assert epoch_to_iso(1616152892) == "2021-03-19T11:21:32"
+    assert epoch_to_iso(1616152892, utc=True) == "2021-03-19T11:21:32+00:00Z"
+
+
+def test_epochs_to_iso_matches_scalar(backend):
+    assert epochs_to_iso(EPOCHS) == [epoch_to_iso(epoch) for epoch in EPOCHS]
+    assert epochs_to_iso(EPOCHS, utc=True) == [epoch_to_iso(epoch, utc=True) for epoch in EPOCHS]
+    assert epochs_to_iso([]) == []
+
+
+def test_epochs_to_iso_out_of_range(backend):
+    with pytest.raises((ValueError, OverflowError, OSError)):
+        epochs_to_iso([0, timestamps.MAX_EPOCH + 1])
+
+
+def test_to_epoch_seconds_reads_every_layout(backend):
+    epochs = [epoch for epoch in EPOCHS if epoch >= 0]
+    dates = [epoch_to_iso(epoch, utc=True) for epoch in epochs]
+
+    assert to_epoch_seconds(dates) == epochs
+    assert to_epoch_seconds(["2025-03-01T10:00:00.123Z", "2025-03-01T10:00:00+00:00Z", "2025-03-01", "", None]) == \
+        [1740823200, 1740823200, 1740787200, timestamps.MISSING_EPOCH, timestamps.MISSING_EPOCH]
+    assert to_epoch_seconds(["", "not a date", "2025-03-01"], missing=-1) == [-1, -1, 1740787200]
+
+
+def test_to_epoch_seconds_reads_only_the_users_table_layouts(backend):
+    # same result whatever the other timestamps of the list - the NumPy path does not read more layouts.
+    for dates in (["2020", "2025-03-01T10:00:00.000Z"], ["2020", "garbage"]):
+        assert to_epoch_seconds(dates)[0] == timestamps.MISSING_EPOCH
+
+    # offsets are not dropped - only UTC timestamps are read.
+    assert to_epoch_seconds(["2025-03-01T10:00:00+02:00", "2025-03-01T10:00:00", "0000-01-01",
+                             "2025-03-01T10:00:00.000Z"], missing=-1) == [-1, -1, -1, 1740823200]
+    assert to_epoch_seconds(["2025-02-30", "2025-03-01"], missing=-1) == [-1, 1740787200]
@@ -0,0 +1,94 @@
+import asyncio
+import time
+import fakeredis
+import pytest
+from unittest.mock import patch
+from app.services.redis_service import RedisService, AsyncRedisService
+from app.services.two_tier_cache import TwoTierCache, LocalCache
+
+
+@pytest.fixture
+def redis_server():
+    return fakeredis.FakeServer()
+
+
+def make_cache(redis_server, **kwargs):
+    redis_service = RedisService(redis_client=fakeredis.FakeRedis(server=redis_server))
+    return TwoTierCache(redis_service, LocalCache(**kwargs))
+
+
+def test_local_cache_lru_eviction():
+    local_cache = LocalCache(max_size=2, ttl=60)
+    local_cache.set("a", 1)
+    local_cache.set("b", 2)
+    local_cache.get("a")
+    local_cache.set("c", 3)
+
+    # "b" is the least recently used.
+    assert local_cache.get("b") is None
+    assert local_cache.get("a") == 1
+    assert local_cache.get("c") == 3
+    assert local_cache.evictions == 1
+
+
+def test_local_cache_ttl():
+    local_cache = LocalCache(ttl=60)
+    local_cache.set("a", 1, ttl=0.01)
+    time.sleep(0.02)
+
+    assert local_cache.get("a") is None
+    assert len(local_cache) == 0
+
+
+def test_two_tier_cache_hit_and_miss_counters(redis_server):
+    cache = make_cache(redis_server)
+
+    assert cache.get_object("user_details:a") is None
+    cache.redis_service.set_object("user_details:a", {"user": "A"})
+    assert cache.get_object("user_details:a") == {"user": "A"}
+    assert cache.get_object("user_details:a") == {"user": "A"}
+
+    stats = cache.stats()
+    assert stats["l1"]["hits"] == 1
+    assert stats["l1"]["misses"] == 2
+    assert stats["l2"] == {"hits": 1, "misses": 1}
+    cache.stop_invalidation_listener()
+
+
+def test_two_tier_cache_invalidation_is_broadcast(redis_server):
+    worker_1 = make_cache(redis_server)
+    worker_2 = make_cache(redis_server)
+    worker_1.set_object("user_details:a", {"user": "A"}, ex=60)
+
+    # both workers hold the key in their L1.
+    assert worker_1.get_object("user_details:a") == {"user": "A"}
+    assert worker_2.get_object("user_details:a") == {"user": "A"}
+    assert worker_2.local_cache.get("user_details:a") == {"user": "A"}
+
+    worker_1.invalidate("user_details:a")
+
+    deadline = time.monotonic() + 5
+    while worker_2.local_cache.get("user_details:a") is not None:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert worker_2.get_object("user_details:a") is None
+
+    worker_1.stop_invalidation_listener()
+    worker_2.stop_invalidation_listener()
+
+
+def test_async_reads_do_not_wait_for_a_dead_listener(redis_server):
+    async_redis_service = AsyncRedisService(redis_client=fakeredis.FakeAsyncRedis(server=redis_server))
+    cache = TwoTierCache(RedisService(redis_client=fakeredis.FakeRedis(server=redis_server)), LocalCache(),
+                         async_redis_service=async_redis_service)
+    cache.redis_service.set_object("user_details:a", {"user": "A"})
+
+    async def read(times):
+        return [await cache.aget_object("user_details:a") for _ in range(times)]
+
+    redis_down = ConnectionError("redis is down")
+    with patch.object(cache.redis_service.redis_client, "pubsub", side_effect=redis_down) as pubsub:
+        assert asyncio.run(read(20)) == [{"user": "A"}] * 20
+        # one failed subscription, retried after listener_retry_interval only.
+        assert pubsub.call_count == 1
+        assert not cache._listener_alive() and not cache._listener_starting
@@ -0,0 +1,148 @@
+from unittest.mock import patch
+import fakeredis
+import pytest
+from moto import mock_aws
+from app.api import users
+from app.dynamo_db.models import OktaUser
+from app.dynamo_db.repositories import UserRepository
+from app.services.redis_service import RedisService
+from app.services.timestamps import to_epoch_seconds
+from app.services.user_snapshot import UserSnapshot
+from app.services.users_view import UsersView
+
+np = pytest.importorskip("numpy")
+
+
+@pytest.fixture
+def users_view():
+    view = UsersView(RedisService(redis_client=fakeredis.FakeRedis()))
+    view.redis_service.redis_client.set(UsersView.BUILD_KEY, "build")
+    view.redis_service.redis_client.xadd(UsersView.CHANGES_KEY, {"emails": ""})
+    return view
+
+
+def user(i, **values):
+    return dict({"email": f"user{i}@example.com", "name": f"User {i}", "admin": str(i % 3 == 0), "id": str(i),
+                 "lastLogin": f"2025-0{i % 9 + 1}-01T10:00:00.000Z" if i % 4 else "",
+                 "passwordChanged": "2024-06-01T10:00:00+00:00Z", "statusChanged": "", "user_events": []}, **values)
+
+
+def emails(rows):
+    return [row["email"] for row in rows]
+
+
+def test_snapshot_reads_only_the_changes(users_view):
+    snapshot = UserSnapshot(max_age=0, capacity=2)
+    users_view.apply({f"user{i}@example.com": user(i) for i in range(10)})
+    assert snapshot.refresh(users_view) and snapshot.count() == 10
+
+    users_view.apply({"user1@example.com": None, "user5@example.com": user(5, name="Five", admin="True"),
+                      "user20@example.com": user(20)})
+    with patch.object(users_view, "read_all") as read_all:
+        assert snapshot.refresh(users_view)
+    read_all.assert_not_called()
+
+    assert snapshot.count() == 10
+    assert snapshot.rows(equals={"admin": "True"}, since={"lastLogin": to_epoch_seconds(["2025-06-01"])[0]},
+                         order_by="lastLogin") == [
+        {"email": "user5@example.com", "name": "Five", "admin": "True", "lastLogin": "2025-06-01T10:00:00+00:00Z",
+         "passwordChanged": "2024-06-01T10:00:00+00:00Z", "statusChanged": ""},
+        {"email": "user6@example.com", "name": "User 6", "admin": "True", "lastLogin": "2025-07-01T10:00:00+00:00Z",
+         "passwordChanged": "2024-06-01T10:00:00+00:00Z", "statusChanged": ""}]
+
+    # a rebuilt view is read again.
+    users_view.redis_service.redis_client.set(UsersView.BUILD_KEY, "rebuilt")
+    users_view.redis_service.redis_client.hdel(UsersView.USERS_KEY, "user0@example.com")
+    assert snapshot.refresh(users_view) and snapshot.count() == 9 and snapshot.build == "rebuilt"
+
+
+def test_snapshot_filters_and_aggregates(users_view):
+    snapshot = UserSnapshot()
+    snapshot.replace("build", "0-0", {f"user{i}@example.com": user(i) for i in range(100)})
+    snapshot.apply({f"user{i}@example.com": None for i in range(0, 100, 10)})
+
+    everyone = {user(i)["email"]: user(i) for i in range(100) if i % 10}
+    assert snapshot.count_by("admin") == {"True": sum(u["admin"] == "True" for u in everyone.values()),
+                                          "False": sum(u["admin"] == "False" for u in everyone.values())}
+    assert snapshot.count(missing=["lastLogin"]) == sum(not u["lastLogin"] for u in everyone.values())
+    assert snapshot.count(equals={"admin": "unknown"}) == 0
+
+    latest = snapshot.rows(limit=5, order_by="lastLogin", descending=True)
+    expected = sorted(everyone.values(), key=lambda u: u["lastLogin"], reverse=True)
+    assert [row["lastLogin"][:19] for row in latest] == [u["lastLogin"][:19] for u in expected[:5]]
+    oldest = [row["lastLogin"] for row in snapshot.rows(limit=1000, order_by="lastLogin")]
+    assert oldest == sorted(oldest)
+    assert [row["lastLogin"] for row in snapshot.rows(limit=5, order_by="lastLogin")] == oldest[:5]
+    assert sorted(emails(snapshot.rows(limit=1000))) == sorted(everyone)
+
+    with pytest.raises(ValueError):
+        snapshot.count(before={"name": 0})
+
+
+def test_snapshot_saved_and_memory_mapped(users_view, tmp_path):
+    path = str(tmp_path / "users.snapshot")
+    snapshot = UserSnapshot.open(path, max_age=0)
+    users_view.apply({f"user{i}@example.com": user(i) for i in range(10)})
+    # saved after the full read.
+    assert snapshot.refresh(users_view)
+
+    loaded = UserSnapshot.open(path, max_age=0)
+    assert isinstance(loaded._columns["lastLogin"], np.memmap)
+    assert loaded.rows(limit=100) == snapshot.rows(limit=100)
+
+    users_view.apply({"user2@example.com": None, "user30@example.com": user(30)})
+    with patch.object(users_view, "read_all") as read_all:
+        assert loaded.refresh(users_view)
+    read_all.assert_not_called()
+    assert sorted(emails(loaded.rows(limit=100))) == sorted(
+        [f"user{i}@example.com" for i in range(10) if i != 2] + ["user30@example.com"])
+    # the file is not changed by the refresh of the mapped snapshot.
+    assert UserSnapshot.load(path, mmap=False).count() == 10
+
+    (tmp_path / "broken.snapshot").write_bytes(b"not a snapshot")
+    assert UserSnapshot.open(str(tmp_path / "broken.snapshot")).size == 0
+
+
+def test_analytics_routes(users_view):
+    users_view.redis_service.redis_client.delete(UsersView.BUILD_KEY)
+    snapshot = UserSnapshot(max_age=0)
+
+    with mock_aws():
+        OktaUser.create_table(read_capacity_units=5, write_capacity_units=5, wait=True)
+        user_repository = UserRepository(OktaUser, users_view=users_view)
+        user_repository.upload_user_data_to_db({
+            "user_1": {"email": "user1@example.com", "name": "User 1", "admin": True,
+                       "lastLogin": "2020-03-01T10:00:00.000Z", "passwordChanged": "2020-03-01T10:00:00.000Z"},
+            "user_2": {"email": "user2@example.com", "name": "User 2", "lastLogin": "2020-03-01T10:00:00.000Z"},
+            "user_3": {"email": "user3@example.com", "name": "User 3", "admin": True}})
+
+        def get_users(**filters):
+            return users.get_analytics_users(**dict(dict(admin=None, inactive_days=None, never_logged_in=False,
+                                                         password_older_than_days=None, status_changed_within_days=None,
+                                                         order_by=None, descending=False, limit=100), **filters),
+                                             user_snapshot=snapshot, users_view=users_view,
+                                             user_repository=user_repository)
+
+        # the first request starts building the view in the background.
+        with pytest.raises(users.HTTPException) as error:
+            get_users(admin=True)
+        assert error.value.status_code == 503
+        users_view.start_build(user_repository).join()
+
+        response = get_users(admin=True, inactive_days=30)
+        assert response["count"] == 1 and emails(response["users"]) == ["user1@example.com"]
+        assert get_users(never_logged_in=True)["count"] == 1
+        assert get_users(password_older_than_days=30)["count"] == 1
+
+        summary = users.get_analytics_summary(days=30, user_snapshot=snapshot, users_view=users_view,
+                                              user_repository=user_repository)
+        assert summary == {"users": 3, "admins": 2, "never_logged_in": 1, "inactive": 2, "old_passwords": 1,
+                           "admins_with_old_password": 1}
+
+        # writes show up at the next request.
+        user_repository.upload_user_data_to_db({"user_4": {"email": "user4@example.com", "name": "User 4"}})
+        assert get_users(never_logged_in=True)["count"] == 2
+
+        with pytest.raises(users.HTTPException) as error:
+            get_users(order_by="name")
+        assert error.value.status_code == 400
@@ -0,0 +1,169 @@
+import asyncio
+import json
+import os
+import pytest
+import subprocess
+import sys
+from unittest.mock import MagicMock, AsyncMock, patch
+from fastapi import HTTPException
+from app.api import users
+from app.api import dependencies
+from app.api.dependencies import shared
+from app.api.utils import encode_page_token, decode_page_token
+from app.dynamo_db.models import OktaUser, OktaUserEvent
+
+
+def make_user(i):
+    return OktaUser(email=f"user{i}@example.com", admin="False", lastLogin="", name=f"User {i}",
+                    passwordChanged="", statusChanged="", id=f"user_{i}")
+
+
+def make_raw_item(i):
+    return make_user(i).serialize()
+
+
+def test_page_token_round_trip():
+    key = {"email": {"S": "user1@example.com"}}
+
+    assert decode_page_token(encode_page_token(key)) == key
+    assert encode_page_token(None) is None
+    assert decode_page_token(None) is None
+
+    with pytest.raises(ValueError):
+        decode_page_token("not a token")
+
+
+def test_get_users_scan_results_page():
+    async_user_repository = MagicMock()
+    async_user_repository.scan_page = AsyncMock(return_value=([make_raw_item(1)],
+                                                              {"email": {"S": "user1@example.com"}}))
+
+    response = json.loads(asyncio.run(users.get_users_scan_results(
+        limit=1, async_user_repository=async_user_repository)).body)
+
+    async_user_repository.scan_page.assert_called_once_with(1, None, raw=True)
+    assert [user["email"] for user in response["items"]] == ["user1@example.com"]
+    assert "adminKey" not in response["items"][0]
+
+    token = response["last_evaluated_key"]
+    async_user_repository.scan_page.return_value = ([make_raw_item(2)], None)
+
+    response = json.loads(asyncio.run(users.get_users_scan_results(
+        limit=1, last_evaluated_key=token, async_user_repository=async_user_repository)).body)
+
+    async_user_repository.scan_page.assert_called_with(1, {"email": {"S": "user1@example.com"}}, raw=True)
+    assert response["last_evaluated_key"] is None
+
+
+def test_get_users_scan_results_page_invalid_token():
+    with pytest.raises(HTTPException) as ex:
+        asyncio.run(users.get_users_scan_results(limit=1, last_evaluated_key="not a token",
+                                                 async_user_repository=MagicMock()))
+
+    assert ex.value.status_code == 400
+
+
+def test_get_user_events():
+    event = OktaUserEvent.from_event("user1@example.com", {"Timestamp": "2025-03-01T10:00:00",
+                                                           "Event Description": "MFA Enabled"})
+    user_event_repository = MagicMock()
+    user_event_repository.get_events.return_value = ([event], {"email": {"S": "user1@example.com"}})
+
+    response = users.get_user_events("user1@example.com", start="2025-03-01T00:00:00", limit=10,
+                                     user_event_repository=user_event_repository)
+
+    user_event_repository.get_events.assert_called_once_with("user1@example.com", "2025-03-01T00:00:00", None,
+                                                              limit=10, last_evaluated_key=None)
+    assert response["items"] == [{"Timestamp": "2025-03-01T10:00:00", "Event Description": "MFA Enabled"}]
+    assert decode_page_token(response["last_evaluated_key"]) == {"email": {"S": "user1@example.com"}}
+
+    with pytest.raises(HTTPException) as ex:
+        users.get_user_events("user1@example.com", limit=0, user_event_repository=user_event_repository)
+    assert ex.value.status_code == 400
+
+
+def test_get_last_user_login_async_path():
+    async_user_repository = MagicMock()
+    async_user_repository.get_user_by_email = AsyncMock(return_value=OktaUser(
+        email="user1@example.com", admin="False", lastLogin="2025-03-01T10:00:00Z", name="User 1",
+        passwordChanged="", statusChanged="", id="user_1"))
+    user_cache = MagicMock()
+    user_cache.aget_object = AsyncMock(return_value=None)
+    user_cache.aset_object = AsyncMock()
+
+    response = asyncio.run(users.get_last_user_login("user1@example.com", user_cache=user_cache,
+                                                     async_user_repository=async_user_repository))
+
+    assert response == {"user": "User 1", "last_login": "2025-03-01T10:00:00Z"}
+    user_cache.aset_object.assert_awaited_once_with("user_details:user1@example.com", response, ex=60)
+
+
+def test_stream_users_scan_results():
+    user_repository = MagicMock()
+    user_repository.iter_scan.return_value = iter([make_raw_item(1), make_raw_item(2)])
+
+    async def read_body(response):
+        return b"".join([chunk async for chunk in response.body_iterator])
+
+    response = users.stream_users_scan_results(user_repository=user_repository)
+    body = asyncio.run(read_body(response))
+
+    assert response.media_type == "application/x-ndjson"
+    assert [json.loads(line)["email"] for line in body.splitlines()] == ["user1@example.com", "user2@example.com"]
+
+
+def test_shared_service_is_created_once():
+    created = []
+
+    @shared
+    def get_service():
+        created.append(object())
+        return created[-1]
+
+    assert not get_service.created()
+    assert asyncio.run(get_service.dependency()) is get_service() is created[0]
+    assert get_service.created() and len(created) == 1
+
+
+def test_analytics_routes_unavailable_without_numpy():
+    from app.services import user_snapshot
+
+    with patch.object(user_snapshot, "np", None), \
+            patch.object(users, "get_user_snapshot", shared(lambda: user_snapshot.UserSnapshot())):
+        with pytest.raises(HTTPException) as error:
+            asyncio.run(users.user_snapshot_dependency())
+
+    assert error.value.status_code == 503
+
+
+def test_writes_invalidate_the_user_details_in_a_fresh_process():
+    import fakeredis
+    from moto import mock_aws
+    from app.dynamo_db.repositories import UserRepository
+    from app.services.redis_service import RedisService
+    from app.services.two_tier_cache import TwoTierCache
+
+    redis_service = RedisService(redis_client=fakeredis.FakeRedis())
+    redis_service.set_object("user_details:user1@example.com", {"email": "user1@example.com"})
+    pubsub = redis_service.redis_client.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(TwoTierCache.CHANNEL)
+
+    # the user cache of this process was never created.
+    with mock_aws(), patch.object(dependencies, "get_user_cache", shared(lambda: TwoTierCache(redis_service))):
+        OktaUser.create_table(read_capacity_units=5, write_capacity_units=5, wait=True)
+        user_repository = UserRepository(OktaUser, on_users_written=dependencies.invalidate_user_details)
+        user_repository.upload_user_data_to_db({"user_1": {"email": "user1@example.com", "name": "User 1"}})
+
+    assert redis_service.get_object("user_details:user1@example.com") is None
+    # the first message read is the subscription, skipped.
+    messages = [pubsub.get_message(timeout=1) for _ in range(2)]
+    assert [json.loads(message["data"]) for message in messages if message] == [["user_details:user1@example.com"]]
+
+
+def test_app_import_does_not_load_the_clients():
+    code = ("import sys, main; "
+            "print(sorted(m for m in ('botocore', 'pynamodb', 'aiohttp', 'requests', 'redis') if m in sys.modules))")
+    result = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.dirname(__file__)),
+                            capture_output=True, text=True, check=True)
+
+    assert result.stdout.strip() == "[]"
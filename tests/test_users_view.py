@@ -0,0 +1,146 @@
+import asyncio
+import json
+from unittest.mock import patch
+import fakeredis
+import pytest
+from moto import mock_aws
+from app.api import users
+from app.api.utils import serialize_raw_item
+from app.dynamo_db.models import OktaUser
+from app.dynamo_db.repositories import UserRepository
+from app.dynamo_db.service import UserService
+from app.services.redis_service import RedisService, AsyncRedisService
+from app.services.users_view import UsersView
+
+
+@pytest.fixture
+def users_view():
+    redis_server = fakeredis.FakeServer()
+    return UsersView(RedisService(redis_client=fakeredis.FakeRedis(server=redis_server)),
+                     async_redis_service=AsyncRedisService(redis_client=fakeredis.FakeAsyncRedis(server=redis_server)))
+
+
+@pytest.fixture
+def user_repository(users_view):
+    with mock_aws():
+        OktaUser.create_table(read_capacity_units=5, write_capacity_units=5, wait=True)
+        yield UserRepository(OktaUser, users_view=users_view)
+
+
+def table_users(user_repository):
+    return {item["email"]["S"]: serialize_raw_item(OktaUser, item) for item in user_repository.scan_table(raw=True)}
+
+
+def view_users(users_view):
+    return {email.decode(): json.loads(value)
+            for email, value in users_view.redis_service.redis_client.hgetall(UsersView.USERS_KEY).items()}
+
+
+def test_view_versions_and_etag(users_view):
+    async def read_view():
+        assert await users_view.aget() is None
+
+        users_view.redis_service.redis_client.set(UsersView.BUILD_KEY, "build")
+        users_view.apply({"b@example.com": {"email": "b@example.com"}, "a@example.com": {"email": "a@example.com"}})
+        first = await users_view.aget()
+        # same version - the response of this process is reused.
+        assert await users_view.aget() is first
+
+        users_view.apply({"b@example.com": None})
+        return first, await users_view.aget()
+
+    (etag, body), (new_etag, new_body) = asyncio.run(read_view())
+
+    assert etag == '"build-1"' and new_etag == '"build-2"'
+    assert json.loads(body) == [{"email": "a@example.com"}, {"email": "b@example.com"}]
+    assert json.loads(new_body) == [{"email": "a@example.com"}]
+
+
+def test_writes_update_the_view(users_view, user_repository):
+    assert users_view.build(user_repository) == 0
+
+    user_repository.upload_user_data_to_db({
+        "user_1": {"email": "user1@example.com", "name": "User 1", "lastLogin": "2025-03-01T10:00:00.000Z"},
+        "user_2": {"email": "user2@example.com", "name": "User 2", "admin": True}})
+    UserService(user_repository).update_users_from_csv([
+        {"User Email": "user1@example.com", "Timestamp": "1741000000", "Event Description": "User Login"},
+        {"User Email": "user2@example.com", "Timestamp": "1741000000", "Event Description": "MFA Enabled"},
+        {"User Email": "unknown@example.com", "Timestamp": "1741000000", "Event Description": "User Login"}])
+    user = user_repository.get_user_by_email("user1@example.com")
+    user.name = "User One"
+    user_repository.save_user(user)
+
+    # computed from the writes, without reading the users back.
+    assert view_users(users_view) == table_users(user_repository)
+    assert view_users(users_view)["user2@example.com"]["user_events"][0]["Event Description"] == "MFA Enabled"
+    assert users_view.reconcile(user_repository)["fixed"] == 0
+
+
+def test_reconcile_fixes_the_view(users_view, user_repository):
+    user_repository.upload_user_data_to_db({f"user_{i}": {"email": f"user{i}@example.com", "name": f"User {i}"}
+                                            for i in range(5)})
+    # built by the first reconciliation.
+    assert users_view.reconcile(user_repository, total_segments=2)["users"] == 5
+
+    client = users_view.redis_service.redis_client
+    client.hset(UsersView.USERS_KEY, "user0@example.com", json.dumps({"email": "user0@example.com"}))
+    client.hdel(UsersView.USERS_KEY, "user1@example.com")
+    client.hset(UsersView.USERS_KEY, "deleted@example.com", json.dumps({"email": "deleted@example.com"}))
+
+    report = users_view.reconcile(user_repository, total_segments=2)
+
+    assert report == {"users": 5, "missing": 1, "stale": 1, "extra": 1, "fixed": 3}
+    assert view_users(users_view) == table_users(user_repository)
+
+
+def test_users_results_served_from_the_view(users_view, user_repository):
+    user_repository.upload_user_data_to_db({"user_1": {"email": "user1@example.com", "name": "User 1"}})
+
+    async def get_results(if_none_match=None):
+        return await users.get_users_scan_results(users_view=users_view, user_repository=user_repository,
+                                                  if_none_match=if_none_match)
+
+    # the first request starts building the view in the background.
+    with pytest.raises(users.HTTPException) as error:
+        asyncio.run(get_results())
+    assert error.value.status_code == 503
+    users_view.start_build(user_repository).join()
+
+    response = asyncio.run(get_results())
+    etag = response.headers["etag"]
+    assert response.status_code == 200
+    assert [user["email"] for user in json.loads(response.body)] == ["user1@example.com"]
+
+    assert asyncio.run(get_results(f'W/{etag}')).status_code == 304
+
+    user_repository.upload_user_data_to_db({"user_2": {"email": "user2@example.com", "name": "User 2"}})
+    response = asyncio.run(get_results(etag))
+    assert response.status_code == 200 and response.headers["etag"] != etag
+    assert len(json.loads(response.body)) == 2
+
+    # while the view is rebuilt, the last version is served.
+    users_view.redis_service.redis_client.delete(UsersView.BUILD_KEY)
+    with patch.object(users_view, "start_build") as start_build:
+        assert asyncio.run(get_results()).body == response.body
+    start_build.assert_called_once()
+
+
+def test_each_version_rendered_once(users_view):
+    users_view.redis_service.redis_client.set(UsersView.BUILD_KEY, "build")
+    users_view.apply({f"user{i}@example.com": {"email": f"user{i}@example.com"} for i in range(10)})
+    other_process = UsersView(users_view.redis_service, async_redis_service=users_view.async_redis_service)
+
+    async def concurrent_requests():
+        return await asyncio.gather(*[users_view.aget() for _ in range(20)])
+
+    with patch.object(UsersView, "_body", wraps=UsersView._body) as render:
+        responses = asyncio.run(concurrent_requests())
+        assert asyncio.run(other_process.aget()) == responses[0]
+        assert render.call_count == 1
+
+        users_view.apply({"user0@example.com": None})
+        assert len(json.loads(asyncio.run(other_process.aget())[1])) == 9
+        assert asyncio.run(users_view.aget()) == other_process._response
+        assert render.call_count == 2
+
+    assert all(response is responses[0] for response in responses)
@@ -1,9 +1,17 @@
+import csv
+import io
+import json
 import pytest
-from app.api.utils import DataProcessor, parse_datetime, serialize_okta_user, read_csv_from_s3
+from app.api.utils import (DataProcessor, parse_datetime, serialize_okta_user, open_csv_stream,
+                           serialize_raw_item, get_s3_fingerprint)
+from app.services import serializers
+from app.services.serializers import dumps_json, loads_json
 from datetime import datetime
 from app.dynamo_db.models import OktaUser
 from unittest.mock import patch
 import requests
+from tests.fake_s3 import FakeS3Server, audit_csv
+from tests.fake_okta import fake_okta_user
 
 
 def test_extract_data():
@@ -40,6 +48,39 @@ def test_extract_data():
     assert response["user2"].get("email") == 'jane.smith@example.com'
 
 
+def extract_data_reference(raw_users_data, relevant_fields):
+    """the field by field extraction the projection plans replaced."""
+    users_data = {}
+    for user in raw_users_data:
+        user_dict = {}
+        for field in relevant_fields:
+            if field in user:
+                user_dict[field] = user[field]
+            elif (field == "name" and "profile" in user and "firstName" in user["profile"]
+                  and "lastName" in user["profile"]):
+                user_dict["name"] = f"{user['profile']['firstName']} {user['profile']['lastName']}"
+            elif field == "email" and "profile" in user and "email" in user["profile"]:
+                user_dict["email"] = user["profile"]["email"]
+        users_data[user['id']] = user_dict
+    return users_data
+
+
+def test_extract_data_parity_with_reference():
+    raw_users_data = [fake_okta_user(i) for i in range(5)] + [
+        {"id": "top_level", "name": "Top Level", "email": "top@example.com", "lastLogin": None,
+         "profile": {"firstName": "Other", "lastName": "Name", "email": "other@example.com"}},
+        {"id": "no_profile", "status": "ACTIVE"},
+        {"id": "partial_profile", "profile": {"firstName": "Only"}},
+    ]
+    relevant_fields = {"id", "statusChanged", "lastLogin", "passwordChanged", "name", "email", "missing"}
+
+    expected = extract_data_reference(raw_users_data, relevant_fields)
+
+    assert DataProcessor.extract_data(raw_users_data, relevant_fields) == expected
+    assert expected["top_level"]["name"] == "Top Level"
+    assert expected["partial_profile"] == {"id": "partial_profile"}
+
+
 def test_update_admin_field():
     raw_users_data = [
         {
@@ -121,31 +162,95 @@ def test_serialize_okta_user_value_error():
         serialize_okta_user(not_model_type)
 
 
-def test_read_csv_from_s3_error():
+def test_open_csv_stream_error():
 
     with patch('requests.get') as mock_get:
 
         mock_get.return_value.status_code = 500
-        mock_get.return_value.text = 'Internal Server Error'
 
         with pytest.raises(requests.exceptions.RequestException) as ex:
-            read_csv_from_s3("https://fake-s3-url.com/fakefile.csv")
+            open_csv_stream("https://fake-s3-url.com/fakefile.csv")
 
         assert str(ex.value) == 'An error occurred while processing the CSV file: Failed to retrieve file: 500'
+        mock_get.return_value.close.assert_called_once()
 
 
-def test_read_csv_from_s3_success():
-    with patch('requests.get') as mock_get:
+def test_open_csv_stream_success():
+    content = b"User Email,Timestamp,Event Description\njohn.doe@example.com,1616152892,login\n"
+
+    with FakeS3Server(content) as server:
+        result = list(open_csv_stream(server.url))
+
+    assert result == [{
+        'User Email': 'john.doe@example.com',
+        'Timestamp': '1616152892',
+        'Event Description': 'login'
+    }]
+
+
+@pytest.mark.parametrize("support_range", [True, False])
+def test_open_csv_stream_resume_from_offset(support_range):
+    content = audit_csv(rows=50)
+
+    with FakeS3Server(content, support_range=support_range) as server:
+        stream = open_csv_stream(server.url, chunk_size=64)
+        rows = iter(stream)
+        first_rows = [next(rows) for _ in range(20)]
+        offset, fieldnames = stream.offset, stream.fieldnames
+        rows.close()
+
+        resumed = open_csv_stream(server.url, start_offset=offset, fieldnames=fieldnames, chunk_size=64)
+        rest = list(resumed)
+
+        # nothing left after the last row.
+        assert list(open_csv_stream(server.url, start_offset=resumed.offset, fieldnames=fieldnames)) == []
+
+    assert stream.total_bytes == resumed.total_bytes == len(content)
+    assert resumed.offset == len(content)
+    assert first_rows + rest == list(csv.DictReader(io.StringIO(content.decode())))
+    assert server.requests[1] == f"bytes={offset}-"
+
+
+def test_get_s3_fingerprint_and_if_match():
+    with FakeS3Server(audit_csv(rows=10)) as server:
+        fingerprint = get_s3_fingerprint(server.url)
+        assert list(open_csv_stream(server.url, if_match=fingerprint["etag"]))
+
+        server.content = audit_csv(rows=20)
+        changed = get_s3_fingerprint(server.url)
+
+        with pytest.raises(requests.exceptions.RequestException, match="the file changed"):
+            open_csv_stream(server.url, start_offset=100, fieldnames=["User Email"], if_match=fingerprint["etag"])
+
+    assert fingerprint["content_length"] == len(audit_csv(rows=10))
+    assert fingerprint["last_modified"] and changed["etag"] != fingerprint["etag"]
+
+    with FakeS3Server(audit_csv(rows=10), versioned=False) as server:
+        assert get_s3_fingerprint(server.url) is None
+
+
+def test_serialize_raw_item_matches_model_serialization():
+    user = OktaUser(email="john.doe@example.com", admin="True", lastLogin="2025-03-01T10:00:00+00:00Z",
+                    name="John Doe", passwordChanged="2025-01-01T10:00:00+00:00Z", statusChanged="", id="user1",
+                    user_events=[{"Timestamp": "2025-03-01T10:00:00", "Event Description": "MFA Enabled"}])
+    raw_item = user.serialize()
+
+    assert "adminKey" in raw_item
+    assert serialize_raw_item(OktaUser, raw_item) == serialize_okta_user(OktaUser.from_raw_data(raw_item))
 
-        mock_get.return_value.status_code = 200
-        mock_get.return_value.text = "User Email,Timestamp,Event Description\njohn.doe@example.com,1616152892,login\n"
+    # missing attributes get the same values as a model built from the item.
+    partial_item = {"email": {"S": "jane@example.com"}}
+    assert serialize_raw_item(OktaUser, partial_item) == serialize_okta_user(OktaUser.from_raw_data(partial_item))
 
-        result = read_csv_from_s3("https://fake-s3-url.com/fakefile.csv")
 
-        expected_result = [{
-            'User Email': 'john.doe@example.com',
-            'Timestamp': '1616152892',
-            'Event Description': 'login'
-        }]
+@pytest.mark.parametrize("with_orjson", [True, False])
+def test_dumps_json(with_orjson):
+    value = {"email": "josé@example.com", "events": [{"Timestamp": "2025-03-01T10:00:00"}], "admin": None}
 
-        assert result == expected_result
+    if with_orjson:
+        pytest.importorskip("orjson")
+        assert loads_json(dumps_json(value)) == value
+    else:
+        with patch.object(serializers, "orjson", None):
+            assert dumps_json(value) == json.dumps(value, separators=(",", ":")).encode()
+            assert loads_json(dumps_json(value)) == value
@@ -0,0 +1,89 @@
+import threading
+import pytest
+from botocore.exceptions import ClientError
+from pynamodb.exceptions import UpdateError
+from app.services.write_scheduler import TokenBucket, WriteScheduler, error_code
+
+
+def throttling_error():
+    return UpdateError("Failed to update item", ClientError(
+        {"Error": {"Code": "ProvisionedThroughputExceededException", "Message": "throttled"}}, "UpdateItem"))
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_token_bucket_limits_rate():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=10, capacity=5, clock=clock, sleep=clock.sleep)
+
+    for _ in range(25):
+        bucket.acquire()
+
+    # a burst of 5, then 10 per second.
+    assert clock.now == pytest.approx(2.0)
+
+
+def test_write_scheduler_keeps_order_per_key():
+    applied = {}
+    lock = threading.Lock()
+
+    def write(key, value):
+        with lock:
+            applied.setdefault(key, []).append(value)
+        return value
+
+    with WriteScheduler(workers=4, max_pending=5) as scheduler:
+        for value in range(200):
+            scheduler.submit(f"user{value % 10}@example.com", write, f"user{value % 10}@example.com", value)
+
+    assert applied == {f"user{i}@example.com": list(range(i, 200, 10)) for i in range(10)}
+    assert scheduler.results["user3@example.com"] == 193
+    stats = scheduler.stats()
+    assert stats["writes"] == 200 and stats["failed"] == 0 and stats["writes_per_sec"] > 0
+
+
+def test_write_scheduler_backs_off_when_throttled():
+    attempts = []
+
+    def write(key):
+        attempts.append(key)
+        if key == "hot@example.com" and attempts.count(key) <= 3:
+            raise throttling_error()
+        if key == "broken@example.com":
+            raise ValueError("bad item")
+        return "updated"
+
+    scheduler = WriteScheduler(workers=2, writes_per_second=1000, backoff_base=0)
+    with scheduler:
+        for key in ("hot@example.com", "cold@example.com", "broken@example.com"):
+            scheduler.submit(key, write, key)
+
+    assert scheduler.results == {"hot@example.com": "updated", "cold@example.com": "updated"}
+    assert list(scheduler.failures) == ["broken@example.com"]
+    # other errors are not retried.
+    assert attempts.count("broken@example.com") == 1
+    assert scheduler.stats()["throttles"] == 3
+
+    # the throttled writer slowed down.
+    hot_bucket = scheduler.buckets[scheduler.shard("hot@example.com")]
+    assert hot_bucket.rate < scheduler.writer_rate
+
+
+def test_write_scheduler_gives_up_after_max_retries():
+    def write():
+        raise throttling_error()
+
+    with WriteScheduler(workers=1, max_retries=2, backoff_base=0) as scheduler:
+        scheduler.submit("hot@example.com", write)
+
+    assert error_code(scheduler.failures["hot@example.com"]) == "ProvisionedThroughputExceededException"
+    assert scheduler.stats()["throttles"] == 3